@@ -1,81 +1,91 @@
 import argparse
 import datetime as dt
-from dataclasses import dataclass
+import sys
 from datetime import datetime
 from pathlib import Path
-from typing import List, Tuple
+from typing import Iterator
 
 import cv2
 import numpy as np
 import psycopg
-from palettable.colorbrewer.qualitative import Set1_9
-from psycopg.rows import class_row
 from tqdm import tqdm
 
-CLS_CMAP = Set1_9.colors
-
-
-@dataclass
-class DetectionRow:
-    detection_id: int
-    capture_ts: datetime
-    camera_id: str
-    object_id: str
-    class_id: int
-    confidence: float
-    min_x: float
-    min_y: float
-    max_x: float
-    max_y: float
-    latitude: float
-    longitude: float
-
-
-def fetch_data(start_time: datetime, end_time: datetime, camera_id: str) -> List[DetectionRow]:
-    conn_params = {
-        'dbname': 'saebackend',
-        'user': 'saebackend',
-        'password': 'saebackend',
-        'host': 'carmel-k3s',
-        'port': '30003',
-        'row_factory': class_row(DetectionRow)
-    }
-
-    try:
-        with psycopg.connect(**conn_params) as conn:
-            with conn.cursor() as cur:
-                query = "SELECT * FROM detection WHERE capture_ts >= %s AND capture_ts <= %s AND camera_id = %s ORDER BY capture_ts ASC;"
-                cur.execute(query, (start_time.isoformat(), end_time.isoformat(), camera_id))
-                rows = []
-                print('Loading result')
-                with tqdm(unit=' rows') as pbar:
-                    while (len(records := cur.fetchmany(10000)) > 0):
-                        pbar.update(len(records))
-                        rows += records
-                return rows
-
-    except psycopg.DatabaseError as e:
-        print(f"Database error: {e}")
-    except Exception as e:
-        print(f"Unexpected error: {e}")
-
-def get_color(class_id: int) -> Tuple[int]:
-    c = CLS_CMAP[class_id % len(CLS_CMAP)]
-    return (c[2], c[1], c[0])
-
-def get_center(row: DetectionRow):
-    return ((row.min_x + row.max_x) / 2, (row.min_y + row.max_y) / 2)
-
-def draw_trajectories(img, detections: List[DetectionRow]):
-    preceding_points = {}
-    for det in tqdm(detections):
-        new_point = get_center(det)
-        if det.object_id in preceding_points:
-            draw_line(img, pt1=preceding_points[det.object_id], pt2=new_point, class_id=det.class_id)
-        preceding_points[det.object_id] = new_point
-
-def draw_line(img, pt1: Tuple[float], pt2: Tuple[float], class_id: int):
-    cv2.line(img, (int(pt1[0] * img.shape[1]), int(pt1[1] * img.shape[0])), (int(pt2[0] * img.shape[1]), int(pt2[1] * img.shape[0])), color=get_color(class_id), thickness=1, lineType=cv2.LINE_AA)
+# The trajectories are drawn like the ones of SAE dumps (tools/sae-introspection/plot.py)
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'sae-introspection'))
+from trajectories import TRACK_POINT_DTYPE, draw_trajectories
+
+CHUNK_ROWS = 100_000
+
+# Only fixed-size, non-null columns are selected, so that every row of the binary COPY output has the same layout
+# (field count, then length and value of each field, big-endian) and chunks can be read directly into NumPy.
+# The object id is hashed to an integer on the server, which is all that is needed to connect the detections of an object.
+QUERY = """
+COPY (
+    SELECT hashtextextended(object_id::text, 0), class_id::int4, capture_ts, ((min_x + max_x) / 2)::float4, ((min_y + max_y) / 2)::float4
+    FROM detection
+    WHERE capture_ts >= %s AND capture_ts <= %s AND camera_id = %s
+        AND object_id IS NOT NULL AND class_id IS NOT NULL AND min_x IS NOT NULL AND min_y IS NOT NULL AND max_x IS NOT NULL AND max_y IS NOT NULL
+    ORDER BY capture_ts ASC
+) TO STDOUT (FORMAT BINARY)
+"""
+COPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+COPY_TRAILER = b'\xff\xff'
+_COPY_HEADER_SIZE = len(COPY_SIGNATURE) + 8
+COPY_ROW_DTYPE = np.dtype([
+    ('field_count', '>i2'),
+    ('object_length', '>i4'), ('object', '>i8'),
+    ('class_length', '>i4'), ('class_id', '>i4'),
+    ('ts_length', '>i4'), ('capture_ts', '>i8'),
+    ('x_length', '>i4'), ('center_x', '>f4'),
+    ('y_length', '>i4'), ('center_y', '>f4'),
+])
+
+
+def fetch_data(conn_params: dict, start_time: datetime, end_time: datetime, camera_id: str) -> Iterator[np.ndarray]:
+    """Streams the detections of a camera in chunks of (up to) CHUNK_ROWS rows of TRACK_POINT_DTYPE, in capture time order."""
+    with psycopg.connect(**conn_params) as conn:
+        with conn.cursor() as cur:
+            with cur.copy(QUERY, (start_time.isoformat(), end_time.isoformat(), camera_id)) as copy:
+                yield from iter_copy_chunks(copy)
+
+def iter_copy_chunks(copy: Iterator[bytes]) -> Iterator[np.ndarray]:
+    buffer = bytearray()
+    is_header_read = False
+    for data in copy:
+        buffer += data
+        if not is_header_read:
+            if len(buffer) < _COPY_HEADER_SIZE:
+                continue
+            if buffer[:len(COPY_SIGNATURE)] != COPY_SIGNATURE:
+                raise ValueError('Unexpected COPY output (no binary COPY signature)')
+            header_size = _COPY_HEADER_SIZE + int.from_bytes(buffer[_COPY_HEADER_SIZE - 4:_COPY_HEADER_SIZE], 'big')
+            if len(buffer) < header_size:
+                continue
+            del buffer[:header_size]
+            is_header_read = True
+        if len(buffer) >= CHUNK_ROWS * COPY_ROW_DTYPE.itemsize:
+            yield _take_rows(buffer)
+
+    if len(buffer) % COPY_ROW_DTYPE.itemsize != len(COPY_TRAILER) or buffer[-len(COPY_TRAILER):] != COPY_TRAILER:
+        raise ValueError('Unexpected end of COPY output')
+    if len(buffer) > len(COPY_TRAILER):
+        yield _take_rows(buffer)
+
+def _take_rows(buffer: bytearray) -> np.ndarray:
+    """Removes all complete rows from the buffer and returns them as detections."""
+    row_count = len(buffer) // COPY_ROW_DTYPE.itemsize
+    rows = np.frombuffer(buffer, dtype=COPY_ROW_DTYPE, count=row_count)
+    if np.any(rows['field_count'] != 5):
+        raise ValueError('Unexpected COPY row layout')
+
+    detections = np.empty(row_count, dtype=TRACK_POINT_DTYPE)
+    for name in ('object', 'class_id', 'center_x', 'center_y'):
+        detections[name] = rows[name]
+    # Microseconds since 2000-01-01 (binary timestamp format), only differences matter
+    detections['time'] = rows['capture_ts'] / 1e6
+    del rows
+    del buffer[:row_count * COPY_ROW_DTYPE.itemsize]
+    return detections
 
 if __name__ == "__main__":
     arg_parser = argparse.ArgumentParser()
@@ -83,9 +93,21 @@ if __name__ == "__main__":
     arg_parser.add_argument('-i', '--image-file', type=Path)
     arg_parser.add_argument('-s', '--start-time', type=dt.datetime.fromisoformat, help='Data segment start time (in isoformat)')
     arg_parser.add_argument('-l', '--length', type=lambda s: dt.timedelta(seconds=int(s)), default=dt.timedelta(minutes=10), help='Length of data segment to load [s]')
+    arg_parser.add_argument('--db-host', type=str, default='carmel-k3s', help='Database host')
+    arg_parser.add_argument('--db-port', type=int, default=30003, help='Database port')
+    arg_parser.add_argument('--db-name', type=str, default='saebackend', help='Database name')
+    arg_parser.add_argument('--db-user', type=str, default='saebackend', help='Database user (the password is taken from PGPASSWORD or ~/.pgpass)')
+    arg_parser.add_argument('--track-timeout', type=float, default=60, help='Do not connect detections of an object that are further apart [s]')
 
     args = arg_parser.parse_args()
 
+    conn_params = {
+        'dbname': args.db_name,
+        'user': args.db_user,
+        'host': args.db_host,
+        'port': args.db_port,
+    }
+
     if args.start_time is None:
         start_time = dt.datetime.now(tz=dt.UTC) - args.length
     else:
@@ -102,13 +124,25 @@ if __name__ == "__main__":
 
     output_file = Path('.') / f'{args.camera_id}_{start_time}_{args.length.seconds}s.jpg'
 
-    print(f'Running query (camera: {args.camera_id}, start: {start_time.isoformat(timespec='seconds')}, length: {args.length})')
-    rows = fetch_data(start_time, end_time, args.camera_id)
+    print(f'Running query (camera: {args.camera_id}, start: {start_time.isoformat(timespec="seconds")}, length: {args.length}, database: {args.db_host}:{args.db_port})')
 
-    print(f'Retrieved {len(rows)} data points from DB')
+    # Each chunk is drawn as soon as it has been received, so memory usage does not depend on the length of the data segment
+    previous = np.empty(0, dtype=TRACK_POINT_DTYPE)
+    row_count = 0
+    try:
+        with tqdm(unit=' rows') as pbar:
+            for detections in fetch_data(conn_params, start_time, end_time, args.camera_id):
+                previous = draw_trajectories(annotated_image, detections, previous)
+                # Objects that have not been seen for a while are not carried over, so the cost per chunk stays bounded
+                previous = previous[previous['time'] >= detections['time'][-1] - args.track_timeout]
+                row_count += len(detections)
+                pbar.update(len(detections))
+    except psycopg.DatabaseError as e:
+        print(f"Database error: {e}")
+    except Exception as e:
+        print(f"Unexpected error: {e}")
 
-    print('Drawing trajectories')
-    draw_trajectories(annotated_image, rows)
+    print(f'Retrieved {row_count} data points from DB')
 
     if args.image_file is None:
         output_image = annotated_image
@@ -118,4 +152,3 @@ if __name__ == "__main__":
 
     cv2.imwrite(output_file, output_image, [cv2.IMWRITE_JPEG_QUALITY, 90])
     print(f'Output written to {output_file}')
-    
@@ -0,0 +1,59 @@
+import time
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from typing import Callable
+
+import cv2
+import numpy as np
+from visionapi.sae_pb2 import VideoFrame
+from visionlib.pipeline.tools import get_raw_frame_data
+
+from common import get_scaled_frame_data, get_turbojpeg
+
+
+def synthetic_frame(width: int, height: int) -> np.ndarray:
+    # Smooth gradients plus some noise compress roughly like camera footage (pure noise would be unrealistically expensive)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)
+    image = np.stack(np.broadcast_arrays(x[None, :], y[:, None], (x[None, :] + y[:, None]) / 2), axis=-1)
+    image += np.random.normal(0, 8, image.shape)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+def decode_full_and_resize(frame: VideoFrame, target_width: int) -> np.ndarray:
+    image = get_raw_frame_data(frame)
+    scale_factor = target_width / image.shape[1]
+    return cv2.resize(image, None, fx=scale_factor, fy=scale_factor, interpolation=cv2.INTER_AREA)
+
+def decode_scaled(frame: VideoFrame, target_width: int) -> np.ndarray:
+    return get_scaled_frame_data(frame, target_width=target_width)
+
+def measure(func: Callable, frame: VideoFrame, target_width: int, iterations: int) -> float:
+    func(frame, target_width)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func(frame, target_width)
+    return (time.perf_counter() - start) / iterations * 1000
+
+
+if __name__ == '__main__':
+
+    arg_parser = ArgumentParser(description='Compare full-size JPEG decoding + resizing with DCT-scaled decoding', formatter_class=ArgumentDefaultsHelpFormatter)
+    arg_parser.add_argument('-i', '--image-file', type=str, help='JPEG file to decode (a synthetic 4K frame is used if not specified)', metavar='FILE')
+    arg_parser.add_argument('-w', '--target-widths', type=int, nargs='+', default=[320, 640, 1280, 1920], metavar='WIDTH')
+    arg_parser.add_argument('-n', '--iterations', type=int, default=20)
+    args = arg_parser.parse_args()
+
+    frame = VideoFrame()
+    if args.image_file is not None:
+        with open(args.image_file, 'rb') as f:
+            frame.frame_data_jpeg = f.read()
+    else:
+        frame.frame_data_jpeg = get_turbojpeg().encode(synthetic_frame(3840, 2160), 90)
+
+    width, height, _, _ = get_turbojpeg().decode_header(frame.frame_data_jpeg)
+    print(f'Decoding {width}x{height} JPEG ({len(frame.frame_data_jpeg) / 1024:.0f} KiB), {args.iterations} iterations each')
+    print(f'{"target width": >12} | {"full + resize": >13} | {"scaled": >9} | speedup')
+
+    for target_width in args.target_widths:
+        full_ms = measure(decode_full_and_resize, frame, target_width, args.iterations)
+        scaled_ms = measure(decode_scaled, frame, target_width, args.iterations)
+        print(f'{target_width: >12} | {full_ms: >10.2f} ms | {scaled_ms: >6.2f} ms | {full_ms / scaled_ms: >6.1f}x')
@@ -1,17 +1,34 @@
 import argparse
+import asyncio
+import bisect
 import signal
 import sys
 import threading
+import time
+from collections import deque
+from concurrent.futures import Executor
 from datetime import timedelta
 from enum import Enum
-from typing import List
+from functools import cache
+from typing import (Any, AsyncIterator, Callable, Deque, Dict, Iterator, List,
+                    NamedTuple, Optional, Tuple)
 
+import cv2
+import numpy as np
+import pybase64
+import redis
+import redis.asyncio
 import tempora
 from simple_term_menu import TerminalMenu
+from turbojpeg import TurboJPEG
 from visionapi.analytics_pb2 import DetectionCountMessage
 from visionapi.common_pb2 import MessageType, TypeMessage
-from visionapi.sae_pb2 import SaeMessage
+from visionapi.sae_pb2 import SaeMessage, VideoFrame
 from visionlib.pipeline.formats import is_sae_message
+from visionlib.pipeline.tools import get_raw_frame_data
+
+from dumpfile import ProcessedMessage
+from protowire import read_varint_field
 
 
 class InternalMessageType(str, Enum):
@@ -20,19 +37,112 @@ class InternalMessageType(str, Enum):
     POSITION = 'POSITION'
     SAE_EVENT = 'SAE_EVENT'
 
+_TYPE_FIELD = TypeMessage.DESCRIPTOR.fields_by_name['type'].number
+_MESSAGE_TYPES = {
+    MessageType.SAE: InternalMessageType.SAE,
+    MessageType.DETECTION_COUNT: InternalMessageType.DETECTION_COUNT,
+    MessageType.POSITION: InternalMessageType.POSITION,
+    MessageType.SAE_EVENT: InternalMessageType.SAE_EVENT,
+}
+
+# Message types of streams without type field (determined by the legacy heuristics), by stream key
+_legacy_stream_types: Dict[str, InternalMessageType] = {}
+
+STREAM_INFO_CACHE_S = 2
+
+# XINFO STREAM also returns the first and last entry of the stream (i.e. potentially several MB of frame data), the script only returns the ids
+_STREAM_INFO_SCRIPT = """
+local info = redis.call('XINFO', 'STREAM', KEYS[1])
+local length, first_id, last_id = 0, '', ''
+for i = 1, #info, 2 do
+    local value = info[i + 1]
+    if info[i] == 'length' then
+        length = value
+    elseif info[i] == 'first-entry' and type(value) == 'table' then
+        first_id = value[1]
+    elseif info[i] == 'last-entry' and type(value) == 'table' then
+        last_id = value[1]
+    end
+end
+return {length, first_id, last_id}
+"""
+
+# Like _STREAM_INFO_SCRIPT, only returns the id of the newest message ever added to the stream (the stream must exist)
+_LAST_GENERATED_ID_SCRIPT = """
+local info = redis.call('XINFO', 'STREAM', KEYS[1])
+for i = 1, #info, 2 do
+    if info[i] == 'last-generated-id' then
+        return info[i + 1]
+    end
+end
+return '0-0'
+"""
+
+class StreamInfo(NamedTuple):
+    key: str
+    length: int
+    last_entry_age_s: Optional[float]
+    # Approximate rate over the entries currently in the stream
+    rate: Optional[float]
+
+_stream_info_cache: Dict[Tuple, Tuple[float, List[StreamInfo]]] = {}
+
+def list_streams(redis_client: redis.Redis, match: Optional[str] = None) -> List[StreamInfo]:
+    """
+    Returns all streams (optionally matching the given pattern) with their length, the age of their newest entry and approximate message rate, sorted by key.
+    All stream infos are fetched in a single pipeline and cached for a few seconds.
+    """
+    connection_kwargs = redis_client.connection_pool.connection_kwargs
+    cache_key = (connection_kwargs.get('host'), connection_kwargs.get('port'), connection_kwargs.get('db'), match)
+    cached = _stream_info_cache.get(cache_key)
+    if cached is not None and time.monotonic() - cached[0] < STREAM_INFO_CACHE_S:
+        return cached[1]
+
+    stream_keys = sorted({key.decode('utf-8') for key in redis_client.scan_iter(match=match, count=1000, _type='STREAM')})
+    get_stream_info = redis_client.register_script(_STREAM_INFO_SCRIPT)
+    pipeline = redis_client.pipeline(transaction=False)
+    pipeline.time()
+    for stream_key in stream_keys:
+        get_stream_info(keys=[stream_key], client=pipeline)
+    server_time, *infos = pipeline.execute(raise_on_error=False)
+    now_ms = server_time[0] * 1000 + server_time[1] // 1000
+
+    streams = []
+    for stream_key, info in zip(stream_keys, infos):
+        if isinstance(info, Exception):
+            # The stream has been deleted in the meantime
+            continue
+        length, first_id, last_id = info
+        last_entry_age_s = (now_ms - message_id_ms(last_id)) / 1000 if last_id else None
+        time_span_ms = message_id_ms(last_id) - message_id_ms(first_id) if last_id else 0
+        rate = (length - 1) / time_span_ms * 1000 if time_span_ms > 0 else None
+        streams.append(StreamInfo(stream_key, length, last_entry_age_s, rate))
+
+    _stream_info_cache[cache_key] = (time.monotonic(), streams)
+    return streams
+
+def _format_stream_info(info: StreamInfo, key_width: int) -> str:
+    age = f'{info.last_entry_age_s:.1f}s ago' if info.last_entry_age_s is not None else '-'
+    rate = f'{info.rate:.1f} msg/s' if info.rate is not None else '-'
+    return f'{info.key: <{key_width}}  {info.length: >6} entries  last {age: >10}  {rate: >12}'
+
+def _stream_menu_entries(streams: List[StreamInfo]) -> List[str]:
+    key_width = max((len(info.key) for info in streams), default=0)
+    return [_format_stream_info(info, key_width) for info in streams]
+
 def choose_stream(redis_client) -> str:
-    available_streams = sorted(map(lambda b: b.decode('utf-8'), redis_client.scan(_type='STREAM', count=100)[1]))
-    menu = TerminalMenu(available_streams, title='Choose Redis stream to attach to:', show_search_hint=True)
+    available_streams = list_streams(redis_client)
+    menu = TerminalMenu(_stream_menu_entries(available_streams), title='Choose Redis stream to attach to:', show_search_hint=True)
     selected_idx = menu.show()
     if selected_idx is None:
         print('No stream chosen. Exiting.', file=sys.stderr)
         exit(0)
-    return available_streams[selected_idx]
+    return available_streams[selected_idx].key
 
 def choose_streams(redis_client) -> str:
-    available_streams = sorted(map(lambda b: b.decode('utf-8'), redis_client.scan(_type='STREAM', count=100)[1]))
+    available_streams = list_streams(redis_client)
     menu = TerminalMenu(
-        available_streams, 
+        _stream_menu_entries(available_streams), 
         title='Choose Redis streams to attach to:', 
         show_search_hint=True,
         multi_select=True,
@@ -44,7 +154,7 @@ def choose_streams(redis_client) -> str:
     if selected_idx_list is None:
         print('No stream chosen. Exiting.', file=sys.stderr)
         exit(0)
-    return [available_streams[idx] for idx in selected_idx_list]
+    return [available_streams[idx].key for idx in selected_idx_list]
 
 def choose_stream_from_list(stream_list: List[str]) -> str:
     sorted_streams = sorted(stream_list)
@@ -65,6 +175,30 @@ def _parse_duration(value: str) -> timedelta:
     except Exception as e:
         raise argparse.ArgumentTypeError(f"Invalid duration '{value}': {e}")
 
+def _parse_size(value: str) -> int:
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    value = value.strip().upper().removesuffix('B')
+    try:
+        if value[-1:] in units:
+            return int(float(value[:-1]) * units[value[-1]])
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid size '{value}' (expected e.g. 500M or 2G)")
+
+def _parse_dump_offset(value: str) -> timedelta:
+    # A leading minus sign denotes an offset from the end of the dump (tempora ignores the sign)
+    if value.strip().startswith('-'):
+        return -_parse_duration(value.strip()[1:])
+    return _parse_duration(value)
+
+def add_dump_selection_args(arg_parser: argparse.ArgumentParser):
+    arg_parser.register('type', 'dump_offset', _parse_dump_offset)
+    arg_parser.add_argument('--from', dest='from_offset', type='dump_offset', metavar='OFFSET',
+                            help='Start at OFFSET after the dump start (e.g. "10m") or before the dump end (e.g. "--from=-5m")')
+    arg_parser.add_argument('--to', dest='to_offset', type='dump_offset', metavar='OFFSET',
+                            help='Stop at OFFSET after the dump start (e.g. "1h") or before the dump end (e.g. "--to=-1m")')
+    arg_parser.add_argument('-s', '--streams', type=str, nargs='+', metavar='STREAM', help='Only read messages from the given streams')
+
 def default_arg_parser():
     arg_parser = argparse.ArgumentParser(add_help=False, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     arg_parser.add_argument('--help', action='help', help='Show help message and exit')
@@ -74,6 +208,7 @@ def default_arg_parser():
                             help='Start reading at the stream head, i.e. the oldest element, instead of attaching to the end')
 
     arg_parser.register('type', 'natural_timedelta', _parse_duration)
+    arg_parser.register('type', 'size', _parse_size)
     return arg_parser
 
 def register_stop_handler():
@@ -89,6 +224,343 @@ def register_stop_handler():
 
     return stop_event
 
+def init_worker():
+    # Workers are shut down by the main process, so they must not react to Ctrl-C themselves
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def register_async_stop_handler(stop: Callable[[], None]):
+    """Calls stop on SIGINT / SIGTERM from within the running event loop (instead of interrupting whatever is running)."""
+    loop = asyncio.get_running_loop()
+
+    def sig_handler(signum):
+        print(f'Caught signal {signal.Signals(signum).name} ({signum}). Exiting...', file=sys.stderr)
+        stop()
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, sig_handler, signum)
+
+class RedisGroupConsumer:
+    """
+    Reads streams in batches as a member of a consumer group. Messages stay pending in the group until they are acknowledged,
+    so a restarted consumer (with the same group and consumer name) first receives the messages it had not acknowledged before.
+    """
+    def __init__(self, host: str, port: int, stream_keys: List[str], group: str, consumer: str, batch_size: int = 100, block: int = 200,
+                 start_at_head: bool = False):
+        self._redis = redis.Redis(host, port)
+        self._stream_keys = stream_keys
+        self._group = group
+        self._consumer = consumer
+        self._batch_size = batch_size
+        self._block = block
+        self._start_at_head = start_at_head
+        self._last_ids: Dict[str, bytes] = {}
+        self._get_last_generated_id = self._redis.register_script(_LAST_GENERATED_ID_SCRIPT)
+        self.lost_count = 0
+
+    def __enter__(self):
+        for stream_key in self._stream_keys:
+            try:
+                self._redis.xgroup_create(stream_key, self._group, id='0' if self._start_at_head else '$', mkstream=True)
+            except redis.ResponseError as e:
+                if 'BUSYGROUP' not in str(e):
+                    raise
+        return self
+
+    def __exit__(self, *_):
+        self._redis.close()
+
+    def __call__(self) -> Iterator[List[Tuple[str, bytes, bytes]]]:
+        """
+        Yields batches of (stream key, message id, proto bytes) in message id time order across all streams. Batches are empty if no message arrived in time.
+        While streams are catching up on a backlog, messages are held back until all streams have been read up to their time.
+        """
+        # Start with the history of pending messages ("0") and switch to new messages (">") once that has been read completely
+        stream_ids = {key: '0' for key in self._stream_keys}
+        # Streams that may hold older messages than the ones read so far (i.e. history not read completely or last read returned a full batch)
+        behind = set(self._stream_keys)
+        held_back: List[Tuple[int, str, bytes, bytes]] = []
+        while True:
+            result = self._redis.xreadgroup(self._group, self._consumer, stream_ids, count=self._batch_size, block=self._block)
+            messages_by_stream = {stream_key.decode('utf-8'): messages for stream_key, messages in result or []}
+            for stream_key in self._stream_keys:
+                messages = messages_by_stream.get(stream_key, [])
+                if stream_ids[stream_key] != '>' and len(messages) == 0:
+                    stream_ids[stream_key] = '>'
+                elif stream_ids[stream_key] == '>' and len(messages) < self._batch_size:
+                    behind.discard(stream_key)
+                elif stream_ids[stream_key] == '>':
+                    # A burst of new messages may not have been read completely
+                    behind.add(stream_key)
+                for message_id, fields in messages:
+                    if stream_ids[stream_key] != '>':
+                        stream_ids[stream_key] = message_id
+                    if not fields:
+                        # Pending message has been trimmed from the stream in the meantime
+                        self.lost_count += 1
+                        self._redis.xack(stream_key, self._group, message_id)
+                        continue
+                    self._last_ids[stream_key] = message_id
+                    held_back.append((message_id_ms(message_id), stream_key, message_id, pybase64.b64decode(fields[b'proto_data_b64'])))
+
+            # Messages of streams that are behind are newer than everything read so far, others only get new messages
+            read_up_to_ms = min((message_id_ms(self._last_ids[key]) if key in self._last_ids else 0 for key in behind), default=None)
+            held_back.sort(key=lambda message: message[0])
+            ready_count = len(held_back) if read_up_to_ms is None else bisect.bisect_right(held_back, read_up_to_ms, key=lambda message: message[0])
+            batch = [(stream_key, message_id, proto_data) for _, stream_key, message_id, proto_data in held_back[:ready_count]]
+            del held_back[:ready_count]
+            yield batch
+
+    def get_oldest_message_ms(self) -> Optional[int]:
+        """Returns the time of the oldest message the consumer is going to read (pending in the group or not yet delivered to it), None if there is none."""
+        pipe = self._redis.pipeline(transaction=False)
+        for stream_key in self._stream_keys:
+            pipe.xpending(stream_key, self._group)
+            pipe.xinfo_groups(stream_key)
+        results = pipe.execute()
+
+        oldest_ms = []
+        pipe = self._redis.pipeline(transaction=False)
+        for stream_key, pending, groups in zip(self._stream_keys, results[::2], results[1::2]):
+            if pending['pending'] > 0:
+                oldest_ms.append(message_id_ms(pending['min']))
+            last_delivered_id = next(group['last-delivered-id'] for group in groups if group['name'].decode('utf-8') == self._group)
+            pipe.xrange(stream_key, min=b'(' + last_delivered_id, count=1)
+        oldest_ms.extend(message_id_ms(messages[0][0]) for messages in pipe.execute() if messages)
+        return min(oldest_ms, default=None)
+
+    def ack(self, message_ids: Dict[str, List[bytes]]):
+        pipe = self._redis.pipeline(transaction=False)
+        for stream_key, ids in message_ids.items():
+            if len(ids) > 0:
+                pipe.xack(stream_key, self._group, *ids)
+        pipe.execute()
+
+    def get_lag_ms(self) -> Dict[str, int]:
+        """Returns the age of the last read message relative to the newest message for each stream (based on message ids)."""
+        pipe = self._redis.pipeline(transaction=False)
+        for stream_key in self._stream_keys:
+            self._get_last_generated_id(keys=[stream_key], client=pipe)
+        lag = {}
+        for stream_key, last_generated_id in zip(self._stream_keys, pipe.execute()):
+            head_ms = message_id_ms(last_generated_id)
+            last_read_ms = message_id_ms(self._last_ids[stream_key]) if stream_key in self._last_ids else head_ms
+            lag[stream_key] = head_ms - last_read_ms
+        return lag
+
+def message_id_ms(message_id: bytes) -> int:
+    """Returns the millisecond part of a Redis stream message id, i.e. (mostly) the time the message has been added to the stream."""
+    return int(message_id.split(b'-')[0])
+
+class RedisBatchPublisher:
+    """Publishes messages like visionlib's RedisPublisher, but sends a whole batch of messages in one round trip."""
+    def __init__(self, host: str, port: int, stream_maxlen: int = 100):
+        self._redis = redis.Redis(host, port)
+        self._stream_maxlen = stream_maxlen
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self._redis.close()
+
+    def __call__(self, messages: List[Tuple[str, bytes]]):
+        pipe = self._redis.pipeline(transaction=False)
+        for stream_key, proto_data in messages:
+            pipe.xadd(stream_key, {'proto_data_b64': pybase64.standard_b64encode(proto_data)}, maxlen=self._stream_maxlen)
+        pipe.execute()
+
+class BackpressurePolicy(str, Enum):
+    # Stop reading until the tool catches up (the backlog stays in Redis, until it is trimmed there)
+    BLOCK = 'block'
+    # Drop the oldest buffered message for every new one
+    DROP_OLDEST = 'drop-oldest'
+    # Only keep the newest message of each stream
+    LATEST_ONLY = 'latest-only'
+
+class StreamMessage(NamedTuple):
+    stream_key: str
+    # Redis message id, i.e. (mostly) the time the message has been added to the stream
+    message_id: bytes
+    read_time: float
+    # The (decoded) message
+    value: Any
+
+class _MessageBuffer:
+    """Bounded buffer between the Redis reader and the decoder, which applies the back-pressure policy if it is full."""
+    def __init__(self, policy: BackpressurePolicy, max_size: int):
+        self._policy = policy
+        self._max_size = max_size
+        self._messages: Deque[StreamMessage] = deque()
+        self._changed = asyncio.Condition()
+        self._closed = False
+        self.dropped_count = 0
+
+    def __len__(self):
+        return len(self._messages)
+
+    async def put(self, message: StreamMessage):
+        async with self._changed:
+            if self._policy == BackpressurePolicy.LATEST_ONLY:
+                previous = next((buffered for buffered in self._messages if buffered.stream_key == message.stream_key), None)
+                if previous is not None:
+                    self._messages.remove(previous)
+                    self.dropped_count += 1
+            if self._policy == BackpressurePolicy.BLOCK:
+                await self._changed.wait_for(lambda: len(self._messages) < self._max_size)
+            elif len(self._messages) >= self._max_size:
+                self._messages.popleft()
+                self.dropped_count += 1
+            self._messages.append(message)
+            self._changed.notify_all()
+
+    async def close(self, last_message: Optional[StreamMessage] = None):
+        """
+        Marks the end of the messages (get_batch returns an empty batch once all buffered messages have been taken).
+        The last message (which put may have been waiting for) is buffered regardless of the policy.
+        """
+        async with self._changed:
+            if last_message is not None:
+                self._messages.append(last_message)
+            self._closed = True
+            self._changed.notify_all()
+
+    async def get_batch(self, max_count: int) -> List[StreamMessage]:
+        async with self._changed:
+            await self._changed.wait_for(lambda: len(self._messages) > 0 or self._closed)
+            batch = [self._messages.popleft() for _ in range(min(max_count, len(self._messages)))]
+            self._changed.notify_all()
+            return batch
+
+def _decode_batch(decode: Optional[Callable[[str, bytes], Any]], messages: List[Tuple[str, bytes]]) -> List[Any]:
+    protos = [(stream_key, pybase64.b64decode(proto_data_b64)) for stream_key, proto_data_b64 in messages]
+    if decode is None:
+        return [proto_data for _, proto_data in protos]
+    return [decode(stream_key, proto_data) for stream_key, proto_data in protos]
+
+class AsyncRedisConsumer:
+    """
+    Reads streams with asyncio and hands the messages to the tool in the order they were read, decoded by the given function.
+    Reading (with one XREAD for all streams), decoding (in batches in an executor) and the tool's own work run concurrently.
+    The number of buffered messages is bounded, what happens if the tool falls behind is determined by the back-pressure policy.
+
+    Usage:
+        async with AsyncRedisConsumer(...) as consumer:
+            async for message in consumer:
+                ...
+    """
+    def __init__(self, host: str, port: int, stream_keys: List[str], decode: Optional[Callable[[str, bytes], Any]] = None,
+                 executor: Optional[Executor] = None, policy: BackpressurePolicy = BackpressurePolicy.BLOCK, max_pending: int = 64,
+                 max_decoding: int = 2, decode_batch_size: int = 16, read_batch_size: int = 100, block: int = 200, start_at_head: bool = False):
+        """
+        Args:
+            decode: Is called with stream key and proto bytes of each message, its result is the value of the yielded StreamMessage.
+                Must be picklable if the executor is a process pool. If None, the proto bytes are yielded.
+            executor: Runs decode (None is the default thread pool of the event loop).
+            max_pending: Maximum number of messages buffered for decoding.
+            max_decoding: Maximum number of batches being decoded concurrently or waiting to be consumed.
+        """
+        self._redis = redis.asyncio.Redis(host, port)
+        self._stream_ids = {stream_key: '0' if start_at_head else '$' for stream_key in stream_keys}
+        self._decode = decode
+        self._executor = executor
+        self._buffer = _MessageBuffer(policy, max_pending)
+        # Batches with the future of their decoded values, (None, None) marks the end after stop(drain=True)
+        self._decoded: asyncio.Queue[Tuple[Optional[List[StreamMessage]], Optional[asyncio.Future]]] = asyncio.Queue(max_decoding)
+        self._decode_batch_size = decode_batch_size
+        self._read_batch_size = read_batch_size
+        self._block = block
+        self._tasks: List[asyncio.Task] = []
+        self._stopped: Optional[asyncio.Event] = None
+        self._error: Optional[BaseException] = None
+        self.read_count = 0
+
+    @property
+    def dropped_count(self) -> int:
+        return self._buffer.dropped_count
+
+    @property
+    def pending_count(self) -> int:
+        return len(self._buffer) + self._decoded.qsize()
+
+    async def __aenter__(self):
+        self._stopped = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._read()), asyncio.create_task(self._decode_messages())]
+        for task in self._tasks:
+            task.add_done_callback(self._on_task_done)
+        return self
+
+    async def __aexit__(self, *_):
+        self.stop()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self._redis.aclose()
+
+    def stop(self, drain: bool = False):
+        """
+        Stops reading, iterating the consumer ends after the current message or, if drain is set, after all messages that have been read already.
+        Must be called from within the event loop.
+        """
+        if drain:
+            # The reader marks the end of the messages when it is cancelled
+            self._tasks[0].cancel()
+            return
+        self._stopped.set()
+        for task in self._tasks:
+            task.cancel()
+
+    def _on_task_done(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            self._error = task.exception()
+            self.stop()
+
+    async def _read(self):
+        message = None
+        try:
+            while True:
+                result = await self._redis.xread(self._stream_ids, count=self._read_batch_size, block=self._block)
+                read_time = time.time()
+                for stream_key, messages in result or []:
+                    stream_key = stream_key.decode('utf-8')
+                    for message_id, fields in messages:
+                        self._stream_ids[stream_key] = message_id
+                        self.read_count += 1
+                        message = StreamMessage(stream_key, message_id, read_time, fields[b'proto_data_b64'])
+                        await self._buffer.put(message)
+                        message = None
+        except asyncio.CancelledError:
+            await self._buffer.close(message)
+            raise
+
+    async def _decode_messages(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._buffer.get_batch(self._decode_batch_size)
+            if len(batch) == 0:
+                await self._decoded.put((None, None))
+                return
+            messages = [(message.stream_key, message.value) for message in batch]
+            await self._decoded.put((batch, loop.run_in_executor(self._executor, _decode_batch, self._decode, messages)))
+
+    async def __aiter__(self) -> AsyncIterator[StreamMessage]:
+        stopped = asyncio.ensure_future(self._stopped.wait())
+        try:
+            while not self._stopped.is_set():
+                next_batch = asyncio.ensure_future(self._decoded.get())
+                await asyncio.wait([next_batch, stopped], return_when=asyncio.FIRST_COMPLETED)
+                if not next_batch.done():
+                    next_batch.cancel()
+                    break
+                batch, values = next_batch.result()
+                if batch is None:
+                    break
+                for message, value in zip(batch, await values):
+                    if self._stopped.is_set():
+                        break
+                    yield message._replace(value=value)
+        finally:
+            stopped.cancel()
+        if self._error is not None:
+            raise self._error
+
 def check_legacy_sae_message(message_bytes: bytes) -> bool:
     msg = SaeMessage()
     msg.ParseFromString(message_bytes)
@@ -103,13 +575,16 @@ def check_legacy_detection_count_message(message_bytes: bytes) -> bool:
         msg.timestamp_utc_ms != 0,
     ))
 
-def determine_message_type(message_bytes: bytes) -> InternalMessageType:
+def determine_message_type(message_bytes: bytes, stream_key: Optional[str] = None) -> InternalMessageType:
     """
     Determines the type of a protobuf message based on its type field. 
-    If the type field is not set or set to an unknown value, try to use heuristics to find message type.
+    If the type field is not set, try to use heuristics to find message type.
+    The type field is read directly from the serialized message, i.e. without parsing it. As the heuristics need to parse the message,
+    their result is cached per stream key (if given) and only re-evaluated when messages on the stream start carrying a type field.
 
     Args:
         message_bytes (bytes): The serialized protobuf message.
+        stream_key (Optional[str]): The stream the message was read from (enables caching for messages without type field).
 
     Returns:
         MessageType: The contained message type.
@@ -118,27 +593,116 @@ def determine_message_type(message_bytes: bytes) -> InternalMessageType:
         ValueError: If the message type cannot be determined.
     """
 
-    # First try parsing the version field
-    msg = TypeMessage()
-    msg.ParseFromString(message_bytes)
-    if msg.type == MessageType.SAE:
-        return InternalMessageType.SAE
-    elif msg.type == MessageType.DETECTION_COUNT:
-        return InternalMessageType.DETECTION_COUNT
-    elif msg.type == MessageType.POSITION:
-        return InternalMessageType.POSITION
-    elif msg.type == MessageType.SAE_EVENT:
-        return InternalMessageType.SAE_EVENT
-    elif msg.type == MessageType.UNSPECIFIED:
-        # Try legacy heuristics
-        try:
-            if check_legacy_sae_message(message_bytes):
-                return InternalMessageType.SAE
-            elif check_legacy_detection_count_message(message_bytes):
-                return InternalMessageType.DETECTION_COUNT
-            else:
-                raise ValueError('Unknown message type. Could not determine message type.')
-        except Exception as e:
-            raise ValueError('Unknown message type. Exception while parsing message', e)
-    else:
-        raise ValueError('Unsupported message type (type={msg.type})')
+    type_value = read_varint_field(message_bytes, _TYPE_FIELD)
+    if type_value is not None and type_value != MessageType.UNSPECIFIED:
+        if type_value not in _MESSAGE_TYPES:
+            raise ValueError(f'Unsupported message type (type={type_value})')
+        _legacy_stream_types.pop(stream_key, None)
+        return _MESSAGE_TYPES[type_value]
+
+    if stream_key is not None and stream_key in _legacy_stream_types:
+        return _legacy_stream_types[stream_key]
+
+    message_type = _determine_legacy_message_type(message_bytes)
+    if stream_key is not None:
+        _legacy_stream_types[stream_key] = message_type
+    return message_type
+
+def _determine_legacy_message_type(message_bytes: bytes) -> InternalMessageType:
+    try:
+        if check_legacy_sae_message(message_bytes):
+            return InternalMessageType.SAE
+        elif check_legacy_detection_count_message(message_bytes):
+            return InternalMessageType.DETECTION_COUNT
+        else:
+            raise ValueError('Unknown message type. Could not determine message type.')
+    except Exception as e:
+        raise ValueError('Unknown message type. Exception while parsing message', e)
+
+
+@cache
+def get_turbojpeg() -> TurboJPEG:
+    # Instantiate lazily, so that tools not decoding any frames do not need libturbojpeg
+    return TurboJPEG()
+
+def choose_jpeg_scaling_factor(width: int, target_width: int) -> Tuple[int, int]:
+    """Returns the smallest libjpeg-turbo DCT scaling factor (1/8, 1/4, 1/2 or 1) that still yields at least target_width."""
+    for denominator in (8, 4, 2):
+        if -(-width // denominator) >= target_width:
+            return (1, denominator)
+    return (1, 1)
+
+def decode_jpeg_scaled(jpeg_bytes: bytes, target_width: int = 0, scale_factor: float = 0) -> np.ndarray:
+    """
+    Decodes a JPEG image directly at a reduced size, i.e. lets libjpeg-turbo skip most of the work by scaling
+    in the DCT domain and only resizes the remainder. Either target_width or scale_factor must be given.
+
+    Args:
+        jpeg_bytes (bytes): The JPEG encoded image.
+        target_width (int): The width of the returned image in px (preserving aspect ratio).
+        scale_factor (float): The size of the returned image relative to the original size.
+
+    Returns:
+        np.ndarray: The decoded BGR image.
+    """
+    jpeg = get_turbojpeg()
+    width, _, _, _ = jpeg.decode_header(jpeg_bytes)
+
+    if target_width <= 0:
+        target_width = round(width * scale_factor)
+
+    image = jpeg.decode(jpeg_bytes, scaling_factor=choose_jpeg_scaling_factor(width, target_width))
+
+    if image.shape[1] != target_width:
+        resize_factor = target_width / image.shape[1]
+        image = cv2.resize(image, None, fx=resize_factor, fy=resize_factor, interpolation=cv2.INTER_AREA)
+
+    return image
+
+def get_scaled_frame_data(frame: VideoFrame, target_width: int = 0, scale_factor: float = 0) -> Optional[np.ndarray]:
+    """Same as get_raw_frame_data(), but returns the frame at a reduced size (see decode_jpeg_scaled())."""
+    if len(frame.frame_data_jpeg) > 0:
+        return decode_jpeg_scaled(frame.frame_data_jpeg, target_width, scale_factor)
+
+    image = get_raw_frame_data(frame)
+    if image is None:
+        return None
+
+    if target_width > 0:
+        scale_factor = target_width / image.shape[1]
+    return cv2.resize(image, None, fx=scale_factor, fy=scale_factor, interpolation=cv2.INTER_AREA)
+
+def process_message(proto_data: bytes, is_remove_frame=False, scale_width=0, scale_quality=85, is_split_frame=False,
+                    stream_key: Optional[str] = None) -> ProcessedMessage:
+    if determine_message_type(proto_data, stream_key) == InternalMessageType.SAE:
+        return process_sae_message(proto_data, is_remove_frame, scale_width, scale_quality, is_split_frame)
+    return proto_data
+
+def process_sae_message(proto_data: bytes, is_remove_frame=False, scale_width=0, scale_quality=85, is_split_frame=False) -> ProcessedMessage:
+    msg = SaeMessage()
+    msg.ParseFromString(proto_data)
+
+    if is_remove_frame:
+        remove_frame(msg)
+
+    if scale_width > 0:
+        resize_frame(msg, scale_width, scale_quality)
+
+    if is_split_frame and len(msg.frame.frame_data_jpeg) > 0:
+        frame_jpeg = msg.frame.frame_data_jpeg
+        msg.frame.ClearField('frame_data_jpeg')
+        return msg.SerializeToString(), frame_jpeg
+
+    return msg.SerializeToString()
+
+def remove_frame(msg: SaeMessage):
+    msg.frame.ClearField('frame_data')
+    msg.frame.ClearField('frame_data_jpeg')
+
+def resize_frame(msg: SaeMessage, scale_width=0, quality=85):
+    frame = get_scaled_frame_data(msg.frame, target_width=scale_width)
+
+    if frame is None:
+        return
+
+    msg.frame.frame_data_jpeg = get_turbojpeg().encode(frame, quality)
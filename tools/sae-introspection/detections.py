@@ -0,0 +1,187 @@
+import os
+import sys
+from datetime import timedelta
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from visionapi.sae_pb2 import SaeMessage, VideoFrame
+
+from common import InternalMessageType, determine_message_type
+from dumpfile import (DumpReader, DumpRecord, detections_path, list_segments,
+                      open_dump, resolve_offset)
+from protowire import WireType, decode_varint, iter_fields
+
+# Detection sidecar (<dumpfile>.det.npz) contents (NumPy npz archive):
+#   detections: one row of DETECTION_DTYPE per detection, in dump order
+#   stream_keys / object_ids: values referenced by the stream and object columns (object ids hex encoded, -1 if not set)
+#   dump_size / dump_mtime_ns: size and modification time of the dump the sidecar has been extracted from
+#   start_time: start time of the dump (from its metadata)
+DETECTIONS_VERSION = 1
+DETECTION_DTYPE = np.dtype([
+    ('record_time', '<f8'), ('stream', '<u2'), ('frame_timestamp_ms', '<i8'), ('object', '<i4'), ('class_id', '<i4'), ('confidence', '<f4'),
+    ('min_x', '<f4'), ('min_y', '<f4'), ('max_x', '<f4'), ('max_y', '<f4'),
+])
+
+_SAE_FRAME_FIELD = SaeMessage.DESCRIPTOR.fields_by_name['frame'].number
+_FRAME_TIMESTAMP_FIELD = VideoFrame.DESCRIPTOR.fields_by_name['timestamp_utc_ms'].number
+
+
+class DetectionTable:
+    """All detections of a dump as columns (see DETECTION_DTYPE), e.g. for plotting or analysis without reading the dump again."""
+    def __init__(self, start_time: float, stream_keys: List[str], object_ids: np.ndarray, detections: np.ndarray):
+        self.start_time = start_time
+        self.stream_keys = stream_keys
+        self.object_ids = object_ids
+        self.detections = detections
+
+    def __len__(self):
+        return len(self.detections)
+
+    @property
+    def end_time(self) -> Optional[float]:
+        return float(self.detections['record_time'].max()) if len(self.detections) > 0 else None
+
+    def select(self, from_offset: Optional[timedelta] = None, to_offset: Optional[timedelta] = None, stream_keys: Optional[List[str]] = None) -> np.ndarray:
+        """Selects the detections like DumpReader.iter_slice() selects records (offsets relative to the dump start, negative ones to the last record)."""
+        mask = np.ones(len(self.detections), dtype=bool)
+        start_time = resolve_offset(self.start_time, self.end_time, from_offset)
+        end_time = resolve_offset(self.start_time, self.end_time, to_offset)
+        if start_time is not None:
+            mask &= self.detections['record_time'] >= start_time
+        if end_time is not None:
+            mask &= self.detections['record_time'] < end_time
+        if stream_keys is not None:
+            stream_idx = [idx for idx, key in enumerate(self.stream_keys) if key in stream_keys]
+            mask &= np.isin(self.detections['stream'], stream_idx)
+        return self.detections[mask]
+
+    def write(self, path: Path, dump_stat: os.stat_result):
+        tmp_path = path.with_name(path.name + '.tmp')
+        with open(tmp_path, 'wb') as file:
+            np.savez(file, version=DETECTIONS_VERSION, detections=self.detections, stream_keys=np.array(self.stream_keys, dtype=str),
+                     object_ids=self.object_ids, dump_size=dump_stat.st_size, dump_mtime_ns=dump_stat.st_mtime_ns, start_time=self.start_time)
+        tmp_path.replace(path)
+
+    @staticmethod
+    def concatenate(tables: List['DetectionTable']) -> 'DetectionTable':
+        """Joins the tables of consecutive dumps (e.g. segments), remapping streams and objects."""
+        stream_keys: List[str] = []
+        object_idx: Dict[str, int] = {}
+        parts = []
+        for table in tables:
+            for key in table.stream_keys:
+                if key not in stream_keys:
+                    stream_keys.append(key)
+            stream_map = np.array([stream_keys.index(key) for key in table.stream_keys] or [0], dtype=np.uint16)
+            object_map = np.array([object_idx.setdefault(object_id, len(object_idx)) for object_id in table.object_ids] + [-1], dtype=np.int32)
+            part = table.detections.copy()
+            part['stream'] = stream_map[part['stream']]
+            # Objects without id (-1) are mapped to the last entry, i.e. stay -1
+            part['object'] = object_map[part['object']]
+            parts.append(part)
+        return DetectionTable(
+            min((table.start_time for table in tables), default=0),
+            stream_keys,
+            np.array(list(object_idx), dtype=str),
+            np.concatenate(parts) if parts else np.empty(0, dtype=DETECTION_DTYPE),
+        )
+
+
+def load_detections(dump_path: Path) -> Optional[DetectionTable]:
+    """Loads the detection sidecar of a dump file. Returns None if there is none or the dump has changed since it has been extracted."""
+    det_path = detections_path(dump_path)
+    if not det_path.exists():
+        return None
+
+    stat = Path(dump_path).stat()
+    try:
+        with np.load(det_path, allow_pickle=False) as sidecar:
+            if int(sidecar['version']) != DETECTIONS_VERSION or int(sidecar['dump_size']) != stat.st_size or int(sidecar['dump_mtime_ns']) != stat.st_mtime_ns:
+                return None
+            return DetectionTable(float(sidecar['start_time']), sidecar['stream_keys'].tolist(), sidecar['object_ids'], sidecar['detections'])
+    except (OSError, ValueError, KeyError) as e:
+        print(f'Could not read detection file {det_path} ({e})', file=sys.stderr)
+        return None
+
+def extract_detections(dump_path: Path) -> DetectionTable:
+    """Reads all detections of a dump file of either format in one pass and (over)writes its detection sidecar."""
+    # The dump may still be written to while reading it, the sidecar is only up-to-date with what existed at the start
+    dump_stat = Path(dump_path).stat()
+    with DumpReader(dump_path) as dump:
+        table = _collect_detections(dump, dump.meta.start_time, dump.meta.recorded_streams)
+
+    try:
+        table.write(detections_path(dump_path), dump_stat)
+    except OSError as e:
+        print(f'Could not write detection file {detections_path(dump_path)} ({e})', file=sys.stderr)
+    return table
+
+def get_detections(path: Path) -> DetectionTable:
+    """Returns the detections of a dump file or a directory of segments, from the sidecar(s) if up-to-date or extracted (and stored) otherwise."""
+    dump_files = _list_dump_files(path)
+    tables = []
+    for dump_file in dump_files:
+        table = load_detections(dump_file)
+        if table is None:
+            print(f'No up-to-date detections found for {dump_file}. Extracting {detections_path(dump_file)}...', file=sys.stderr)
+            table = extract_detections(dump_file)
+        tables.append(table)
+    return tables[0] if len(tables) == 1 else DetectionTable.concatenate(tables)
+
+def select_detections(path: Path, from_offset: Optional[timedelta] = None, to_offset: Optional[timedelta] = None,
+                      stream_keys: Optional[List[str]] = None) -> DetectionTable:
+    """
+    Returns a table of only the selected detections of a dump file or a directory of segments (see DetectionTable.select()).
+    The sidecar(s) are used if all of them are up-to-date. Otherwise only the selected records are read (using the index to
+    seek to them) and no sidecar is written, as that would mean reading the whole dump (see extract_detections.py).
+    """
+    tables = [load_detections(dump_file) for dump_file in _list_dump_files(path)]
+    if all(table is not None for table in tables):
+        table = tables[0] if len(tables) == 1 else DetectionTable.concatenate(tables)
+        return DetectionTable(table.start_time, table.stream_keys, table.object_ids, table.select(from_offset, to_offset, stream_keys))
+
+    print(f'No up-to-date detections found for {path}, reading the selected records (extract_detections.py speeds up repeated reads)', file=sys.stderr)
+    with open_dump(path) as dump:
+        return _collect_detections(dump.iter_slice(from_offset, to_offset, stream_keys), dump.meta.start_time, dump.meta.recorded_streams)
+
+def _list_dump_files(path: Path) -> List[Path]:
+    return list_segments(path) if Path(path).is_dir() else [Path(path)]
+
+def _collect_detections(records: Iterable[DumpRecord], start_time: float, recorded_streams: List[str]) -> DetectionTable:
+    rows = []
+    object_idx: Dict[bytes, int] = {}
+    stream_keys = list(recorded_streams)
+    stream_idx = {key: idx for idx, key in enumerate(stream_keys)}
+    for record in records:
+        if determine_message_type(record.proto_bytes, record.source_stream) != InternalMessageType.SAE:
+            continue
+        frame_timestamp, sae_msg = _parse_without_frame(record.proto_bytes)
+        if record.source_stream not in stream_idx:
+            stream_idx[record.source_stream] = len(stream_keys)
+            stream_keys.append(record.source_stream)
+        stream = stream_idx[record.source_stream]
+        for det in sae_msg.detections:
+            obj = object_idx.setdefault(det.object_id, len(object_idx)) if len(det.object_id) > 0 else -1
+            bbox = det.bounding_box
+            rows.append((record.record_time, stream, frame_timestamp, obj, det.class_id, det.confidence, bbox.min_x, bbox.min_y, bbox.max_x, bbox.max_y))
+
+    return DetectionTable(start_time, stream_keys, np.array([object_id.hex() for object_id in object_idx], dtype=str),
+                          np.array(rows, dtype=DETECTION_DTYPE))
+
+def _parse_without_frame(proto_bytes: bytes) -> Tuple[int, SaeMessage]:
+    """Returns the frame timestamp and the SaeMessage without its frame (parsing the frame data would copy it for nothing)."""
+    view = memoryview(proto_bytes)
+    frame_timestamp = 0
+    parts = []
+    for field in iter_fields(proto_bytes):
+        if field.number != _SAE_FRAME_FIELD:
+            parts.append(view[field.start:field.end])
+            continue
+        # Frames of records with deduplicated frames are split into two occurrences, only one contains the timestamp
+        for frame_field in iter_fields(proto_bytes, field.value_start, field.end):
+            if frame_field.number == _FRAME_TIMESTAMP_FIELD and frame_field.wire_type == WireType.VARINT:
+                frame_timestamp, _ = decode_varint(proto_bytes, frame_field.value_start)
+    sae_msg = SaeMessage()
+    sae_msg.ParseFromString(b''.join(parts))
+    return frame_timestamp, sae_msg
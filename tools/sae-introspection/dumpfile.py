@@ -0,0 +1,790 @@
+import hashlib
+import io
+import json
+import os
+import struct
+import sys
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from enum import Enum, IntEnum
+from pathlib import Path
+from typing import (BinaryIO, Iterable, Iterator, List, NamedTuple, Optional,
+                    Tuple, Union)
+
+import numpy as np
+import pybase64
+import zstandard
+from visionapi.sae_pb2 import SaeMessage, VideoFrame
+from visionlib.saedump import MESSAGE_SEPARATOR, DumpMeta, Event, EventMeta
+
+from protowire import encode_len_field
+
+# Binary saedump (v2) layout:
+#   V2_MAGIC | u32 header length | DumpMeta JSON
+#   followed by records of: u8 kind | f64 record_time | u16 stream index | u32 payload length | payload
+# The stream index refers to the position in DumpMeta.recorded_streams.
+# Deduplicated frames are stored once as FRAME_BLOB records (payload: frame digest | JPEG bytes) and referenced by
+# MESSAGE_FRAME_REF records (payload: u64 byte offset of the blob | message without frame_data_jpeg).
+V2_MAGIC = b'SAEDUMP\x02'
+_HEADER_LENGTH = struct.Struct('<I')
+_RECORD_HEADER = struct.Struct('<BdHI')
+_FRAME_REF = struct.Struct('<Q')
+_FRAME_DIGEST_SIZE = 16
+
+# Writers re-emit a frame if it is evicted from this LRU cache, so that readers only need the same cache to resolve
+# all references while decoding a dump sequentially (i.e. without seeking, which compressed dumps do not support)
+FRAME_CACHE_BYTES = 128 * 1024 * 1024
+
+_SAE_FRAME_FIELD = SaeMessage.DESCRIPTOR.fields_by_name['frame'].number
+_FRAME_JPEG_FIELD = VideoFrame.DESCRIPTOR.fields_by_name['frame_data_jpeg'].number
+
+_V1_SEPARATOR = MESSAGE_SEPARATOR.encode('utf-8')
+_V1_READ_CHUNK_SIZE = 1024 * 1024
+_V1_SEEK_CHUNK_SIZE = 64 * 1024
+
+# Index sidecar (<dumpfile>.idx) layout:
+#   INDEX_MAGIC | u32 header length | JSON object: {"stream_keys": [...], "dump_size": size of the dump when indexed (null if written while recording)}
+#   followed by one entry per record: f64 record_time | u16 stream index | u64 byte offset in the dump file
+INDEX_MAGIC = b'SAEIDX\x00\x02'
+INDEX_SUFFIX = '.idx'
+INDEX_DTYPE = np.dtype([('record_time', '<f8'), ('stream', '<u2'), ('offset', '<u8')])
+_INDEX_ENTRY = struct.Struct('<dHQ')
+
+# Columnar detection sidecar (<dumpfile>.det.npz), see detections.py
+DETECTIONS_SUFFIX = '.det.npz'
+
+# Either the message or the message without its JPEG frame plus the frame (to be deduplicated by the dump writer)
+ProcessedMessage = Union[bytes, Tuple[bytes, bytes]]
+
+# Segmented recordings are directories of v2 dumps named <sequence number>_<start time>.saedump[.zst]
+SEGMENT_SUFFIX = '.saedump'
+ZSTD_SUFFIX = '.zst'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+ZSTD_DICT_FILENAME = 'zstd.dict'
+ZSTD_FLUSH_INTERVAL_S = 5
+_ZSTD_READ_BUFFER_SIZE = 1024 * 1024
+
+
+class DumpFormat(str, Enum):
+    V1 = 'v1'
+    V2 = 'v2'
+
+class RecordKind(IntEnum):
+    MESSAGE = 0
+    FRAME_BLOB = 1
+    MESSAGE_FRAME_REF = 2
+
+_MESSAGE_KINDS = (RecordKind.MESSAGE, RecordKind.MESSAGE_FRAME_REF)
+
+class DumpRecord(NamedTuple):
+    record_time: float
+    source_stream: str
+    proto_bytes: bytes
+
+
+class DumpWriter:
+    def __init__(self, file: BinaryIO, start_time: float, stream_keys: List[str], format: DumpFormat = DumpFormat.V2):
+        self._file = file
+        self._format = format
+        self._stream_idx = {key: idx for idx, key in enumerate(stream_keys)}
+        self._frame_cache = _FrameCache()
+        # Offsets refer to the uncompressed data, so they cannot be taken from compressing file objects
+        self._position = 0
+
+        meta_json = DumpMeta(start_time=start_time, recorded_streams=stream_keys).model_dump_json().encode('utf-8')
+        if format == DumpFormat.V2:
+            if len(stream_keys) > 0xFFFF:
+                raise ValueError(f'Too many streams for saedump v2 ({len(stream_keys)})')
+            self._write(V2_MAGIC, _HEADER_LENGTH.pack(len(meta_json)), meta_json)
+        else:
+            self._write(meta_json, _V1_SEPARATOR)
+
+    def write(self, stream_key: str, proto_bytes: bytes, record_time: Optional[float] = None, frame_jpeg: Optional[bytes] = None) -> int:
+        """
+        Appends one message to the dump. If the JPEG frame of a SaeMessage is split off and passed as frame_jpeg,
+        identical frames are only stored once (v2 only, readers transparently put the frame back into the message).
+
+        Returns:
+            int: The byte offset the message record was written at.
+        """
+        if record_time is None:
+            record_time = time.time()
+
+        if self._format == DumpFormat.V2:
+            stream_idx = self._stream_idx.get(stream_key)
+            if stream_idx is None:
+                raise ValueError(f'Stream {stream_key} is not part of the recorded streams')
+
+            if frame_jpeg is None:
+                offset = self._position
+                self._write_record(RecordKind.MESSAGE, record_time, stream_idx, proto_bytes)
+                return offset
+
+            digest = hashlib.blake2b(frame_jpeg, digest_size=_FRAME_DIGEST_SIZE).digest()
+            blob_offset = self._frame_cache.get(digest)
+            if blob_offset is None:
+                blob_offset = self._position
+                self._write_record(RecordKind.FRAME_BLOB, record_time, stream_idx, digest, frame_jpeg)
+                self._frame_cache.put(digest, blob_offset, len(frame_jpeg))
+
+            offset = self._position
+            self._write_record(RecordKind.MESSAGE_FRAME_REF, record_time, stream_idx, _FRAME_REF.pack(blob_offset), proto_bytes)
+        else:
+            offset = self._position
+            if frame_jpeg is not None:
+                proto_bytes = _attach_frame(proto_bytes, frame_jpeg)
+            event = Event(
+                meta=EventMeta(
+                    record_time=record_time,
+                    source_stream=stream_key
+                ),
+                data_b64=pybase64.standard_b64encode(proto_bytes)
+            )
+            self._write(event.model_dump_json().encode('utf-8'), _V1_SEPARATOR)
+
+        return offset
+
+    def flush(self):
+        self._file.flush()
+
+    def _write_record(self, kind: RecordKind, record_time: float, stream_idx: int, *payload: bytes):
+        self._write(_RECORD_HEADER.pack(kind, record_time, stream_idx, sum(len(part) for part in payload)), *payload)
+
+    def _write(self, *parts: bytes):
+        for part in parts:
+            self._file.write(part)
+            self._position += len(part)
+
+
+class _FrameCache:
+    """LRU cache of frames (by digest on the writing side, by blob offset on the reading side) limited to FRAME_CACHE_BYTES"""
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._size = 0
+
+    def get(self, key):
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+        return value[0] if value is not None else None
+
+    def put(self, key, value, size: int):
+        self._entries[key] = (value, size)
+        self._size += size
+        while self._size > FRAME_CACHE_BYTES and len(self._entries) > 1:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self._size -= evicted_size
+
+
+class DumpFileWriter:
+    """
+    Writes a complete dump file. Uncompressed dumps get an index sidecar, compressed ones are written as a zstd stream
+    that is flushed every few seconds, so that an interrupted recording loses at most the last few seconds.
+    """
+    def __init__(self, path: Path, start_time: float, stream_keys: List[str], format: DumpFormat = DumpFormat.V2,
+                 compression_level: Optional[int] = None, zstd_dict: Optional[bytes] = None):
+        self.path = Path(path)
+        self._file = open(self.path, 'xb')
+        self._index_file = None
+        self._index_writer = None
+        self._is_compressed = compression_level is not None
+        self._last_flush_time = time.monotonic()
+
+        if self._is_compressed:
+            if format != DumpFormat.V2:
+                raise ValueError('Only saedump v2 files can be compressed')
+            if zstd_dict is not None:
+                _store_zstd_dict(self.path.parent, zstd_dict)
+            compressor = zstandard.ZstdCompressor(level=compression_level, dict_data=zstandard.ZstdCompressionDict(zstd_dict) if zstd_dict is not None else None)
+            self._out = compressor.stream_writer(self._file, closefd=False)
+        else:
+            self._out = self._file
+            self._index_file = open(index_path(self.path), 'xb')
+            self._index_writer = IndexWriter(self._index_file, stream_keys)
+
+        self._dump_writer = DumpWriter(self._out, start_time, stream_keys, format)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    @property
+    def size(self) -> int:
+        """Number of bytes written to disk so far"""
+        return self._file.tell()
+
+    def write(self, stream_key: str, proto_bytes: bytes, record_time: float, frame_jpeg: Optional[bytes] = None):
+        offset = self._dump_writer.write(stream_key, proto_bytes, record_time, frame_jpeg)
+
+        if self._index_writer is not None:
+            self._index_writer.add(record_time, stream_key, offset)
+
+        # Record times are not necessarily the current time (e.g. when a backlog is recorded), so the flush interval is based on the clock
+        if self._is_compressed and time.monotonic() - self._last_flush_time > ZSTD_FLUSH_INTERVAL_S:
+            self._out.flush(zstandard.FLUSH_BLOCK)
+            self._last_flush_time = time.monotonic()
+
+    def flush(self):
+        """Makes everything written so far durable (i.e. it survives a crash of the recording process or host)"""
+        if self._is_compressed:
+            self._out.flush(zstandard.FLUSH_BLOCK)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        if self._index_writer is not None:
+            self._index_writer.flush()
+
+    def close(self):
+        if self._is_compressed:
+            self._out.close()
+        self._file.close()
+        if self._index_file is not None:
+            self._index_file.close()
+
+class SegmentedDumpWriter:
+    """
+    Writes a recording as a directory of segments (each one a complete v2 dump), starting a new segment whenever
+    the current one exceeds the configured size or duration. Old segments are deleted according to the retention settings.
+    """
+    def __init__(self, directory: Path, stream_keys: List[str], max_segment_bytes: int = 0, max_segment_duration: Optional[timedelta] = None,
+                 keep_segments: int = 0, max_total_bytes: int = 0, compression_level: Optional[int] = None, zstd_dict: Optional[bytes] = None):
+        self.directory = Path(directory)
+        self._stream_keys = stream_keys
+        self._max_segment_bytes = max_segment_bytes
+        self._max_segment_duration_s = max_segment_duration.total_seconds() if max_segment_duration else 0
+        self._keep_segments = keep_segments
+        self._max_total_bytes = max_total_bytes
+        self._compression_level = compression_level
+        self._zstd_dict = zstd_dict
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        existing_segments = list_segments(self.directory)
+        self._next_seq = _segment_seq(existing_segments[-1]) + 1 if len(existing_segments) > 0 else 0
+        self._segment: Optional[DumpFileWriter] = None
+        self._segment_start_time = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def write(self, stream_key: str, proto_bytes: bytes, record_time: float, frame_jpeg: Optional[bytes] = None):
+        if self._segment is None or self._is_segment_full(record_time):
+            self._rotate(record_time)
+        self._segment.write(stream_key, proto_bytes, record_time, frame_jpeg)
+
+    def flush(self):
+        if self._segment is not None:
+            self._segment.flush()
+
+    def close(self):
+        if self._segment is not None:
+            # Messages are acknowledged after flush(), which only covers the current segment
+            self._segment.flush()
+            self._segment.close()
+            self._segment = None
+
+    def _is_segment_full(self, record_time: float) -> bool:
+        if self._max_segment_bytes > 0 and self._segment.size >= self._max_segment_bytes:
+            return True
+        if self._max_segment_duration_s > 0 and record_time - self._segment_start_time >= self._max_segment_duration_s:
+            return True
+        return False
+
+    def _rotate(self, record_time: float):
+        self.close()
+
+        suffix = SEGMENT_SUFFIX + ZSTD_SUFFIX if self._compression_level is not None else SEGMENT_SUFFIX
+        segment_path = self.directory / f'{self._next_seq:06d}_{time.strftime("%Y-%m-%dT%H-%M-%S", time.localtime(record_time))}{suffix}'
+        self._segment = DumpFileWriter(segment_path, record_time, self._stream_keys, DumpFormat.V2, self._compression_level, self._zstd_dict)
+        self._segment_start_time = record_time
+        self._next_seq += 1
+
+        self._apply_retention()
+
+    def _apply_retention(self):
+        # The segment that has just been started is never deleted
+        old_segments = list_segments(self.directory)[:-1]
+        segment_sizes = [segment.stat().st_size for segment in old_segments]
+
+        while len(old_segments) > 0 and (
+            (self._keep_segments > 0 and len(old_segments) + 1 > self._keep_segments) or
+            (self._max_total_bytes > 0 and sum(segment_sizes) > self._max_total_bytes)
+        ):
+            segment = old_segments.pop(0)
+            segment_sizes.pop(0)
+            print(f'Deleting old segment {segment}', file=sys.stderr)
+            segment.unlink(missing_ok=True)
+            index_path(segment).unlink(missing_ok=True)
+            detections_path(segment).unlink(missing_ok=True)
+
+
+def write_message(dump_writer: Union[DumpFileWriter, SegmentedDumpWriter], stream_key: str, message: ProcessedMessage, record_time: float):
+    if isinstance(message, tuple):
+        proto_data, frame_jpeg = message
+        dump_writer.write(stream_key, proto_data, record_time, frame_jpeg)
+    else:
+        dump_writer.write(stream_key, message, record_time)
+
+
+class DumpReader:
+    """
+    Streaming reader for saedump files. Detects the format (legacy JSON/base64 v1 or binary v2) and zstd compression on open.
+    Every iteration starts over at the first record.
+    """
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        with open(self.path, 'rb') as file:
+            self.is_compressed = file.read(len(ZSTD_MAGIC)) == ZSTD_MAGIC
+
+        self._frame_cache = _FrameCache()
+        self._file = self._open()
+        try:
+            self._read_header()
+        except Exception:
+            self._file.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def __iter__(self) -> Iterator[DumpRecord]:
+        for _, record in self.iter_with_offsets():
+            yield record
+
+    @property
+    def end_time(self) -> Optional[float]:
+        """Record time of the last record"""
+        if not self.is_compressed:
+            return get_index(self.path).end_time
+        return max((record.record_time for record in self), default=None)
+
+    def iter_with_offsets(self) -> Iterator[Tuple[int, DumpRecord]]:
+        self._rewind()
+        if self.format == DumpFormat.V2:
+            yield from self._iter_v2()
+        else:
+            for offset, message in _split_v1(self._file):
+                yield offset, _parse_v1_event(message)
+
+    def iter_slice(self, from_offset: Optional[timedelta] = None, to_offset: Optional[timedelta] = None,
+                   stream_keys: Optional[List[str]] = None) -> Iterator[DumpRecord]:
+        """
+        Iterates over the records of a dump within a time range and / or a subset of streams. Uses the index sidecar
+        (building it if necessary) to seek directly to the selected records instead of scanning the whole file.
+        Offsets are relative to the dump start time, negative offsets are relative to the last record.
+        """
+        if from_offset is None and to_offset is None and stream_keys is None:
+            yield from self
+            return
+
+        start_time, end_time = _resolve_range(self, from_offset, to_offset)
+        yield from self.iter_range(start_time, end_time, stream_keys)
+
+    def iter_range(self, start_time: Optional[float], end_time: Optional[float], stream_keys: Optional[List[str]]) -> Iterator[DumpRecord]:
+        """Iterates over the records within [start_time, end_time) belonging to one of the given streams."""
+        index = None
+        if not self.is_compressed:
+            # Selecting streams only needs a single pass anyway, so building the index first would not pay off
+            index = load_index(self.path) if start_time is None and end_time is None else get_index(self.path)
+
+        if index is not None:
+            yield from self.read_at(index.select(start_time, end_time, stream_keys))
+            return
+
+        for record in self:
+            if _is_selected(record, start_time, end_time, stream_keys):
+                yield record
+
+    def read_at(self, offsets: Iterable[int]) -> Iterator[DumpRecord]:
+        """Reads the records starting at the given byte offsets (e.g. taken from a DumpIndex). Not possible for compressed dumps."""
+        for offset in offsets:
+            self._file.seek(int(offset))
+            if self.format == DumpFormat.V2:
+                kind, record, _ = self._read_v2_record(int(offset))
+                if kind is None:
+                    return
+                if kind in _MESSAGE_KINDS:
+                    yield record
+            else:
+                yield _parse_v1_event(_read_v1_message(self._file))
+
+    def end_of_record(self, offset: Optional[int]) -> int:
+        """Returns the byte offset right after the record at the given offset (or after the header if offset is None)."""
+        if offset is None:
+            return self.data_offset
+        self._file.seek(offset)
+        if self.format == DumpFormat.V2:
+            header = self._file.read(_RECORD_HEADER.size)
+            if len(header) < _RECORD_HEADER.size:
+                return offset
+            return offset + _RECORD_HEADER.size + _RECORD_HEADER.unpack(header)[3]
+        else:
+            return offset + len(_read_v1_message(self._file)) + len(_V1_SEPARATOR)
+
+    def _open(self) -> BinaryIO:
+        file = open(self.path, 'rb')
+        if not self.is_compressed:
+            return file
+        decompressor = zstandard.ZstdDecompressor(dict_data=_load_zstd_dict(self.path.parent))
+        return io.BufferedReader(decompressor.stream_reader(file, read_across_frames=True, closefd=True), _ZSTD_READ_BUFFER_SIZE)
+
+    def _read_header(self):
+        if self._file.read(len(V2_MAGIC)) == V2_MAGIC:
+            self.format = DumpFormat.V2
+            header_length, = _HEADER_LENGTH.unpack(self._file.read(_HEADER_LENGTH.size))
+            self.meta = DumpMeta.model_validate_json(self._file.read(header_length))
+            self.data_offset = len(V2_MAGIC) + _HEADER_LENGTH.size + header_length
+        elif self.is_compressed:
+            raise ValueError(f'{self.path} is not a saedump v2 file (only v2 dumps can be compressed)')
+        else:
+            self.format = DumpFormat.V1
+            self._file.seek(0)
+            meta_json = next(_split_v1(self._file), (0, b''))[1]
+            self.meta = DumpMeta.model_validate_json(meta_json)
+            self.data_offset = len(meta_json) + len(_V1_SEPARATOR)
+
+    def _rewind(self):
+        if self.is_compressed:
+            # Decompressing streams cannot seek backwards
+            self._file.close()
+            self._file = self._open()
+            self._file.read(self.data_offset)
+        else:
+            self._file.seek(self.data_offset)
+        self._frame_cache = _FrameCache()
+
+    def _iter_v2(self) -> Iterator[Tuple[int, DumpRecord]]:
+        offset = self.data_offset
+        while True:
+            kind, record, length = self._read_v2_record(offset)
+            if kind is None:
+                return
+            if kind in _MESSAGE_KINDS:
+                yield offset, record
+            offset += length
+
+    def _read_v2_record(self, offset: int) -> Tuple[Optional[RecordKind], Optional[DumpRecord], int]:
+        header = self._file.read(_RECORD_HEADER.size)
+        if len(header) == 0:
+            return None, None, 0
+        if len(header) < _RECORD_HEADER.size:
+            _warn_truncated(self.path, offset)
+            return None, None, 0
+        kind, record_time, stream_idx, length = _RECORD_HEADER.unpack(header)
+        payload = self._file.read(length)
+        if len(payload) < length:
+            _warn_truncated(self.path, offset)
+            return None, None, 0
+
+        if kind == RecordKind.FRAME_BLOB:
+            frame_jpeg = payload[_FRAME_DIGEST_SIZE:]
+            self._frame_cache.put(offset, frame_jpeg, len(frame_jpeg))
+            return kind, None, _RECORD_HEADER.size + length
+        if kind == RecordKind.MESSAGE_FRAME_REF:
+            blob_offset, = _FRAME_REF.unpack_from(payload)
+            payload = _attach_frame(payload[_FRAME_REF.size:], self._load_frame(blob_offset))
+
+        return kind, DumpRecord(record_time, self.meta.recorded_streams[stream_idx], payload), _RECORD_HEADER.size + length
+
+    def _load_frame(self, blob_offset: int) -> bytes:
+        frame_jpeg = self._frame_cache.get(blob_offset)
+        if frame_jpeg is not None:
+            return frame_jpeg
+        if self.is_compressed:
+            raise ValueError(f'{self.path}: Referenced frame at byte {blob_offset} is not cached (dump written with a larger FRAME_CACHE_BYTES?)')
+
+        # Records read out of order (e.g. via the index) may reference frames that have not been read yet
+        position = self._file.tell()
+        self._file.seek(blob_offset)
+        kind, _, _ = self._read_v2_record(blob_offset)
+        self._file.seek(position)
+        if kind != RecordKind.FRAME_BLOB:
+            raise ValueError(f'{self.path}: No frame found at byte {blob_offset}')
+        return self._frame_cache.get(blob_offset)
+
+
+class SegmentedDumpReader:
+    """Reads a directory of segments (as written by SegmentedDumpWriter) as if it was one continuous dump."""
+    def __init__(self, directory: Path):
+        self.path = Path(directory)
+        self.segments = list_segments(self.path)
+        if len(self.segments) == 0:
+            raise ValueError(f'No dump segments found in {self.path}')
+
+        self._segment_start_times = []
+        recorded_streams = []
+        for segment in self.segments:
+            with DumpReader(segment) as reader:
+                self._segment_start_times.append(reader.meta.start_time)
+                recorded_streams.extend(key for key in reader.meta.recorded_streams if key not in recorded_streams)
+
+        self.format = DumpFormat.V2
+        self.meta = DumpMeta(start_time=self._segment_start_times[0], recorded_streams=recorded_streams)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        pass
+
+    def __iter__(self) -> Iterator[DumpRecord]:
+        for segment in self._existing_segments():
+            with DumpReader(segment) as reader:
+                yield from reader
+
+    @property
+    def end_time(self) -> Optional[float]:
+        with DumpReader(self.segments[-1]) as reader:
+            return reader.end_time
+
+    def iter_slice(self, from_offset: Optional[timedelta] = None, to_offset: Optional[timedelta] = None,
+                   stream_keys: Optional[List[str]] = None) -> Iterator[DumpRecord]:
+        """See DumpReader.iter_slice(). Segments outside of the time range are skipped entirely."""
+        start_time, end_time = _resolve_range(self, from_offset, to_offset)
+
+        segment_end_times = self._segment_start_times[1:] + [float('inf')]
+        for segment, segment_start, segment_end in zip(self.segments, self._segment_start_times, segment_end_times):
+            if end_time is not None and segment_start >= end_time:
+                break
+            if start_time is not None and segment_end <= start_time:
+                continue
+            if not segment.exists():
+                continue
+            with DumpReader(segment) as reader:
+                yield from reader.iter_range(start_time, end_time, stream_keys)
+
+    def _existing_segments(self) -> Iterator[Path]:
+        # Segments may be deleted by retention of a running recording in the meantime
+        for segment in self.segments:
+            if segment.exists():
+                yield segment
+
+
+def open_dump(path: Path) -> Union[DumpReader, SegmentedDumpReader]:
+    """Opens a dump file of either format (compressed or not), or a directory of dump segments, for reading."""
+    if Path(path).is_dir():
+        return SegmentedDumpReader(path)
+    return DumpReader(path)
+
+def list_segments(directory: Path) -> List[Path]:
+    segments = [path for path in Path(directory).iterdir() if path.name.endswith(SEGMENT_SUFFIX) or path.name.endswith(SEGMENT_SUFFIX + ZSTD_SUFFIX)]
+    return sorted(segments, key=lambda path: (_segment_seq(path), path.name))
+
+def train_zstd_dict(samples: List[bytes], dict_size: int = 112640) -> bytes:
+    return zstandard.train_dictionary(dict_size, samples).as_bytes()
+
+
+class IndexWriter:
+    """Incrementally writes the index sidecar for a dump that is being recorded."""
+    def __init__(self, file: BinaryIO, stream_keys: List[str]):
+        self._file = file
+        self._stream_idx = {key: idx for idx, key in enumerate(stream_keys)}
+        _write_index_header(file, stream_keys, None)
+
+    def add(self, record_time: float, stream_key: str, offset: int):
+        self._file.write(_INDEX_ENTRY.pack(record_time, self._stream_idx[stream_key], offset))
+
+    def flush(self):
+        self._file.flush()
+
+
+class DumpIndex:
+    def __init__(self, stream_keys: List[str], entries: np.ndarray, dump_size: Optional[int] = None):
+        self.stream_keys = stream_keys
+        self.entries = entries
+        # Size of the dump file the index has been built for (None if it has been written while recording)
+        self.dump_size = dump_size
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def start_time(self) -> Optional[float]:
+        return float(self.entries['record_time'].min()) if len(self.entries) > 0 else None
+
+    @property
+    def end_time(self) -> Optional[float]:
+        return float(self.entries['record_time'].max()) if len(self.entries) > 0 else None
+
+    def select(self, start_time: Optional[float] = None, end_time: Optional[float] = None, stream_keys: Optional[List[str]] = None) -> np.ndarray:
+        """
+        Selects all records within [start_time, end_time) belonging to one of the given streams.
+
+        Returns:
+            np.ndarray: Byte offsets of the selected records, in file order.
+        """
+        mask = np.ones(len(self.entries), dtype=bool)
+        if start_time is not None:
+            mask &= self.entries['record_time'] >= start_time
+        if end_time is not None:
+            mask &= self.entries['record_time'] < end_time
+        if stream_keys is not None:
+            stream_idx = [idx for idx, key in enumerate(self.stream_keys) if key in stream_keys]
+            mask &= np.isin(self.entries['stream'], stream_idx)
+        return np.sort(self.entries['offset'][mask])
+
+    def write(self, path: Path):
+        tmp_path = path.with_name(path.name + '.tmp')
+        with open(tmp_path, 'wb') as file:
+            _write_index_header(file, self.stream_keys, self.dump_size)
+            file.write(self.entries.tobytes())
+        os.replace(tmp_path, path)
+
+
+def index_path(dump_path: Path) -> Path:
+    dump_path = Path(dump_path)
+    return dump_path.with_name(dump_path.name + INDEX_SUFFIX)
+
+def detections_path(dump_path: Path) -> Path:
+    dump_path = Path(dump_path)
+    return dump_path.with_name(dump_path.name + DETECTIONS_SUFFIX)
+
+def load_index(dump_path: Path) -> Optional[DumpIndex]:
+    """Loads the index sidecar of a dump file. Returns None if there is none or it does not cover the whole dump."""
+    idx_path = index_path(dump_path)
+    if not idx_path.exists():
+        return None
+
+    with open(idx_path, 'rb') as file:
+        if file.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+            return None
+        header_length, = _HEADER_LENGTH.unpack(file.read(_HEADER_LENGTH.size))
+        header = json.loads(file.read(header_length))
+        entry_count = (idx_path.stat().st_size - file.tell()) // INDEX_DTYPE.itemsize
+        entries = np.fromfile(file, dtype=INDEX_DTYPE, count=entry_count)
+
+    dump_size = Path(dump_path).stat().st_size
+    if header['dump_size'] is not None:
+        # Built indexes cover the complete records of the dump as it was, which may end with an incomplete record (e.g. of a killed recording)
+        if header['dump_size'] != dump_size:
+            return None
+    else:
+        # Indexes written while recording are up-to-date if their last record is the last one of the dump
+        with DumpReader(dump_path) as dump:
+            last_offset = int(entries['offset'].max()) if len(entries) > 0 else None
+            if dump.end_of_record(last_offset) != dump_size:
+                return None
+
+    return DumpIndex(header['stream_keys'], entries, header['dump_size'])
+
+def build_index(dump_path: Path) -> DumpIndex:
+    """Scans a dump file of either format and (over)writes its index sidecar."""
+    # The dump may still be written to while scanning it, the index is only considered up-to-date with what existed at the start
+    dump_size = Path(dump_path).stat().st_size
+    with DumpReader(dump_path) as dump:
+        stream_keys = list(dump.meta.recorded_streams)
+        stream_idx = {key: idx for idx, key in enumerate(stream_keys)}
+        rows = []
+        for offset, record in dump.iter_with_offsets():
+            if record.source_stream not in stream_idx:
+                stream_idx[record.source_stream] = len(stream_keys)
+                stream_keys.append(record.source_stream)
+            rows.append((record.record_time, stream_idx[record.source_stream], offset))
+
+    index = DumpIndex(stream_keys, np.array(rows, dtype=INDEX_DTYPE), dump_size)
+    try:
+        index.write(index_path(dump_path))
+    except OSError as e:
+        print(f'Could not write index file {index_path(dump_path)} ({e})', file=sys.stderr)
+    return index
+
+def get_index(dump_path: Path) -> DumpIndex:
+    index = load_index(dump_path)
+    if index is None:
+        print(f'No up-to-date index found for {dump_path}. Building {index_path(dump_path)}...', file=sys.stderr)
+        index = build_index(dump_path)
+    return index
+
+def resolve_offset(dump_start: float, dump_end: Optional[float], offset: Optional[timedelta]) -> Optional[float]:
+    """Returns the absolute time of an offset relative to the dump start (or to the dump end if negative), None if offset is None."""
+    if offset is None:
+        return None
+    if offset < timedelta(0):
+        return (dump_end or dump_start) + offset.total_seconds()
+    return dump_start + offset.total_seconds()
+
+def _resolve_range(dump: Union[DumpReader, SegmentedDumpReader], from_offset: Optional[timedelta], to_offset: Optional[timedelta]) -> Tuple[Optional[float], Optional[float]]:
+    # The end of the dump is only determined if needed, as that might require a full pass over the dump
+    is_end_needed = any(offset is not None and offset < timedelta(0) for offset in (from_offset, to_offset))
+    dump_end = dump.end_time if is_end_needed else None
+    return resolve_offset(dump.meta.start_time, dump_end, from_offset), resolve_offset(dump.meta.start_time, dump_end, to_offset)
+
+def _is_selected(record: DumpRecord, start_time: Optional[float], end_time: Optional[float], stream_keys: Optional[List[str]]) -> bool:
+    if start_time is not None and record.record_time < start_time:
+        return False
+    if end_time is not None and record.record_time >= end_time:
+        return False
+    return stream_keys is None or record.source_stream in stream_keys
+
+def _write_index_header(file: BinaryIO, stream_keys: List[str], dump_size: Optional[int]):
+    header = json.dumps({'stream_keys': stream_keys, 'dump_size': dump_size}).encode('utf-8')
+    file.write(INDEX_MAGIC)
+    file.write(_HEADER_LENGTH.pack(len(header)))
+    file.write(header)
+
+def _read_v1_message(file: BinaryIO) -> bytes:
+    buffer = bytearray()
+    while len(chunk := file.read(_V1_SEEK_CHUNK_SIZE)) > 0:
+        search_start = max(0, len(buffer) - len(_V1_SEPARATOR) + 1)
+        buffer += chunk
+        if (end := buffer.find(_V1_SEPARATOR, search_start)) != -1:
+            return bytes(buffer[:end])
+    return bytes(buffer)
+
+def _split_v1(file: BinaryIO) -> Iterator[Tuple[int, bytes]]:
+    offset = file.tell()
+    buffer = b''
+    while True:
+        chunk = file.read(_V1_READ_CHUNK_SIZE)
+        if len(chunk) == 0:
+            break
+        buffer += chunk
+        start = 0
+        while (end := buffer.find(_V1_SEPARATOR, start)) != -1:
+            yield offset, buffer[start:end]
+            offset += end - start + len(_V1_SEPARATOR)
+            start = end + len(_V1_SEPARATOR)
+        buffer = buffer[start:]
+    if len(buffer.strip()) > 0:
+        yield offset, buffer
+
+def _attach_frame(proto_bytes: bytes, frame_jpeg: bytes) -> bytes:
+    # Protobuf merges repeated occurrences of a message field, so appending a frame containing only the JPEG data restores it
+    return proto_bytes + encode_len_field(_SAE_FRAME_FIELD, encode_len_field(_FRAME_JPEG_FIELD, frame_jpeg))
+
+def _parse_v1_event(message: bytes) -> DumpRecord:
+    event = Event.model_validate_json(message)
+    return DumpRecord(event.meta.record_time, event.meta.source_stream, pybase64.standard_b64decode(event.data_b64))
+
+def _segment_seq(path: Path) -> int:
+    try:
+        return int(path.name.split('_', 1)[0])
+    except ValueError:
+        return -1
+
+def _store_zstd_dict(directory: Path, zstd_dict: bytes):
+    dict_path = Path(directory) / ZSTD_DICT_FILENAME
+    if dict_path.exists():
+        if dict_path.read_bytes() != zstd_dict:
+            raise ValueError(f'{dict_path} already exists and contains a different dictionary')
+        return
+    dict_path.write_bytes(zstd_dict)
+
+def _load_zstd_dict(directory: Path) -> Optional[zstandard.ZstdCompressionDict]:
+    dict_path = Path(directory) / ZSTD_DICT_FILENAME
+    if not dict_path.exists():
+        return None
+    return zstandard.ZstdCompressionDict(dict_path.read_bytes())
+
+def _warn_truncated(path: Path, offset: int):
+    print(f'Dump file {path} is truncated at byte {offset}. Ignoring incomplete last record.', file=sys.stderr)
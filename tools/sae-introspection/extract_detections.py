@@ -0,0 +1,31 @@
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+from detections import extract_detections, load_detections
+from dumpfile import detections_path, list_segments
+
+if __name__ == '__main__':
+
+    arg_parser = ArgumentParser(description='Extract the detections of SAE dump files into columnar sidecar files (for plot.py and analysis)')
+    arg_parser.add_argument('dumpfiles', type=Path, nargs='+', metavar='DUMPFILE', help='Path to SAE dump file(s) or segment directories')
+    arg_parser.add_argument('-f', '--force', action='store_true', help='Extract the detections even if an up-to-date sidecar exists')
+    args = arg_parser.parse_args()
+
+    dump_files = []
+    for path in args.dumpfiles:
+        dump_files.extend(list_segments(path) if path.is_dir() else [path])
+
+    for dump_file in dump_files:
+        table = None if args.force else load_detections(dump_file)
+        if table is None:
+            start = time.time()
+            table = extract_detections(dump_file)
+            print(f'Extracted detections of {dump_file} in {time.time() - start:.2f}s')
+        else:
+            print(f'Detections of {dump_file} are up-to-date')
+
+        print(f'  {detections_path(dump_file)}: {len(table)} detections of {len(table.object_ids)} objects')
+        for stream_idx, stream_key in enumerate(table.stream_keys):
+            print(f'  {stream_key}: {np.count_nonzero(table.detections["stream"] == stream_idx)} detections')
@@ -0,0 +1,38 @@
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+from dumpfile import (ZSTD_SUFFIX, build_index, index_path, list_segments,
+                      load_index)
+
+if __name__ == '__main__':
+
+    arg_parser = ArgumentParser(description='Build the time / stream index sidecar for existing SAE dump files')
+    arg_parser.add_argument('dumpfiles', type=Path, nargs='+', metavar='DUMPFILE', help='Path to SAE dump file(s) or segment directories to index')
+    arg_parser.add_argument('-f', '--force', action='store_true', help='Rebuild the index even if an up-to-date one exists')
+    args = arg_parser.parse_args()
+
+    dump_files = []
+    for path in args.dumpfiles:
+        dump_files.extend(list_segments(path) if path.is_dir() else [path])
+
+    for dump_file in dump_files:
+        if dump_file.name.endswith(ZSTD_SUFFIX):
+            print(f'Skipping {dump_file} (compressed dumps cannot be indexed)')
+            continue
+
+        index = None if args.force else load_index(dump_file)
+        if index is None:
+            start = time.time()
+            index = build_index(dump_file)
+            print(f'Indexed {dump_file} in {time.time() - start:.2f}s')
+        else:
+            print(f'Index of {dump_file} is up-to-date')
+
+        print(f'  {index_path(dump_file)}: {len(index)} records')
+        if len(index) > 0:
+            print(f'  {time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(index.start_time))} -> '
+                  f'{time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(index.end_time))} ({index.end_time - index.start_time:.1f}s)')
+        for stream_idx, stream_key in enumerate(index.stream_keys):
+            print(f'  {stream_key}: {np.count_nonzero(index.entries["stream"] == stream_idx)} records')
@@ -1,52 +1,221 @@
-import base64
+import sys
+import threading
 import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, NamedTuple, Optional
 
-from common import choose_stream, default_arg_parser, register_stop_handler
+import pybase64
 from redis import Redis
-from visionapi.sae_pb2 import SaeMessage
+from visionapi.sae_pb2 import SaeMessage, VideoFrame
 
+from common import (default_arg_parser, message_id_ms,
+                    register_stop_handler)
+from protowire import read_varint_field_prefix
 
-def get_timestamp(sae_message_bytes):
-    decoded_message = base64.b64decode(sae_message_bytes)
+DEFAULT_PREFIXES = ['videosource', 'objectdetector', 'objecttracker', 'geomapper']
+DISCOVERY_INTERVAL_S = 10
+# Number of base64 characters of the newest and oldest message that are fetched (enough to contain the frame timestamp, but not the frame itself)
+MESSAGE_PREFIX_LENGTH = 512
+_TIMESTAMP_FIELD_PATH = (SaeMessage.DESCRIPTOR.fields_by_name['frame'].number, VideoFrame.DESCRIPTOR.fields_by_name['timestamp_utc_ms'].number)
 
-    sae_msg = SaeMessage()
-    sae_msg.ParseFromString(decoded_message)
+# Returns length, entries added (Redis >= 7, -1 otherwise), and id and beginning of the serialized message of the oldest and newest entry
+_STREAM_ENDS_SCRIPT = """
+local function message_prefix(entry)
+    local fields = entry[2]
+    for i = 1, #fields, 2 do
+        if fields[i] == 'proto_data_b64' then
+            return string.sub(fields[i + 1], 1, tonumber(ARGV[1]))
+        end
+    end
+    return ''
+end
+
+local info = redis.call('XINFO', 'STREAM', KEYS[1])
+local result = {0, -1, '', '', '', ''}
+for i = 1, #info, 2 do
+    local value = info[i + 1]
+    if info[i] == 'length' then
+        result[1] = value
+    elseif info[i] == 'entries-added' then
+        result[2] = value
+    elseif info[i] == 'first-entry' and type(value) == 'table' then
+        result[3], result[4] = value[1], message_prefix(value)
+    elseif info[i] == 'last-entry' and type(value) == 'table' then
+        result[5], result[6] = value[1], message_prefix(value)
+    end
+end
+return result
+"""
+
+METRICS = [
+    ('sae_stream_lag_seconds', 'Age of the newest message (based on its frame timestamp)', 'lag_s'),
+    ('sae_stream_backlog_seconds', 'Time span between the oldest and the newest message in the stream', 'backlog_s'),
+    ('sae_stream_length', 'Number of messages in the stream', 'length'),
+    ('sae_stream_rate', 'Messages per second added to the stream since the previous poll', 'rate'),
+    ('sae_stream_memory_bytes', 'Memory used by the stream in Redis', 'memory_bytes'),
+]
+
+
+class StreamStats(NamedTuple):
+    stream_key: str
+    length: int
+    memory_bytes: Optional[int]
+    lag_s: Optional[float]
+    backlog_s: Optional[float]
+    rate: Optional[float]
+
+
+def read_timestamp_ms(message_prefix_b64: bytes) -> Optional[int]:
+    # Only whole base64 quadruples can be decoded
+    message_prefix = pybase64.b64decode(message_prefix_b64[:len(message_prefix_b64) // 4 * 4])
+    return read_varint_field_prefix(message_prefix, _TIMESTAMP_FIELD_PATH)
+
+
+class StreamMonitor:
+    """Polls length, memory usage and the timestamps of the oldest and newest message of many streams in a single Redis round trip."""
+    def __init__(self, redis_client: Redis, stream_keys: Optional[List[str]], prefixes: List[str]):
+        self._redis = redis_client
+        self._fixed_stream_keys = stream_keys
+        self._prefixes = prefixes
+        self._stream_keys: List[str] = stream_keys or []
+        self._last_discovery_time = 0
+        self._get_stream_ends = redis_client.register_script(_STREAM_ENDS_SCRIPT)
+        # Server time and entries added (or newest message id) at the previous poll by stream
+        self._previous: Dict[str, tuple] = {}
+
+    def _discover(self):
+        if self._fixed_stream_keys is not None or time.monotonic() - self._last_discovery_time < DISCOVERY_INTERVAL_S:
+            return
+        stream_keys = set()
+        for prefix in self._prefixes:
+            stream_keys.update(key.decode('utf-8') for key in self._redis.scan_iter(match=f'{prefix}:*', count=1000, _type='STREAM'))
+        self._stream_keys = sorted(stream_keys)
+        self._last_discovery_time = time.monotonic()
+
+    def poll(self) -> List[StreamStats]:
+        self._discover()
+
+        pipeline = self._redis.pipeline(transaction=False)
+        pipeline.time()
+        for stream_key in self._stream_keys:
+            self._get_stream_ends(keys=[stream_key], args=[MESSAGE_PREFIX_LENGTH], client=pipeline)
+            pipeline.memory_usage(stream_key)
+        server_time, *results = pipeline.execute(raise_on_error=False)
+        server_time_s = server_time[0] + server_time[1] / 1e6
+        now = time.time()
+
+        stats = []
+        for idx, stream_key in enumerate(self._stream_keys):
+            ends, memory_bytes = results[2 * idx], results[2 * idx + 1]
+            if isinstance(ends, Exception):
+                # The stream has been deleted in the meantime
+                continue
+            length, entries_added, first_id, first_prefix, last_id, last_prefix = ends
+
+            first_timestamp_ms = read_timestamp_ms(first_prefix) if first_id else None
+            last_timestamp_ms = read_timestamp_ms(last_prefix) if last_id else None
+            lag_s = now - last_timestamp_ms / 1000 if last_timestamp_ms is not None else None
+            backlog_s = (last_timestamp_ms - first_timestamp_ms) / 1000 if first_timestamp_ms is not None and last_timestamp_ms is not None else None
+
+            stats.append(StreamStats(stream_key, length, memory_bytes if isinstance(memory_bytes, int) else None, lag_s, backlog_s,
+                                     self._rate(stream_key, server_time_s, entries_added, length, first_id, last_id)))
+        return stats
+
+    def _rate(self, stream_key: str, server_time_s: float, entries_added: int, length: int, first_id: bytes, last_id: bytes) -> Optional[float]:
+        if entries_added < 0:
+            # Older Redis versions do not count the added entries, so the rate is estimated from the ids of the messages in the stream
+            time_span_ms = message_id_ms(last_id) - message_id_ms(first_id) if last_id else 0
+            return (length - 1) / time_span_ms * 1000 if time_span_ms > 0 else None
+
+        previous = self._previous.get(stream_key)
+        self._previous[stream_key] = (server_time_s, entries_added)
+        if previous is None or server_time_s <= previous[0]:
+            return None
+        return (entries_added - previous[1]) / (server_time_s - previous[0])
+
+
+def format_metrics(stats: List[StreamStats]) -> str:
+    """Returns the stats in the Prometheus text exposition format."""
+    lines = []
+    for name, description, attribute in METRICS:
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} gauge')
+        for stream_stats in stats:
+            value = getattr(stream_stats, attribute)
+            if value is not None:
+                stream_key = stream_stats.stream_key.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+                lines.append(f'{name}{{stream="{stream_key}"}} {value}')
+    return '\n'.join(lines) + '\n'
+
+class MetricsServer(ThreadingHTTPServer):
+    """Serves the most recent metrics (set by the poll loop) to Prometheus."""
+    daemon_threads = True
+
+    def __init__(self, port: int):
+        super().__init__(('', port), _MetricsHandler)
+        self.metrics = ''
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.server.metrics.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *_):
+        pass
+
+
+def format_duration(seconds: Optional[float]) -> str:
+    return f'{seconds:.2f}s' if seconds is not None else '-'
+
+def print_stats(stats: List[StreamStats]):
+    key_width = max([len(stream_stats.stream_key) for stream_stats in stats] + [6])
+    if sys.stdout.isatty():
+        print('\033[2J\033[H', end='')
+    print(f'{time.strftime("%Y-%m-%d %H:%M:%S")}  {len(stats)} streams')
+    print(f'{"Stream": <{key_width}} | {"Lag": >9} | {"Backlog": >9} | {"Length": >7} | {"Rate": >8} | {"Memory": >9}')
+    for stream_stats in stats:
+        rate = f'{stream_stats.rate:.1f}/s' if stream_stats.rate is not None else '-'
+        memory = f'{stream_stats.memory_bytes / 1024 / 1024:.1f} MiB' if stream_stats.memory_bytes is not None else '-'
+        print(f'{stream_stats.stream_key: <{key_width}} | {format_duration(stream_stats.lag_s): >9} | {format_duration(stream_stats.backlog_s): >9} | '
+              f'{stream_stats.length: >7} | {rate: >8} | {memory: >9}', flush=True)
 
-    return sae_msg.frame.timestamp_utc_ms
 
 if __name__ == '__main__':
 
     arg_parser = default_arg_parser()
-    arg_parser.add_argument('-s', '--stream', type=str)
-    arg_parser.add_argument('-i', '--image-file', type=str, default=None)
+    arg_parser.add_argument('-s', '--streams', type=str, nargs='+', metavar='STREAM', help='Streams to monitor (default are all streams with one of the prefixes)')
+    arg_parser.add_argument('--prefixes', type=str, nargs='+', default=DEFAULT_PREFIXES, metavar='PREFIX', help='Monitor all streams starting with "PREFIX:"')
+    arg_parser.add_argument('-i', '--interval', type='natural_timedelta', default='1s', metavar='DURATION', help='Time between polls')
+    arg_parser.add_argument('--metrics-port', type=int, metavar='PORT', help='Expose the stream stats as Prometheus metrics on this port')
+    arg_parser.add_argument('-q', '--quiet', action='store_true', help='Do not print the stream stats (e.g. when only exposing metrics)')
     args = arg_parser.parse_args()
 
-    STREAM_KEY = args.stream
     REDIS_HOST = args.redis_host
     REDIS_PORT = args.redis_port
 
-    if STREAM_KEY is None:
-        redis_client = Redis(REDIS_HOST, REDIS_PORT)
-        STREAM_KEY = choose_stream(redis_client)
-    
     stop_event = register_stop_handler()
 
-    redis = Redis(REDIS_HOST, REDIS_PORT)
+    monitor = StreamMonitor(Redis(REDIS_HOST, REDIS_PORT), args.streams, args.prefixes)
+
+    metrics_server = None
+    if args.metrics_port is not None:
+        metrics_server = MetricsServer(args.metrics_port)
+        threading.Thread(target=metrics_server.serve_forever, name='metrics-server', daemon=True).start()
+        print(f'Serving metrics on port {args.metrics_port}', file=sys.stderr)
 
-    while True:
-        if stop_event.is_set():
-            break
+    while not stop_event.is_set():
+        stats = monitor.poll()
 
-        stream_tail = redis.xrange(STREAM_KEY, count=1)
-        stream_head = redis.xrevrange(STREAM_KEY, count=1)
-        stream_length = redis.xlen(STREAM_KEY)
+        if metrics_server is not None:
+            metrics_server.metrics = format_metrics(stats)
+        if not args.quiet:
+            print_stats(stats)
 
-        if stream_tail is not None and stream_head is not None:
-            tail_timestamp_epoch = get_timestamp(stream_tail[0][1][b"proto_data_b64"]) / 1000
-            head_timestamp_epoch = get_timestamp(stream_head[0][1][b"proto_data_b64"]) / 1000
-            tail_timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(tail_timestamp_epoch))
-            head_timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(head_timestamp_epoch))
-            now = time.time()
-            print(f'{tail_timestamp}/lag={round(now - tail_timestamp_epoch, 2)}s -> {head_timestamp}/lag={round(now - head_timestamp_epoch, 2)}s ({stream_length} messages; {round(head_timestamp_epoch - tail_timestamp_epoch, 2)} s)')
+        stop_event.wait(args.interval.total_seconds())
 
-        time.sleep(1)
\ No newline at end of file
+    if metrics_server is not None:
+        metrics_server.shutdown()
@@ -0,0 +1,205 @@
+import asyncio
+import sys
+import time
+from collections import OrderedDict, deque
+from typing import Deque, List, Optional, Tuple
+
+import numpy as np
+import redis
+from visionapi.sae_pb2 import SaeMessage, VideoFrame
+
+from common import (AsyncRedisConsumer, BackpressurePolicy, StreamMessage,
+                    default_arg_parser, message_id_ms,
+                    register_async_stop_handler)
+from protowire import WireType, decode_varint, iter_fields
+
+STAGES = ['videosource', 'objectdetector', 'objecttracker', 'geomapper']
+REPORT_INTERVAL_S = 1
+PERCENTILES = [50, 90, 99]
+# Upper bound of latency samples per stage (in addition to the time window)
+MAX_WINDOW_SAMPLES = 100_000
+
+_FRAME_FIELD = SaeMessage.DESCRIPTOR.fields_by_name['frame'].number
+_SOURCE_ID_FIELD = VideoFrame.DESCRIPTOR.fields_by_name['source_id'].number
+_TIMESTAMP_FIELD = VideoFrame.DESCRIPTOR.fields_by_name['timestamp_utc_ms'].number
+
+# Source id and frame timestamp, which identify a frame across all stages
+FrameKey = Tuple[str, int]
+
+
+def read_frame_key(stream_key: str, proto_data: bytes) -> Optional[FrameKey]:
+    """Reads source id and timestamp of the frame directly from the serialized SaeMessage (without parsing frame data or detections)."""
+    try:
+        frame = next((field for field in iter_fields(proto_data) if field.number == _FRAME_FIELD and field.wire_type == WireType.LEN), None)
+        if frame is None:
+            return None
+        source_id, timestamp = '', None
+        for field in iter_fields(proto_data, frame.value_start, frame.end):
+            if field.number == _SOURCE_ID_FIELD and field.wire_type == WireType.LEN:
+                source_id = bytes(proto_data[field.value_start:field.end]).decode('utf-8')
+            elif field.number == _TIMESTAMP_FIELD and field.wire_type == WireType.VARINT:
+                timestamp, _ = decode_varint(proto_data, field.value_start)
+    except (ValueError, UnicodeDecodeError):
+        return None
+    return (source_id, timestamp) if timestamp is not None else None
+
+
+class RollingWindow:
+    """Values observed within the last window_s seconds (at most MAX_WINDOW_SAMPLES)."""
+    def __init__(self, window_s: float):
+        self._window_s = window_s
+        self._samples: Deque[Tuple[float, float]] = deque(maxlen=MAX_WINDOW_SAMPLES)
+
+    def add(self, now: float, value: float):
+        self._samples.append((now, value))
+
+    def values(self, now: float) -> np.ndarray:
+        while self._samples and self._samples[0][0] < now - self._window_s:
+            self._samples.popleft()
+        return np.fromiter((value for _, value in self._samples), dtype=np.float64, count=len(self._samples))
+
+
+class LatencyTracer:
+    """
+    Correlates the messages of a frame on all stage streams and records the latency each stage adds (between the times the
+    message has been added to the previous and to the stage's stream) and whether the frame has been dropped by the stage.
+    The latency of the first stage is measured from the frame timestamp.
+    Frames are tracked until they reached the last stage or until match_timeout_s passed, at most max_pending at once.
+    Frames evicted because of max_pending are only counted, as it is unknown whether they would have reached the next stage.
+    """
+    def __init__(self, stages: List[str], window_s: float, match_timeout_s: float, max_pending: int):
+        self.stages = stages
+        self._match_timeout_s = match_timeout_s
+        self._max_pending = max_pending
+        # Frame key -> time first seen and time added to each stage stream in ms (insertion ordered, i.e. oldest first)
+        self._pending: OrderedDict[FrameKey, Tuple[float, List[Optional[int]]]] = OrderedDict()
+        # Recently finished frames, so that late messages (e.g. read out of order) do not start a new entry
+        self._finished: OrderedDict[FrameKey, None] = OrderedDict()
+        self.latencies = [RollingWindow(window_s) for _ in stages]
+        self.end_to_end = RollingWindow(window_s)
+        # 1 for each frame dropped by the stage, 0 for each frame passed on
+        self.drops = [RollingWindow(window_s) for _ in stages]
+        self.evicted_count = 0
+
+    @property
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    def add(self, stage_idx: int, frame_key: FrameKey, added_ms: int, now: float):
+        if frame_key in self._finished:
+            return
+        entry = self._pending.get(frame_key)
+        if entry is None:
+            entry = (now, [None] * len(self.stages))
+            self._pending[frame_key] = entry
+        entry[1][stage_idx] = added_ms
+        if stage_idx == len(self.stages) - 1:
+            self._finish(frame_key, now)
+        elif len(self._pending) > self._max_pending:
+            self.evicted_count += 1
+            self._finish(next(iter(self._pending)), now, is_evicted=True)
+
+    def expire(self, now: float):
+        while self._pending:
+            frame_key, (first_seen, _) = next(iter(self._pending.items()))
+            if first_seen > now - self._match_timeout_s:
+                break
+            self._finish(frame_key, now)
+
+    def _finish(self, frame_key: FrameKey, now: float, is_evicted: bool = False):
+        _, added = self._pending.pop(frame_key)
+        self._finished[frame_key] = None
+        if len(self._finished) > self._max_pending:
+            self._finished.popitem(last=False)
+
+        timestamp = frame_key[1]
+        if added[0] is not None:
+            self.latencies[0].add(now, added[0] - timestamp)
+        for idx in range(1, len(self.stages)):
+            if added[idx - 1] is None:
+                # The frame has not been seen on the previous stage (e.g. it has been dropped before or tracing started in between)
+                continue
+            if added[idx] is None:
+                if not is_evicted:
+                    self.drops[idx].add(now, 1)
+            else:
+                self.drops[idx].add(now, 0)
+                self.latencies[idx].add(now, added[idx] - added[idx - 1])
+        if added[0] is not None and added[-1] is not None:
+            self.end_to_end.add(now, added[-1] - timestamp)
+
+
+def format_latencies(name: str, latencies: np.ndarray, drops: Optional[np.ndarray]) -> str:
+    drop_rate = f'{drops.mean() * 100:.1f}%' if drops is not None and len(drops) > 0 else '-'
+    if len(latencies) > 0:
+        percentiles = ''.join(f'{value: >8.0f}' for value in np.percentile(latencies, PERCENTILES))
+        maximum = f'{latencies.max():.0f}'
+    else:
+        percentiles = ''.join(f'{"-": >8}' for _ in PERCENTILES)
+        maximum = '-'
+    return f'{name: <16}{len(latencies): >8}{drop_rate: >8}{percentiles}{maximum: >8}'
+
+def print_report(tracer: LatencyTracer, now: float):
+    header = ''.join(f'{f"p{percentile}": >8}' for percentile in PERCENTILES)
+    lines = [f'{time.strftime("%H:%M:%S")}  latency in ms (within window), {tracer.pending_count} frames pending, {tracer.evicted_count} evicted',
+             f'{"Stage": <16}{"Frames": >8}{"Dropped": >8}{header}{"max": >8}']
+    for idx, stage in enumerate(tracer.stages):
+        lines.append(format_latencies(stage, tracer.latencies[idx].values(now), tracer.drops[idx].values(now) if idx > 0 else None))
+    lines.append(format_latencies('end-to-end', tracer.end_to_end.values(now), None))
+    print('\n'.join(lines), flush=True)
+
+async def report_periodically(tracer: LatencyTracer):
+    # Reports are independent of incoming messages, so that a stalled pipeline shows up as well
+    while True:
+        await asyncio.sleep(REPORT_INTERVAL_S)
+        now = time.time()
+        tracer.expire(now)
+        print_report(tracer, now)
+
+async def trace(consumer: AsyncRedisConsumer, tracer: LatencyTracer, stage_by_stream: dict):
+    register_async_stop_handler(consumer.stop)
+
+    report_task = asyncio.create_task(report_periodically(tracer))
+    try:
+        async with consumer:
+            async for message in consumer:
+                message: StreamMessage
+                if message.value is not None:
+                    tracer.add(stage_by_stream[message.stream_key], message.value, message_id_ms(message.message_id), time.time())
+    finally:
+        report_task.cancel()
+
+
+if __name__ == '__main__':
+
+    arg_parser = default_arg_parser()
+    arg_parser.add_argument('stream_ids', type=str, nargs='*', metavar='STREAM_ID',
+                            help='Ids of the camera streams to trace (as in <stage>:<stream id>, default are all video source streams)')
+    arg_parser.add_argument('--stages', type=str, nargs='+', default=STAGES, metavar='STAGE', help='Stream prefixes of the stages, in pipeline order')
+    arg_parser.add_argument('-w', '--window', type='natural_timedelta', default='1m', metavar='DURATION', help='Time window for percentiles and drop rates')
+    arg_parser.add_argument('--match-timeout', type='natural_timedelta', default='5s', metavar='DURATION',
+                            help='Time after which a frame that has not reached the last stage is considered dropped')
+    arg_parser.add_argument('--max-pending', type=int, default=10_000, help='Maximum number of frames tracked at once (bounds memory usage)')
+    args = arg_parser.parse_args()
+
+    REDIS_HOST = args.redis_host
+    REDIS_PORT = args.redis_port
+
+    stream_ids = args.stream_ids
+    if len(stream_ids) == 0:
+        redis_client = redis.Redis(REDIS_HOST, REDIS_PORT)
+        prefix = f'{args.stages[0]}:'
+        stream_ids = sorted(key.decode('utf-8')[len(prefix):] for key in redis_client.scan_iter(match=f'{prefix}*', count=1000, _type='STREAM'))
+        if len(stream_ids) == 0:
+            print(f'No streams found for stage {args.stages[0]}', file=sys.stderr)
+            sys.exit(1)
+
+    stage_by_stream = {f'{stage}:{stream_id}': idx for idx, stage in enumerate(args.stages) for stream_id in stream_ids}
+    print(f'Tracing {", ".join(stream_ids)} through {" -> ".join(args.stages)}', file=sys.stderr)
+
+    tracer = LatencyTracer(args.stages, args.window.total_seconds(), args.match_timeout.total_seconds(), args.max_pending)
+    # All messages are needed for matching, so the reader blocks instead of dropping messages if the tracer falls behind
+    consumer = AsyncRedisConsumer(REDIS_HOST, REDIS_PORT, list(stage_by_stream), decode=read_frame_key, policy=BackpressurePolicy.BLOCK,
+                                  start_at_head=args.start_at_head)
+
+    asyncio.run(trace(consumer, tracer, stage_by_stream))
@@ -1,50 +1,378 @@
+import argparse
+import bisect
+import heapq
+import multiprocessing
+import operator
+import re
+import signal
+import threading
 import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, wait
 from datetime import timedelta
+from enum import Enum
+from functools import reduce
+from queue import Empty, Full, Queue
+from typing import Iterator, List, NamedTuple, Optional, Tuple, Union
 
-import pybase64
 from visionapi.analytics_pb2 import DetectionCountMessage
-from visionapi.sae_pb2 import PositionMessage, SaeMessage
-from visionlib.pipeline.publisher import RedisPublisher
-from visionlib.saedump import DumpMeta, Event, message_splitter
+from visionapi.common_pb2 import MessageType, TypeMessage
+from visionapi.sae_pb2 import PositionMessage, SaeMessage, VideoFrame
 
-from common import (InternalMessageType, default_arg_parser,
+from common import (InternalMessageType, RedisBatchPublisher,
+                    add_dump_selection_args, default_arg_parser,
                     determine_message_type, register_stop_handler)
+from dumpfile import DumpReader, DumpRecord, SegmentedDumpReader, open_dump
+from protowire import read_varint_field, replace_varint_field
 
+PREFETCH_QUEUE_SIZE = 1024
+MAX_BATCH_SIZE = 256
+_TYPE_FIELD = TypeMessage.DESCRIPTOR.fields_by_name['type'].number
+# Field number paths of the timestamp to rewrite per message type
+_TIMESTAMP_FIELD_PATHS = {
+    MessageType.SAE: (SaeMessage.DESCRIPTOR.fields_by_name['frame'].number, VideoFrame.DESCRIPTOR.fields_by_name['timestamp_utc_ms'].number),
+    MessageType.POSITION: (PositionMessage.DESCRIPTOR.fields_by_name['timestamp_utc_ms'].number,),
+    MessageType.DETECTION_COUNT: (DetectionCountMessage.DESCRIPTOR.fields_by_name['timestamp_utc_ms'].number,),
+}
+# Upper bounds of the lateness histogram buckets (the last bucket collects everything above)
+LATENESS_BUCKETS_MS = [0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
 
-def time_until_record_time(playback_start_time: float, record_start_time: float, record_target_time: float):
-    current_time = time.time()
-    playback_delta = current_time - playback_start_time
-    target_delta = record_target_time - record_start_time
-    return max(0, target_delta - playback_delta)
 
-def time_until_interval(prev_message_time: float, target_interval: timedelta):
-    current_time = time.time()
-    target_time = prev_message_time + target_interval.total_seconds()
-    sleep_time = target_time - current_time
-    return max(0, sleep_time)
+class LatePolicy(str, Enum):
+    CATCH_UP = 'catch-up'
+    DROP = 'drop'
 
-def set_frame_timestamp_to_now(proto_bytes: str):
-    msg_type = determine_message_type(proto_bytes)
+
+class Prefetcher(threading.Thread):
+    """Reads records from the dump in a background thread, so that reading and decoding never delay publishing."""
+    def __init__(self, records: Iterator[DumpRecord], stop_event: threading.Event):
+        super().__init__(name='prefetch', daemon=True)
+        self._records = records
+        self._stop_event = stop_event
+        self._queue: Queue[Optional[DumpRecord]] = Queue(PREFETCH_QUEUE_SIZE)
+        self._error: Optional[Exception] = None
+
+    def run(self):
+        try:
+            for record in self._records:
+                if not self._put(record):
+                    return
+        except Exception as e:
+            self._error = e
+        self._put(None)
+
+    def __iter__(self) -> Iterator[DumpRecord]:
+        while not self._stop_event.is_set():
+            try:
+                record = self._queue.get(timeout=0.1)
+            except Empty:
+                continue
+            if record is None:
+                break
+            yield record
+        if self._error is not None:
+            raise self._error
+
+    def _put(self, record: Optional[DumpRecord]) -> bool:
+        while not self._stop_event.is_set():
+            try:
+                self._queue.put(record, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+
+class PlaybackScheduler:
+    """
+    Determines when each message is due on the monotonic clock. Due times are always computed from the playback start
+    (instead of the previous message), so that processing delays and oversleeping do not accumulate into drift.
+    """
+    def __init__(self, speed: float = 1, fixed_interval: Optional[timedelta] = None, record_start_time: Optional[float] = None):
+        self.playback_start = time.monotonic()
+        self._speed = speed
+        self._interval_s = fixed_interval.total_seconds() if fixed_interval is not None else None
+        self.record_start_time = record_start_time
+        self._message_count = 0
+
+    def due_time(self, record_time: float) -> float:
+        if self.record_start_time is None:
+            self.record_start_time = record_time
+        if self._interval_s is not None:
+            offset = self._message_count * self._interval_s
+        else:
+            offset = record_time - self.record_start_time
+        self._message_count += 1
+        return self.playback_start + offset / self._speed
+
+
+class LatenessHistogram:
+    """Collects how late messages were published relative to their due time (in bounded memory)."""
+    def __init__(self):
+        self._counts = [0] * (len(LATENESS_BUCKETS_MS) + 1)
+        self._count = 0
+        self._sum_ms = 0.0
+        self._max_ms = 0.0
+
+    def add(self, lateness_s: float):
+        lateness_ms = max(0.0, lateness_s * 1000)
+        self._counts[bisect.bisect_left(LATENESS_BUCKETS_MS, lateness_ms)] += 1
+        self._count += 1
+        self._sum_ms += lateness_ms
+        self._max_ms = max(self._max_ms, lateness_ms)
+
+    def percentile(self, q: float) -> float:
+        """Returns the upper bound of the bucket containing the q-th percentile (or the maximum for the last bucket)"""
+        threshold = q / 100 * self._count
+        cumulative = 0
+        for bucket_idx, count in enumerate(self._counts):
+            cumulative += count
+            if cumulative >= threshold and count > 0:
+                return LATENESS_BUCKETS_MS[bucket_idx] if bucket_idx < len(LATENESS_BUCKETS_MS) else self._max_ms
+        return 0.0
+
+    def merge(self, other: 'LatenessHistogram'):
+        self._counts = [count + other_count for count, other_count in zip(self._counts, other._counts)]
+        self._count += other._count
+        self._sum_ms += other._sum_ms
+        self._max_ms = max(self._max_ms, other._max_ms)
+
+    def print(self):
+        if self._count == 0:
+            return
+        print(f'Lateness: mean {self._sum_ms / self._count:.2f}ms, p50 <= {self.percentile(50):g}ms, p90 <= {self.percentile(90):g}ms, '
+              f'p99 <= {self.percentile(99):g}ms, max {self._max_ms:.2f}ms')
+        lower_bounds = [0] + LATENESS_BUCKETS_MS
+        upper_bounds = [f'{bound:g}ms' for bound in LATENESS_BUCKETS_MS] + ['inf']
+        for lower, upper, count in zip(lower_bounds, upper_bounds, self._counts):
+            share = count / self._count
+            print(f'  {f"{lower:g}-{upper}": >14} | {count: >8} | {share * 100: >5.1f}% | {"#" * round(share * 50)}')
+
+def set_frame_timestamp_to_now(proto_bytes: bytes, stream_key: Optional[str] = None) -> bytes:
+    timestamp_ms = time.time_ns() // 1000000
+
+    # Patching the timestamp on the wire avoids parsing and re-serializing the whole message (including the frame)
+    field_path = _TIMESTAMP_FIELD_PATHS.get(read_varint_field(proto_bytes, _TYPE_FIELD))
+    if field_path is not None:
+        patched_bytes = replace_varint_field(proto_bytes, field_path, timestamp_ms)
+        if patched_bytes is not None:
+            return patched_bytes
+
+    return set_timestamp_parsed(proto_bytes, timestamp_ms, stream_key)
+
+def set_timestamp_parsed(proto_bytes: bytes, timestamp_ms: int, stream_key: Optional[str] = None) -> bytes:
+    msg_type = determine_message_type(proto_bytes, stream_key)
 
     match msg_type:
         case InternalMessageType.SAE:
             msg = SaeMessage()
             msg.ParseFromString(proto_bytes)
 
-            msg.frame.timestamp_utc_ms = time.time_ns() // 1000000
+            msg.frame.timestamp_utc_ms = timestamp_ms
             return msg.SerializeToString()
         case InternalMessageType.POSITION:
             msg = PositionMessage()
             msg.ParseFromString(proto_bytes)
 
-            msg.timestamp_utc_ms = time.time_ns() // 1000000
+            msg.timestamp_utc_ms = timestamp_ms
             return msg.SerializeToString()
         case InternalMessageType.DETECTION_COUNT:
             msg = DetectionCountMessage()
             msg.ParseFromString(proto_bytes)
 
-            msg.timestamp_utc_ms = time.time_ns() // 1000000
+            msg.timestamp_utc_ms = timestamp_ms
             return msg.SerializeToString()
+        case _:
+            return proto_bytes
+
+class ScheduledPublisher:
+    """Publishes messages at their due time. Messages due within the batch window (after the first one) are published together."""
+    def __init__(self, publish: RedisBatchPublisher, stop_event: threading.Event, batch_window_s: float, late_policy: LatePolicy,
+                 max_lateness_s: float, adjust_timestamps: bool):
+        self._publish = publish
+        self._stop_event = stop_event
+        self._batch_window_s = batch_window_s
+        self._late_policy = late_policy
+        self._max_lateness_s = max_lateness_s
+        self._adjust_timestamps = adjust_timestamps
+        self._batch: List[Tuple[str, bytes, float]] = []
+        self.histogram = LatenessHistogram()
+        self.stream_counts = Counter()
+        self.byte_count = 0
+        self.dropped_count = 0
+
+    def submit(self, stream_key: str, proto_bytes: bytes, due_time: float):
+        if len(self._batch) > 0 and (due_time - self._batch[0][2] > self._batch_window_s or len(self._batch) >= MAX_BATCH_SIZE):
+            self.flush()
+
+        if self._late_policy == LatePolicy.DROP and time.monotonic() - due_time > self._max_lateness_s:
+            self.dropped_count += 1
+            return
+
+        self._stop_event.wait(max(0, due_time - time.monotonic()))
+
+        if self._adjust_timestamps:
+            proto_bytes = set_frame_timestamp_to_now(proto_bytes, stream_key)
+
+        self._batch.append((stream_key, proto_bytes, due_time))
+        self.stream_counts[stream_key] += 1
+        self.byte_count += len(proto_bytes)
+
+    def flush(self):
+        if len(self._batch) == 0:
+            return
+        send_time = time.monotonic()
+        self._publish([(stream_key, proto_bytes) for stream_key, proto_bytes, _ in self._batch])
+        for _, _, due_time in self._batch:
+            self.histogram.add(send_time - due_time)
+        self._batch = []
+
+
+class PlaybackResult(NamedTuple):
+    stream_counts: Counter
+    stream_durations: Counter
+    source_counts: Counter
+    byte_count: int
+    dropped_count: int
+    playback_duration: float
+    record_duration: float
+    histogram: LatenessHistogram
+
+    @property
+    def message_count(self) -> int:
+        return sum(self.stream_counts.values())
+
+
+# A copy of the played back streams: index of the copy (None for the original streams) and time offset in seconds
+StreamCopy = Tuple[Optional[int], float]
+
+def target_stream(stream_template: str, source_stream: str, copy_idx: Optional[int]) -> str:
+    if copy_idx is None:
+        return source_stream
+    return stream_template.format(i=copy_idx, stream=source_stream)
+
+def play_pass(dump: Union[DumpReader, SegmentedDumpReader], args: argparse.Namespace, publish: RedisBatchPublisher,
+              stop_event: threading.Event, copies: List[StreamCopy]) -> Optional[PlaybackResult]:
+    """Plays back the selected part of the dump once into each of the given stream copies."""
+    # When starting somewhere in the middle of the dump, the first selected message is played back immediately
+    scheduler = PlaybackScheduler(args.speed, args.fixed_interval, dump.meta.start_time if args.from_offset is None else None)
+    publisher = ScheduledPublisher(publish, stop_event, args.batch_window / 1000, args.late_policy, args.max_lateness / 1000, args.adjust_timestamps)
+
+    prefetcher = Prefetcher(dump.iter_slice(args.from_offset, args.to_offset, args.streams), stop_event)
+    prefetcher.start()
+
+    # Messages of all copies ordered by due time: (due time, sequence number, stream key, proto bytes)
+    pending: List[Tuple[float, int, str, bytes]] = []
+    sequence_number = 0
+    source_counts = Counter()
+    last_record_ts = None
+
+    for record in prefetcher:
+        due_time = scheduler.due_time(record.record_time)
+        last_record_ts = record.record_time
+        source_counts[record.source_stream] += 1
+
+        for copy_idx, offset_s in copies:
+            heapq.heappush(pending, (due_time + offset_s, sequence_number, target_stream(args.stream_template, record.source_stream, copy_idx), record.proto_bytes))
+            sequence_number += 1
+
+        # Records are read in order of their due times, so no message due before the current one can be added later
+        while len(pending) > 0 and pending[0][0] <= due_time and not stop_event.is_set():
+            message_due_time, _, stream_key, proto_bytes = heapq.heappop(pending)
+            publisher.submit(stream_key, proto_bytes, message_due_time)
+
+        if stop_event.is_set():
+            break
+
+    while len(pending) > 0 and not stop_event.is_set():
+        message_due_time, _, stream_key, proto_bytes = heapq.heappop(pending)
+        publisher.submit(stream_key, proto_bytes, message_due_time)
+
+    publisher.flush()
+
+    if last_record_ts is None:
+        return None
+
+    playback_duration = time.monotonic() - scheduler.playback_start
+    return PlaybackResult(publisher.stream_counts, Counter({stream_key: playback_duration for stream_key in publisher.stream_counts}), source_counts,
+                          publisher.byte_count, publisher.dropped_count, playback_duration, last_record_ts - scheduler.record_start_time, publisher.histogram)
+
+def combine_results(results: List[PlaybackResult], is_concurrent: bool) -> PlaybackResult:
+    """Combines the results of consecutive passes, or of concurrent publishers (which each played back the whole dump into different streams)."""
+    histogram = LatenessHistogram()
+    for result in results:
+        histogram.merge(result.histogram)
+    combine_durations = max if is_concurrent else sum
+    return PlaybackResult(
+        stream_counts=reduce(operator.add, (result.stream_counts for result in results)),
+        stream_durations=reduce(operator.add, (result.stream_durations for result in results)),
+        source_counts=reduce(operator.or_ if is_concurrent else operator.add, (result.source_counts for result in results)),
+        byte_count=sum(result.byte_count for result in results),
+        dropped_count=sum(result.dropped_count for result in results),
+        playback_duration=combine_durations(result.playback_duration for result in results),
+        record_duration=combine_durations(result.record_duration for result in results),
+        histogram=histogram,
+    )
+
+def print_playback_report(result: PlaybackResult, speed: float):
+    playback_duration = max(result.playback_duration, 1e-6)
+    print(f'Played back {result.message_count} messages ({result.byte_count / 1024 / 1024:.1f} MiB) in {playback_duration:.1f}s: '
+          f'{result.message_count / playback_duration:.1f} msg/s, {result.byte_count / 1024 / 1024 / playback_duration:.2f} MiB/s, '
+          f'{result.record_duration / playback_duration:.2f}x real time{f", {result.dropped_count} late messages dropped" if result.dropped_count > 0 else ""}')
+    if speed != float('inf'):
+        result.histogram.print()
+
+def print_fan_out_report(result: PlaybackResult, speed: float, process_count: int):
+    print(f'Fan-out to {len(result.stream_counts)} streams from {process_count} publisher processes')
+    print_playback_report(result, speed)
+
+    record_duration = max(result.record_duration, 1e-6)
+    for source_stream, count in sorted(result.source_counts.items()):
+        print(f'Recorded {source_stream}: {count / record_duration:.1f} fps (target at speed {speed:g}: {count / record_duration * speed:.1f} fps)')
+
+    stream_fps = {stream_key: count / max(result.stream_durations[stream_key], 1e-6) for stream_key, count in result.stream_counts.items()}
+    if len(stream_fps) == 0:
+        return
+    slowest = min(stream_fps, key=stream_fps.get)
+    fastest = max(stream_fps, key=stream_fps.get)
+    print(f'Per-stream fps: min {stream_fps[slowest]:.1f} ({slowest}), mean {sum(stream_fps.values()) / len(stream_fps):.1f}, '
+          f'max {stream_fps[fastest]:.1f} ({fastest})')
+    for stream_key in sorted(stream_fps, key=_natural_sort_key):
+        print(f'  {stream_key}: {stream_fps[stream_key]:.1f} fps')
+
+_publisher_stop_event = None
+
+def init_publisher(stop_event: multiprocessing.Event):
+    global _publisher_stop_event
+    _publisher_stop_event = stop_event
+    # Publishers are stopped by the main process, so they must not react to Ctrl-C themselves
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def run_publisher(args: argparse.Namespace, copies: List[StreamCopy]) -> Optional[PlaybackResult]:
+    """Plays back the dump into the given stream copies (in a publisher process)"""
+    results = []
+    with RedisBatchPublisher(args.redis_host, args.redis_port, args.stream_maxlen) as publish, open_dump(args.dumpfile) as dump:
+        while not _publisher_stop_event.is_set():
+            result = play_pass(dump, args, publish, _publisher_stop_event, copies)
+            if result is not None:
+                results.append(result)
+            if not args.loop or result is None:
+                break
+    return combine_results(results, is_concurrent=False) if len(results) > 0 else None
+
+def _natural_sort_key(value: str) -> list:
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', value)]
+
+def _parse_speed(value: str) -> float:
+    if value.strip().lower() == 'max':
+        return float('inf')
+    try:
+        speed = float(value.strip().lower().removesuffix('x'))
+    except ValueError:
+        speed = 0
+    if speed <= 0:
+        raise argparse.ArgumentTypeError(f"Invalid speed '{value}' (expected e.g. 0.5, 4x or max)")
+    return speed
 
 
 if __name__ == '__main__':
@@ -54,45 +382,57 @@ if __name__ == '__main__':
     arg_parser.add_argument('-l', '--loop', action='store_true', help='Loop indefinitely (exit with Ctrl-C)')
     arg_parser.add_argument('-t', '--adjust-timestamps', action='store_true', help='Adjust message timestamps to the time in the moment of playback')
     arg_parser.add_argument('-i', '--fixed-interval', type='natural_timedelta', help='Ignore embedded timestamp and instead output messages at the given interval (natural timedelta)', metavar='INTERVAL')
+    arg_parser.add_argument('--speed', type=_parse_speed, default=1.0, help='Playback speed factor (e.g. 0.5, 4x or "max" for as fast as possible)', metavar='FACTOR')
+    arg_parser.add_argument('--batch-window', type=float, default=5, help='Publish messages that are due within this many milliseconds of each other in one round trip', metavar='MS')
+    arg_parser.add_argument('--late-policy', type=LatePolicy, choices=list(LatePolicy), default=LatePolicy.CATCH_UP,
+                            help='What to do with messages that are late: Publish them immediately (catch-up) or drop them if later than MAX_LATENESS')
+    arg_parser.add_argument('--max-lateness', type=float, default=100, help='Messages later than this many milliseconds are dropped with --late-policy drop', metavar='MS')
+    arg_parser.add_argument('--stream-maxlen', type=int, default=100, help='Maximum length of the published streams (as for all SAE components)', metavar='N')
+    arg_parser.add_argument('--fan-out', type=int, default=0, help='Load generator mode: Play back the dump into N copies of the streams (named by STREAM_TEMPLATE)', metavar='N')
+    arg_parser.add_argument('--stream-template', type=str, default='videosource:synthetic-{i}',
+                            help='Stream key of the copies in fan-out mode ({i} is the copy index, {stream} the original stream key)', metavar='TEMPLATE')
+    arg_parser.add_argument('--copy-offset', type=float, default=0, help='Delay each copy by this many milliseconds more than the previous one (spreads the load)', metavar='MS')
+    arg_parser.add_argument('--publishers', type=int, default=4, help='Number of publisher processes in fan-out mode', metavar='N')
+    add_dump_selection_args(arg_parser)
     args = arg_parser.parse_args()
 
+    if args.fan_out > 0 and '{i}' not in args.stream_template:
+        arg_parser.error('--stream-template must contain {i}')
+
     REDIS_HOST = args.redis_host
     REDIS_PORT = args.redis_port
 
     stop_event = register_stop_handler()
 
-    publish = RedisPublisher(REDIS_HOST, REDIS_PORT)
-
-    with publish, open(args.dumpfile, 'r') as input_file:
-        while not stop_event.is_set():
-            message_iter = message_splitter(input_file)
-
-            playback_start_ts = time.time()
-            prev_message_ts = 0
-            start_message = next(message_iter)
-            dump_meta = DumpMeta.model_validate_json(start_message)
-            print(f'Starting playback from file {args.dumpfile} containing streams {dump_meta.recorded_streams}')
-
-            for message in message_iter:
-                event = Event.model_validate_json(message)
-                proto_bytes = pybase64.standard_b64decode(event.data_b64)
+    if args.fan_out > 0:
+        with open_dump(args.dumpfile) as dump:
+            source_streams = args.streams if args.streams is not None else dump.meta.recorded_streams
+        if len(source_streams) > 1 and '{stream}' not in args.stream_template:
+            arg_parser.error(f'The dump contains multiple streams {source_streams}. Select one with -s or add {{stream}} to --stream-template')
 
-                if args.fixed_interval is not None:
-                    stop_event.wait(time_until_interval(prev_message_ts, args.fixed_interval))
-                else:
-                    stop_event.wait(time_until_record_time(playback_start_ts, dump_meta.start_time, event.meta.record_time))
+        copies = [(copy_idx, copy_idx * args.copy_offset / 1000) for copy_idx in range(args.fan_out)]
+        process_count = min(args.publishers, args.fan_out)
+        print(f'Starting fan-out playback from file {args.dumpfile} of streams {source_streams} into {args.fan_out} copies '
+              f'({target_stream(args.stream_template, source_streams[0], 0)} ...) from {process_count} publisher processes')
 
-                if args.adjust_timestamps:
-                    proto_bytes = set_frame_timestamp_to_now(proto_bytes)
+        publisher_stop_event = multiprocessing.Event()
+        with ProcessPoolExecutor(process_count, initializer=init_publisher, initargs=(publisher_stop_event,)) as pool:
+            futures = [pool.submit(run_publisher, args, copies[process_idx::process_count]) for process_idx in range(process_count)]
+            while len(wait(futures, timeout=0.2).not_done) > 0:
+                if stop_event.is_set():
+                    publisher_stop_event.set()
 
-                publish(event.meta.source_stream, proto_bytes)
+        results = [future.result() for future in futures if future.result() is not None]
+        if len(results) > 0:
+            print_fan_out_report(combine_results(results, is_concurrent=True), args.speed, process_count)
+    else:
+        with RedisBatchPublisher(REDIS_HOST, REDIS_PORT, args.stream_maxlen) as publish, open_dump(args.dumpfile) as dump:
+            while not stop_event.is_set():
+                print(f'Starting playback from file {args.dumpfile} ({dump.format.value}) containing streams {dump.meta.recorded_streams}')
 
-                prev_message_ts = time.time()
+                result = play_pass(dump, args, publish, stop_event, [(None, 0)])
+                if result is not None:
+                    print_playback_report(result, args.speed)
 
-                if stop_event.is_set():
+                if not args.loop:
                     break
-            
-            if not args.loop:
-                break
-            else:
-                input_file.seek(0)
@@ -1,61 +1,81 @@
+import os
+import sys
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Dict, Generator, List, Tuple
+from typing import List, Tuple
 
 import cv2
 import numpy as np
-import pybase64
-import tqdm
-from common import (InternalMessageType, choose_stream_from_list,
-                    determine_message_type, register_stop_handler)
-from palettable.colorbrewer.qualitative import Set1_9
-from visionapi.sae_pb2 import SaeMessage
-from visionlib.saedump import DumpMeta, Event, message_splitter
-
-CLS_CMAP = Set1_9.colors
-ALPHA = 0.80
+from common import (add_dump_selection_args, choose_stream_from_list,
+                    init_worker)
+from detections import DetectionTable, select_detections
+from dumpfile import open_dump
+from trajectories import TRACK_POINT_DTYPE, draw_trajectories
 
-def iter_sae_dump(file: Path) -> Generator[bytes, None, None]:
-    with open(file, 'r') as input_file:
-        message_iter = message_splitter(input_file)
-        for message in message_iter:
-            yield message
+ALPHA = 0.80
+DEFAULT_RESOLUTION = (1920, 1080)
+HEATMAP_COLORMAP = cv2.COLORMAP_INFERNO
 
 def get_contained_streams(file: Path) -> List[str]:
-    message_iter = iter_sae_dump(file)
-    first_message = next(message_iter)
-    message_iter.close()
-
-    dump_meta = DumpMeta.model_validate_json(first_message)
-    return dump_meta.recorded_streams
-
-def iter_sae_messages(dump_file: Path, stream_id: str) -> Generator[SaeMessage, None, None]:
-    event_iter = iter_sae_dump(dump_file)
-
-    # Skip the DumpMeta message
-    _ = next(event_iter)
-    
-    for json_event in event_iter:
-        event = Event.model_validate_json(json_event)
-
-        if event.meta.source_stream != stream_id:
-            continue
-
-        proto_bytes = pybase64.standard_b64decode(event.data_b64)
-        sae_msg = SaeMessage()
-        sae_msg.ParseFromString(proto_bytes)
-        
-        if (msg_type := determine_message_type(proto_bytes)) != InternalMessageType.SAE:
-            raise ValueError(f'Found message type {msg_type}, SAE messages needed')
-        
-        yield sae_msg
-        
-def draw_line(img, pt1: Tuple[float], pt2: Tuple[float], class_id: int):
-    cv2.line(img, (int(pt1[0] * img.shape[1]), int(pt1[1] * img.shape[0])), (int(pt2[0] * img.shape[1]), int(pt2[1] * img.shape[0])), color=get_color(class_id), thickness=1, lineType=cv2.LINE_AA)
-
-def get_color(class_id: int) -> Tuple[int]:
-    c = CLS_CMAP[class_id % len(CLS_CMAP)]
-    return (c[2], c[1], c[0])
+    with open_dump(file) as dump:
+        return dump.meta.recorded_streams
+
+def get_centers(detections: np.ndarray) -> np.ndarray:
+    """Returns the bounding box centers (normalized coordinates) as an (n, 2) array."""
+    return np.stack([(detections['min_x'] + detections['max_x']) / 2, (detections['min_y'] + detections['max_y']) / 2], axis=1)
+
+def to_track_points(detections: np.ndarray) -> np.ndarray:
+    """Returns the detections with an object id as points for draw_trajectories()."""
+    detections = detections[detections['object'] >= 0]
+    centers = get_centers(detections)
+    points = np.empty(len(detections), dtype=TRACK_POINT_DTYPE)
+    points['object'] = detections['object']
+    points['class_id'] = detections['class_id']
+    points['time'] = detections['record_time']
+    points['center_x'] = centers[:, 0]
+    points['center_y'] = centers[:, 1]
+    return points
+
+def draw_heatmap(img: np.ndarray, detections: np.ndarray, bin_size: int):
+    """Overlays the density of detection centers, counted in bins of bin_size x bin_size pixels (log scaled)."""
+    height, width = img.shape[:2]
+    centers = get_centers(detections)
+    density, _, _ = np.histogram2d(centers[:, 1], centers[:, 0], bins=(max(1, height // bin_size), max(1, width // bin_size)), range=((0, 1), (0, 1)))
+    if density.max() == 0:
+        return
+
+    density = np.log1p(density)
+    intensity = cv2.resize((density / density.max() * 255).astype(np.uint8), (width, height), interpolation=cv2.INTER_NEAREST)
+    heatmap = cv2.applyColorMap(intensity, HEATMAP_COLORMAP)
+    is_covered = intensity > 0
+    img[is_covered] = heatmap[is_covered]
+
+def parse_resolution(value: str) -> Tuple[int, int]:
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+
+def split_by_stream(table: DetectionTable, detections: np.ndarray, stream_ids: List[str]) -> List[np.ndarray]:
+    return [detections[detections['stream'] == table.stream_keys.index(stream_id)] if stream_id in table.stream_keys else detections[:0]
+            for stream_id in stream_ids]
+
+def get_output_file(dump_file: Path, stream_id: str, is_single_stream: bool) -> Path:
+    if is_single_stream:
+        return dump_file.parent / f'{dump_file.stem}.jpg'
+    return dump_file.parent / f'{dump_file.stem}_{stream_id.replace(":", "_")}.jpg'
+
+def render(detections: np.ndarray, image: np.ndarray, mode: str, bin_size: int) -> np.ndarray:
+    annotated_image = image.copy()
+    if mode == 'heatmap':
+        draw_heatmap(annotated_image, detections, bin_size)
+    else:
+        draw_trajectories(annotated_image, to_track_points(detections))
+    return cv2.addWeighted(annotated_image, ALPHA, image, 1 - ALPHA, 0)
+
+def plot_to_file(detections: np.ndarray, image: np.ndarray, mode: str, bin_size: int, output_file: Path) -> Path:
+    cv2.imwrite(str(output_file), render(detections, image, mode, bin_size), [cv2.IMWRITE_JPEG_QUALITY, 90])
+    return output_file
 
 
 if __name__ == '__main__':
@@ -63,47 +83,55 @@ if __name__ == '__main__':
     arg_parser = ArgumentParser()
     arg_parser.add_argument('dumpfile', type=Path, help='Path to SAE dump file to plot')
     arg_parser.add_argument('-i', '--image-file', help='Path to an image to plot trajectories on (grey background will be used if not specified)')
+    arg_parser.add_argument('-m', '--mode', choices=['trajectories', 'heatmap'], default='trajectories', help='Plot object trajectories or the density of detections')
+    arg_parser.add_argument('-r', '--resolution', type=parse_resolution, metavar='WIDTHxHEIGHT',
+                            help=f'Output resolution (default is the size of the image or {DEFAULT_RESOLUTION[0]}x{DEFAULT_RESOLUTION[1]})')
+    arg_parser.add_argument('--bin-size', type=int, default=4, metavar='PIXELS', help='Size of the heatmap bins')
+    arg_parser.add_argument('-a', '--all-streams', action='store_true',
+                            help='Plot every stream (or all selected with -s) into its own image <dumpfile>_<stream>.jpg, instead of asking for one')
+    arg_parser.add_argument('-w', '--workers', type=int, metavar='N', help='Number of worker processes for --all-streams (default is one per stream, up to the number of CPUs)')
+    add_dump_selection_args(arg_parser)
     args = arg_parser.parse_args()
 
-    stop_event = register_stop_handler()
-
-    streams = get_contained_streams(args.dumpfile)
-    if len(streams) == 1:
-        stream_id = streams[0]
-    else:
-        stream_id = choose_stream_from_list(streams)
-
     if args.image_file is not None:
         image = cv2.imread(args.image_file, cv2.IMREAD_COLOR)
+        if args.resolution is not None:
+            image = cv2.resize(image, args.resolution, interpolation=cv2.INTER_AREA)
     else:
-        image = np.ones((1080, 1920, 3), dtype=np.uint8) * 127
-
-    annotated_image = image.copy()
+        width, height = args.resolution or DEFAULT_RESOLUTION
+        image = np.ones((height, width, 3), dtype=np.uint8) * 127
 
-    output_file = args.dumpfile.parent / f'{args.dumpfile.stem}.jpg'
-
-    previous_points: Dict[bytes, Tuple[float, float]] = {}
-
-    print('Drawing trajectories from messages')
-
-    for sae_msg in tqdm.tqdm(iter_sae_messages(args.dumpfile, stream_id)):
-        if stop_event.is_set():
-            break
-
-        for det in sae_msg.detections:
-            center_x = (det.bounding_box.max_x + det.bounding_box.min_x) / 2
-            center_y = (det.bounding_box.max_y + det.bounding_box.min_y) / 2
-            new_point = (center_x, center_y)
-            obj_id = det.object_id
-
-            if obj_id in previous_points:
-                draw_line(annotated_image, pt1=previous_points[obj_id], pt2=new_point, class_id=det.class_id)
-
-            previous_points[obj_id] = new_point
-
-    
-    output_image = cv2.addWeighted(annotated_image, ALPHA, image, 1 - ALPHA, 0)
-
-    cv2.imwrite(output_file, output_image, [cv2.IMWRITE_JPEG_QUALITY, 90])
-    print(f'Output written to {output_file}')
-        
+    streams = args.streams if args.streams is not None else get_contained_streams(args.dumpfile)
+    if args.all_streams or len(streams) == 1:
+        stream_ids = streams
+    else:
+        stream_ids = [choose_stream_from_list(streams)]
+
+    # The detections are read from the sidecar file if it is up-to-date, otherwise only the selected records are read from the dump
+    table = select_detections(args.dumpfile, args.from_offset, args.to_offset, stream_ids)
+    detections = table.detections
+    stream_detections = split_by_stream(table, detections, stream_ids)
+    for stream_id, selected in zip(stream_ids, stream_detections):
+        if len(selected) == 0:
+            print(f'No detections found on stream {stream_id} (SAE messages needed)')
+
+    print(f'Drawing {args.mode} from {len(detections)} detections of {len(stream_ids)} stream(s)')
+
+    output_files = [get_output_file(args.dumpfile, stream_id, len(stream_ids) == 1) for stream_id in stream_ids]
+    workers = min(len(stream_ids), args.workers or os.cpu_count())
+    if workers <= 1:
+        for selected, output_file in zip(stream_detections, output_files):
+            print(f'Output written to {plot_to_file(selected, image, args.mode, args.bin_size, output_file)}')
+    else:
+        # Each stream is rendered in its own process, so the total time is bound by the largest stream
+        with ProcessPoolExecutor(workers, initializer=init_worker) as pool:
+            futures = [pool.submit(plot_to_file, selected, image, args.mode, args.bin_size, output_file)
+                       for selected, output_file in zip(stream_detections, output_files)]
+            try:
+                for future in futures:
+                    print(f'Output written to {future.result()}')
+            except KeyboardInterrupt:
+                # Workers ignore Ctrl-C, the streams that are being rendered are finished, all others are skipped
+                print('Interrupted, waiting for running workers...', file=sys.stderr)
+                pool.shutdown(cancel_futures=True)
+                sys.exit(1)
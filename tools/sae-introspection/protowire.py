@@ -0,0 +1,179 @@
+from enum import IntEnum
+from typing import (Iterator, List, NamedTuple, Optional, Sequence, Tuple,
+                    Union)
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+
+class WireType(IntEnum):
+    VARINT = 0
+    I64 = 1
+    LEN = 2
+    I32 = 5
+
+
+# Positions within the serialized message: start is the position of the tag, length_start the position after the tag
+# (i.e. of the length prefix for LEN fields) and value_start the position of the actual value (after the length prefix)
+class WireField(NamedTuple):
+    number: int
+    wire_type: WireType
+    start: int
+    value_start: int
+    end: int
+    length_start: int
+
+
+def encode_varint(value: int) -> bytes:
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+def encode_tag(field_number: int, wire_type: WireType) -> bytes:
+    return encode_varint(field_number << 3 | wire_type)
+
+def encode_len_field(field_number: int, payload: bytes) -> bytes:
+    return encode_tag(field_number, WireType.LEN) + encode_varint(len(payload)) + payload
+
+def decode_varint(data: Buffer, pos: int) -> Tuple[int, int]:
+    """Returns the decoded value and the position after it."""
+    value = 0
+    shift = 0
+    while True:
+        if pos >= len(data) or shift > 63:
+            raise ValueError('Truncated or invalid varint')
+        byte = data[pos]
+        value |= (byte & 0x7F) << shift
+        pos += 1
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+def iter_fields(data: Buffer, start: int = 0, end: Optional[int] = None) -> Iterator[WireField]:
+    """Iterates over the fields of a serialized message (without descending into nested messages). Raises ValueError if the data is malformed."""
+    end = len(data) if end is None else end
+    pos = start
+    while pos < end:
+        tag, length_start = decode_varint(data, pos)
+        wire_type = tag & 0x7
+        if wire_type == WireType.VARINT:
+            _, field_end = decode_varint(data, length_start)
+            value_start = length_start
+        elif wire_type == WireType.I64:
+            value_start, field_end = length_start, length_start + 8
+        elif wire_type == WireType.I32:
+            value_start, field_end = length_start, length_start + 4
+        elif wire_type == WireType.LEN:
+            length, value_start = decode_varint(data, length_start)
+            field_end = value_start + length
+        else:
+            raise ValueError(f'Unsupported wire type {wire_type}')
+        if field_end > end:
+            raise ValueError('Field exceeds message bounds')
+        yield WireField(tag >> 3, WireType(wire_type), pos, value_start, field_end, length_start)
+        pos = field_end
+
+def read_varint_field(data: Buffer, field_number: int) -> Optional[int]:
+    """Returns the value of a top-level varint field (the last occurrence, as protobuf does), or None if it is not present or the data is malformed."""
+    value = None
+    try:
+        for field in iter_fields(data):
+            if field.number == field_number and field.wire_type == WireType.VARINT:
+                value, _ = decode_varint(data, field.value_start)
+    except ValueError:
+        return None
+    return value
+
+def replace_varint_field(data: bytes, path: Sequence[int], value: int) -> Optional[bytes]:
+    """
+    Sets a (non-negative) varint field, which may be nested in message fields given by the path of field numbers, directly on the serialized message.
+    Only the field itself and the length prefixes of the enclosing messages are rewritten.
+    Fields of the path may occur repeatedly (e.g. a message field split into two occurrences, which protobuf merges). As the last value of the
+    field wins, its last occurrence is rewritten.
+
+    Returns:
+        Optional[bytes]: The modified message or None if the message does not contain the field (or is malformed).
+    """
+    try:
+        fields = _find_last_field(data, path, 0, len(data))
+    except ValueError:
+        return None
+    if fields is None:
+        return None
+
+    # Replacements are collected from the innermost field outwards, i.e. in order of descending position
+    leaf = fields[-1]
+    new_value = encode_varint(value)
+    replacements = [(leaf.value_start, leaf.end, new_value)]
+    size_delta = len(new_value) - (leaf.end - leaf.value_start)
+    for field in reversed(fields[:-1]):
+        if size_delta == 0:
+            break
+        new_length = encode_varint(field.end - field.value_start + size_delta)
+        replacements.append((field.length_start, field.value_start, new_length))
+        size_delta += len(new_length) - (field.value_start - field.length_start)
+
+    # Joining memoryview slices copies the (potentially large) unchanged parts only once
+    view = memoryview(data)
+    parts = []
+    position = 0
+    for replace_start, replace_end, replacement in reversed(replacements):
+        parts.append(view[position:replace_start])
+        parts.append(replacement)
+        position = replace_end
+    parts.append(view[position:])
+    return b''.join(parts)
+
+def _find_last_field(data: Buffer, path: Sequence[int], start: int, end: int) -> Optional[List[WireField]]:
+    """Returns the fields along the path to the last occurrence of its leaf within data[start:end], or None if there is none."""
+    matches = [field for field in iter_fields(data, start, end) if field.number == path[0]]
+    expected_type = WireType.VARINT if len(path) == 1 else WireType.LEN
+    if any(field.wire_type != expected_type for field in matches):
+        raise ValueError(f'Unexpected wire type of field {path[0]}')
+    for field in reversed(matches):
+        if len(path) == 1:
+            return [field]
+        nested_fields = _find_last_field(data, path[1:], field.value_start, field.end)
+        if nested_fields is not None:
+            return [field] + nested_fields
+    return None
+
+def read_varint_field_prefix(data: Buffer, path: Sequence[int]) -> Optional[int]:
+    """
+    Reads a (non-repeated) varint field, which may be nested in message fields given by the path of field numbers, from the beginning of
+    a serialized message. The data may be cut off anywhere after the field, so that e.g. the timestamp of a frame can be read without the frame data.
+    Returns the first occurrence of the field or None if it is not contained in the data.
+    """
+    pos, end = 0, len(data)
+    try:
+        for depth, field_number in enumerate(path):
+            is_leaf = depth == len(path) - 1
+            while True:
+                if pos >= end:
+                    return None
+                tag, pos = decode_varint(data, pos)
+                wire_type = tag & 0x7
+                if tag >> 3 == field_number:
+                    if is_leaf and wire_type == WireType.VARINT:
+                        value, _ = decode_varint(data, pos)
+                        return value
+                    if is_leaf or wire_type != WireType.LEN:
+                        return None
+                    length, pos = decode_varint(data, pos)
+                    end = min(end, pos + length)
+                    break
+                if wire_type == WireType.VARINT:
+                    _, pos = decode_varint(data, pos)
+                elif wire_type == WireType.I64:
+                    pos += 8
+                elif wire_type == WireType.I32:
+                    pos += 4
+                elif wire_type == WireType.LEN:
+                    length, pos = decode_varint(data, pos)
+                    pos += length
+                else:
+                    return None
+    except ValueError:
+        return None
@@ -1,69 +1,169 @@
+import asyncio
+import socket
+import sys
+import threading
 import time
-from typing import TextIO
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from datetime import timedelta
+from functools import partial
+from queue import Queue
+from typing import Callable, Dict, List, Optional, Tuple, Union
 
-import cv2
-import pybase64
 import redis
-from turbojpeg import TurboJPEG
-from visionapi.sae_pb2 import SaeMessage
-from visionlib.pipeline.consumer import RedisConsumer
-from visionlib.pipeline.tools import get_raw_frame_data
-from visionlib.saedump import MESSAGE_SEPARATOR, DumpMeta, Event, EventMeta
 
-from common import (InternalMessageType, choose_streams, default_arg_parser,
-                    determine_message_type, register_stop_handler)
+from common import (AsyncRedisConsumer, BackpressurePolicy,
+                    RedisGroupConsumer, choose_streams, default_arg_parser,
+                    init_worker, message_id_ms, process_message,
+                    register_async_stop_handler, register_stop_handler)
+from dumpfile import (ZSTD_SUFFIX, DumpFileWriter, DumpFormat,
+                      ProcessedMessage, SegmentedDumpWriter, write_message)
 
-jpeg = TurboJPEG()
+STATS_INTERVAL_S = 5
+MAX_QUEUED_BATCHES = 16
 
-def write_meta(file: TextIO, start_time: float, stream_keys: list[str]):
-    meta = DumpMeta(
-        start_time=start_time,
-        recorded_streams=stream_keys
-    )
-    file.write(meta.model_dump_json())
-    file.write(MESSAGE_SEPARATOR)
 
-def write_event(file: TextIO, stream_key: str, proto_data: bytes):
-    bytes_to_write = proto_data
-    
-    event = Event(
-        meta=EventMeta(
-            record_time=time.time(),
-            source_stream=stream_key
-        ),
-        data_b64=pybase64.standard_b64encode(bytes_to_write)
-    )
+class GroupBatchWriter(threading.Thread):
+    """
+    Writes batches read from a consumer group in the background. Messages are only acknowledged after they have been flushed to disk,
+    so every message that is not in the dump is still pending in the group and will be delivered again after a restart.
+    """
+    def __init__(self, dump_writer: Union[DumpFileWriter, SegmentedDumpWriter], consumer: RedisGroupConsumer,
+                 process_batch: Callable[[List[str], List[bytes]], List[ProcessedMessage]], flush_interval_s: float):
+        super().__init__(name='batch-writer')
+        self._dump_writer = dump_writer
+        self._consumer = consumer
+        self._process_batch = process_batch
+        self._flush_interval_s = flush_interval_s
+        self.queue: Queue[Optional[List[Tuple[str, bytes, float, bytes]]]] = Queue(MAX_QUEUED_BATCHES)
+        self.written_count = 0
+        self.acked_count = 0
+        self.error: Optional[Exception] = None
 
-    file.write(event.model_dump_json())
-    file.write(MESSAGE_SEPARATOR)
+    def run(self):
+        unacked: Dict[str, List[bytes]] = defaultdict(list)
+        last_flush_time = time.time()
+        try:
+            while True:
+                batch = self.queue.get()
+                if batch is not None:
+                    results = self._process_batch([stream_key for stream_key, _, _, _ in batch], [proto_data for _, _, _, proto_data in batch])
+                    for (stream_key, message_id, record_time, _), message in zip(batch, results):
+                        write_message(self._dump_writer, stream_key, message, record_time)
+                        unacked[stream_key].append(message_id)
+                    self.written_count += len(batch)
 
-def process_sae_message(proto_data: bytes, is_remove_frame=False, scale_width=0, scale_quality=85) -> bytes:
-    msg = SaeMessage()
-    msg.ParseFromString(proto_data)
+                if batch is None or time.time() - last_flush_time >= self._flush_interval_s:
+                    self._dump_writer.flush()
+                    self._consumer.ack(unacked)
+                    self.acked_count += sum(len(ids) for ids in unacked.values())
+                    unacked.clear()
+                    last_flush_time = time.time()
 
-    if is_remove_frame:
-        remove_frame(msg)
+                if batch is None:
+                    return
+        except Exception as e:
+            # Unacknowledged messages stay pending in the group, i.e. nothing is lost
+            self.error = e
+            while self.queue.get() is not None:
+                pass
 
-    if scale_width > 0:
-        resize_frame(msg, scale_width, scale_quality)
+def process_batch(stream_keys: List[str], protos: List[bytes], pool: Optional[ProcessPoolExecutor],
+                  process: Optional[Callable[..., ProcessedMessage]]) -> List[ProcessedMessage]:
+    if process is None:
+        return protos
+    if pool is None:
+        return [process(proto_data, stream_key=stream_key) for stream_key, proto_data in zip(stream_keys, protos)]
+    return list(pool.map(partial(_process_stream_message, process), stream_keys, protos, chunksize=max(1, len(protos) // 64)))
 
-    return msg.SerializeToString()
+def _process_stream_message(process: Callable[..., ProcessedMessage], stream_key: str, proto_data: bytes) -> ProcessedMessage:
+    return process(proto_data, stream_key=stream_key)
+
+def record_consumer_group(consumer: RedisGroupConsumer, writer: GroupBatchWriter, stop_event: threading.Event, time_limit: timedelta):
+    time_limit_s = time_limit.total_seconds()
+    start_time = time.time()
+    last_stats_time = start_time
+    read_count = 0
+    read_bytes = 0
+    last_stats_count = 0
+    last_stats_bytes = 0
+
+    writer.start()
+
+    for batch in consumer():
+        if stop_event.is_set() or writer.error is not None:
+            break
+
+        now = time.time()
+
+        if time_limit_s > 0 and now - start_time > time_limit_s:
+            print(f'Reached configured time limit of {time_limit}')
+            break
+
+        if now - last_stats_time > STATS_INTERVAL_S:
+            interval = now - last_stats_time
+            lag = ', '.join(f'{stream_key} {lag_ms / 1000:.1f}s' for stream_key, lag_ms in consumer.get_lag_ms().items())
+            print(f'{(read_count - last_stats_count) / interval:.1f} msg/s, {(read_bytes - last_stats_bytes) / interval / 1024 / 1024:.2f} MiB/s, '
+                  f'written {writer.written_count}, acked {writer.acked_count}, {writer.queue.qsize()} batches queued, lag: {lag}', file=sys.stderr)
+            last_stats_time = now
+            last_stats_count = read_count
+            last_stats_bytes = read_bytes
+
+        read_count += len(batch)
+        read_bytes += sum(len(proto_data) for _, _, proto_data in batch)
+
+        # Messages are recorded at the time they have been added to the stream, so that a backlog read after a restart keeps its timing.
+        # Blocks if the writer falls behind, which leaves the backlog in Redis instead of in memory
+        writer.queue.put([(stream_key, message_id, message_id_ms(message_id) / 1000, proto_data) for stream_key, message_id, proto_data in batch])
+
+    writer.queue.put(None)
+    writer.join()
+
+    if writer.error is not None:
+        print(f'Writing failed, unwritten messages remain pending in the consumer group: {writer.error!r}', file=sys.stderr)
+    print(f'Written and acknowledged {writer.acked_count} messages, {consumer.lost_count} pending messages were lost to stream trimming', file=sys.stderr)
 
-def remove_frame(msg: SaeMessage):
-    msg.frame.ClearField('frame_data')
-    msg.frame.ClearField('frame_data_jpeg')
 
-def resize_frame(msg: SaeMessage, scale_width=0, quality=85):
-    frame = get_raw_frame_data(msg.frame)
+async def record_streams(consumer: AsyncRedisConsumer, dump_writer: Union[DumpFileWriter, SegmentedDumpWriter], time_limit: timedelta):
+    # Messages that have been read already are still written when stopping
+    stop = partial(consumer.stop, drain=True)
+    register_async_stop_handler(stop)
 
-    if frame is None:
-        return
+    def stop_at_time_limit():
+        print(f'Reached configured time limit of {time_limit}')
+        stop()
 
-    original_width = frame.shape[1]
-    scale_factor = scale_width / original_width
-    frame = cv2.resize(frame, None, fx=scale_factor, fy=scale_factor, interpolation=cv2.INTER_AREA)
+    written_count = 0
+    last_stats_time = time.time()
 
-    msg.frame.frame_data_jpeg = jpeg.encode(frame, quality)
+    async with consumer:
+        if time_limit.total_seconds() > 0:
+            asyncio.get_running_loop().call_later(time_limit.total_seconds(), stop_at_time_limit)
+
+        async for message in consumer:
+            write_message(dump_writer, message.stream_key, message.value, message_id_ms(message.message_id) / 1000)
+            written_count += 1
+
+            if time.time() - last_stats_time > STATS_INTERVAL_S:
+                print(f'Written {written_count} messages, {consumer.pending_count} pending, {consumer.dropped_count} dropped', file=sys.stderr)
+                last_stats_time = time.time()
+
+    print(f'Written {written_count} messages, {consumer.dropped_count} dropped', file=sys.stderr)
+
+
+def get_oldest_message_ms(redis_client: redis.Redis, stream_keys: List[str]) -> Optional[int]:
+    pipe = redis_client.pipeline(transaction=False)
+    for stream_key in stream_keys:
+        pipe.xrange(stream_key, count=1)
+    return min((message_id_ms(messages[0][0]) for messages in pipe.execute() if messages), default=None)
+
+def get_start_time(redis_client: redis.Redis, oldest_message_ms: Optional[int]) -> float:
+    """Returns the dump start time based on the clock of the Redis server, which the message ids (i.e. the record times) are based on as well."""
+    seconds, microseconds = redis_client.time()
+    now = seconds + microseconds / 1e6
+    # Messages added before the recording started (i.e. a backlog) precede the current time
+    return now if oldest_message_ms is None else min(now, oldest_message_ms / 1000)
 
 
 if __name__ == '__main__':
@@ -71,44 +171,87 @@ if __name__ == '__main__':
     arg_parser = default_arg_parser()
     arg_parser.add_argument('-s', '--streams', type=str, nargs='*', metavar='STREAM')
     arg_parser.add_argument('-o', '--output-file', type=str, default=f'./{time.strftime("%Y-%m-%dT%H-%M-%S%z")}.saedump', metavar='FILE')
-    arg_parser.add_argument('-t', '--time-limit', type='natural_timedelta', help='Stop recording after TIME_LIMIT (default "60s")', default='60s')
+    arg_parser.add_argument('-t', '--time-limit', type='natural_timedelta', help='Stop recording after TIME_LIMIT (default "60s", "0" records until stopped)', default='60s')
     arg_parser.add_argument('-r', '--remove-frame', action='store_true', help='Remove frame data from messages (reduces size significantly)')
     arg_parser.add_argument('-d', '--downscale-frames', default=0, type=int, help='Downscale frames to given width (preserving aspect ratio)', metavar='WIDTH')
     arg_parser.add_argument('-q', '--downscale-jpeg-quality', default=85, type=int, help='JPEG quality for downscaling frames (0-100, sane values 80-95)', metavar='QUALITY')
+    arg_parser.add_argument('--dedup-frames', action='store_true', help='Store identical JPEG frames only once (e.g. from static test sources or parked cameras)')
+    arg_parser.add_argument('--legacy-format', action='store_true', help='Write the legacy JSON/base64 (v1) saedump format instead of the binary v2 format')
+    arg_parser.add_argument('-w', '--workers', default=4, type=int, help='Number of worker processes for frame processing (0 processes frames in a thread of the main process)', metavar='N')
+    arg_parser.add_argument('--max-pending', default=64, type=int, help='Maximum number of messages waiting for frame processing', metavar='N')
+    arg_parser.add_argument('--drop-on-backlog', action='store_true', help='Drop the oldest waiting messages when MAX_PENDING is reached (default is to wait for the workers)')
+    arg_parser.add_argument('-z', '--compress', type=int, nargs='?', const=3, default=None, help='Compress the dump with zstd at the given level (1-22)', metavar='LEVEL')
+    arg_parser.add_argument('--zstd-dict', type=str, help='Use a zstd dictionary (see train_zstd_dict.py) for compression', metavar='FILE')
+    arg_parser.add_argument('--segment-size', type='size', default=0, help='Write segments of at most SIZE (e.g. 500M) into the output directory', metavar='SIZE')
+    arg_parser.add_argument('--segment-duration', type='natural_timedelta', help='Write segments of at most DURATION (e.g. 1h) into the output directory', metavar='DURATION')
+    arg_parser.add_argument('--keep-segments', type=int, default=0, help='Delete the oldest segments if there are more than N', metavar='N')
+    arg_parser.add_argument('--max-total-size', type='size', default=0, help='Delete the oldest segments if all segments together exceed SIZE (e.g. 50G)', metavar='SIZE')
+    arg_parser.add_argument('-g', '--consumer-group', type=str, help='Read as a member of this consumer group: Messages are acknowledged after they have been written, '
+                            'so a restarted recording resumes where the previous one stopped (MAX_PENDING and DROP_ON_BACKLOG do not apply)', metavar='GROUP')
+    arg_parser.add_argument('--consumer-name', type=str, default=socket.gethostname(), help='Name within the consumer group (must be the same to resume a recording)', metavar='NAME')
+    arg_parser.add_argument('-b', '--batch-size', type=int, default=500, help='Maximum number of messages per read from the consumer group', metavar='N')
+    arg_parser.add_argument('--flush-interval', type='natural_timedelta', default='1s', help='Flush the dump to disk and acknowledge messages at this interval', metavar='DURATION')
     args = arg_parser.parse_args()
 
+    is_segmented = args.segment_size > 0 or args.segment_duration is not None
+    if args.legacy_format and (args.compress is not None or is_segmented or args.dedup_frames):
+        arg_parser.error('Compression, segments and frame deduplication are only supported for the v2 format')
+    if (args.keep_segments > 0 or args.max_total_size > 0) and not is_segmented:
+        arg_parser.error('Retention settings require --segment-size or --segment-duration')
+    if args.zstd_dict is not None and args.compress is None:
+        arg_parser.error('--zstd-dict requires --compress')
+
     STREAM_KEYS = args.streams
     REDIS_HOST = args.redis_host
     REDIS_PORT = args.redis_port
 
+    redis_client = redis.Redis(REDIS_HOST, REDIS_PORT)
     if STREAM_KEYS is None:
-        redis_client = redis.Redis(REDIS_HOST, REDIS_PORT)
         STREAM_KEYS = choose_streams(redis_client)
 
-    print(f'Recording streams {STREAM_KEYS} for {args.time_limit} into {args.output_file}')
-
-    stop_event = register_stop_handler()
+    output_file = args.output_file
+    if args.compress is not None and not is_segmented and not output_file.endswith(ZSTD_SUFFIX):
+        output_file += ZSTD_SUFFIX
 
-    consume = RedisConsumer(REDIS_HOST, REDIS_PORT, STREAM_KEYS, block=200, start_at_head=args.start_at_head)
-
-    start_time = time.time()
+    time_limit_s = args.time_limit.total_seconds()
+    print(f'Recording streams {STREAM_KEYS} {f"for {args.time_limit} " if time_limit_s > 0 else ""}into {output_file}')
 
-    with consume, open(args.output_file, 'x') as output_file:
-        
-        write_meta(output_file, start_time, STREAM_KEYS)
+    process_frames = args.remove_frame or args.downscale_frames > 0 or args.dedup_frames
+    use_pool = process_frames and args.workers > 0
+    pool = ProcessPoolExecutor(args.workers, initializer=init_worker) if use_pool else nullcontext()
 
-        for stream_key, proto_data in consume():
-            if stop_event.is_set():
-                break
+    zstd_dict = None
+    if args.zstd_dict is not None:
+        with open(args.zstd_dict, 'rb') as dict_file:
+            zstd_dict = dict_file.read()
 
-            if time.time() - start_time > args.time_limit.total_seconds():
-                print(f'Reached configured time limit of {args.time_limit}')
-                break
+    def create_dump_writer(start_time: float) -> Union[DumpFileWriter, SegmentedDumpWriter]:
+        if is_segmented:
+            return SegmentedDumpWriter(output_file, STREAM_KEYS, args.segment_size, args.segment_duration, args.keep_segments, args.max_total_size,
+                                       args.compress, zstd_dict)
+        return DumpFileWriter(output_file, start_time, STREAM_KEYS, DumpFormat.V1 if args.legacy_format else DumpFormat.V2, args.compress, zstd_dict)
 
-            if stream_key is None:
-                continue
+    process = partial(process_message, is_remove_frame=args.remove_frame, scale_width=args.downscale_frames,
+                      scale_quality=args.downscale_jpeg_quality, is_split_frame=args.dedup_frames) if process_frames else None
 
-            if determine_message_type(proto_data) == InternalMessageType.SAE:
-                proto_data = process_sae_message(proto_data, args.remove_frame, args.downscale_frames, args.downscale_jpeg_quality)
+    if args.consumer_group is not None:
+        stop_event = register_stop_handler()
+        consume = RedisGroupConsumer(REDIS_HOST, REDIS_PORT, STREAM_KEYS, args.consumer_group, args.consumer_name, args.batch_size,
+                                     block=200, start_at_head=args.start_at_head)
+        with consume:
+            # A resumed recording starts with the messages that are still pending or have been added while it was not running
+            dump_writer = create_dump_writer(get_start_time(redis_client, consume.get_oldest_message_ms()))
+            with pool, dump_writer:
+                batch_writer = GroupBatchWriter(dump_writer, consume, partial(process_batch, pool=pool if use_pool else None, process=process),
+                                                args.flush_interval.total_seconds())
+                record_consumer_group(consume, batch_writer, stop_event, args.time_limit)
+        sys.exit(0 if batch_writer.error is None else 1)
 
-            write_event(output_file, stream_key, proto_data)
\ No newline at end of file
+    dump_writer = create_dump_writer(get_start_time(redis_client, get_oldest_message_ms(redis_client, STREAM_KEYS) if args.start_at_head else None))
+    with pool, dump_writer:
+        # Frames are processed in batches in the worker pool (or a thread without workers), while reading and writing continue
+        consumer = AsyncRedisConsumer(REDIS_HOST, REDIS_PORT, STREAM_KEYS, decode=partial(_process_stream_message, process) if process_frames else None,
+                                      executor=pool if use_pool else None,
+                                      policy=BackpressurePolicy.DROP_OLDEST if args.drop_on_backlog else BackpressurePolicy.BLOCK,
+                                      max_pending=args.max_pending, max_decoding=max(1, args.workers) * 2, start_at_head=args.start_at_head)
+        asyncio.run(record_streams(consumer, dump_writer, args.time_limit))
@@ -1,63 +1,253 @@
-import requests
-import time
 import argparse
+import math
+import re
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from os import system
-from collections import defaultdict
-
-ap = argparse.ArgumentParser()
-ap.add_argument('port')
-PORT = int(ap.parse_args().port)
-
-# Configuration
-PROMETHEUS_ENDPOINT = f"http://localhost:{PORT}/api/v1/query"
-COUNTER_METRICS = ["object_detector_frame_counter"]
-SUMMARY_METRICS = [
-    "object_detector_model_duration",
-    "object_detector_nms_duration",
-    "object_detector_proto_serialization_duration",
-    "object_detector_proto_deserialization_duration",
-    "object_detector_get_duration",
-    "object_detector_redis_publish_duration",
-]
-INTERVAL = 0.5  # seconds between queries
-
-
-# Variables to store the previous value and timestamp
-prev_values = defaultdict(lambda: 0)
-prev_time = 0
-
-while True:
+from typing import Deque, Dict, List, NamedTuple, Optional, Tuple
+
+import requests
+
+# prometheus_port of videosource, objectdetector, objecttracker, geomapper and rediswriter (see doc/installation/apt-configuration)
+DEFAULT_PORTS = [8000, 8001, 8002, 8003, 8004]
+INTERVAL = 0.5  # seconds between scrapes
+WINDOW = 10  # seconds over which rates, averages and quantiles are computed
+SCRAPE_TIMEOUT_S = 1
+QUANTILES = [0.5, 0.9, 0.99]
+# Metrics of the Python client itself, only CPU and memory usage are shown
+IGNORED_PREFIXES = ('python_', 'process_')
+
+_SAMPLE_PATTERN = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})?\s+(\S+)')
+_LABEL_PATTERN = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+# Sample name and sorted label pairs
+SampleKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+class Scrape(NamedTuple):
+    time: float
+    # Metric family name -> type (counter, gauge, summary, histogram, untyped)
+    types: Dict[str, str]
+    samples: Dict[SampleKey, float]
+
+
+class StageStats(NamedTuple):
+    name: str
+    labels: Tuple[Tuple[str, str], ...]
+    # Observations per second, average duration and share of wall time spent in the stage (all within the window)
+    rate: float
+    average: Optional[float]
+    busy: float
+    quantiles: Optional[List[Optional[float]]]
+
+
+def parse_metrics(text: str) -> Tuple[Dict[str, str], Dict[SampleKey, float]]:
+    """Parses the Prometheus text exposition format."""
+    types = {}
+    samples = {}
+    for line in text.splitlines():
+        if line.startswith('# TYPE '):
+            _, _, name, metric_type = line.split(maxsplit=3)
+            types[name] = metric_type
+            continue
+        if not line or line.startswith('#'):
+            continue
+        match = _SAMPLE_PATTERN.match(line)
+        if match is None:
+            continue
+        name, labels, value = match.groups()
+        labels = tuple(sorted(_LABEL_PATTERN.findall(labels))) if labels else ()
+        samples[(name, labels)] = float(value)
+    return types, samples
+
+def scrape(session: requests.Session, host: str, port: int) -> Optional[Scrape]:
     try:
-        # Get the metrics from Prometheus
-        response = requests.get(PROMETHEUS_ENDPOINT)
+        response = session.get(f'http://{host}:{port}/metrics', timeout=SCRAPE_TIMEOUT_S)
         response.raise_for_status()
-        metrics_data = response.text
-
-        current_values = defaultdict(lambda: 0)
-        for line in [l for l in metrics_data.splitlines() if not l.startswith('#')]:
-            # Extract the metric value from the line
-            parts = line.split()
-            name = parts[0]
-            value = float(parts[-1])  # The value is the last part of the line
-            current_values[name] = value
-
-        # Get the current time
-        current_time = time.time()
-
-        system('clear')
-        for m in COUNTER_METRICS:
-            rate_of_change = (current_values[f'{m}_total'] - prev_values[f'{m}_total']) / (current_time - prev_time)
-            print(f"Rate of change for {m}: {rate_of_change} units/second")
-        
-        for m in SUMMARY_METRICS:
-            average = current_values[f'{m}_sum'] / current_values[f'{m}_count']
-            print(f"Average for {m}: {average} s")
-        
-        prev_values = current_values
-        prev_time = current_time
-
-    except Exception as e:
-        print(e)
-
-    # Wait for the next interval
-    time.sleep(INTERVAL)
\ No newline at end of file
+    except requests.RequestException:
+        return None
+    return Scrape(time.time(), *parse_metrics(response.text))
+
+
+def histogram_quantile(quantile: float, buckets: List[Tuple[float, float]]) -> Optional[float]:
+    """Estimates a quantile from (upper bound, cumulative count) pairs by linear interpolation within the bucket (like PromQL's histogram_quantile())."""
+    buckets = sorted(buckets)
+    if not buckets or buckets[-1][1] <= 0:
+        return None
+    rank = quantile * buckets[-1][1]
+    lower_bound, lower_count = 0, 0
+    for upper_bound, count in buckets:
+        if count >= rank:
+            if math.isinf(upper_bound):
+                return lower_bound
+            if count == lower_count:
+                return upper_bound
+            return lower_bound + (upper_bound - lower_bound) * (rank - lower_count) / (count - lower_count)
+        lower_bound, lower_count = upper_bound, count
+    return lower_bound
+
+
+class Component:
+    """Keeps the scrapes of one component within the window and computes windowed stats from the oldest and the newest one."""
+    def __init__(self, port: int, window: float):
+        self.port = port
+        self._window = window
+        self._scrapes: Deque[Scrape] = deque()
+
+    def add(self, scrape: Optional[Scrape]):
+        if scrape is None:
+            self._scrapes.clear()
+            return
+        if self._scrapes and self._is_reset(self._scrapes[-1], scrape):
+            # The component has been restarted, the counters start at zero again
+            self._scrapes.clear()
+        self._scrapes.append(scrape)
+        # Keep one scrape at or before the start of the window
+        while len(self._scrapes) > 2 and self._scrapes[1].time <= scrape.time - self._window:
+            self._scrapes.popleft()
+
+    @staticmethod
+    def _is_reset(previous: Scrape, current: Scrape) -> bool:
+        return any(name.endswith(('_total', '_count')) and current.samples.get((name, labels), 0) < value
+                   for (name, labels), value in previous.samples.items())
+
+    @property
+    def is_up(self) -> bool:
+        return len(self._scrapes) > 0
+
+    @property
+    def name(self) -> str:
+        """Guesses the component name from the common prefix of its metrics (e.g. object_detector)."""
+        if not self._scrapes:
+            return ''
+        names = [name for name in self._scrapes[-1].types if not name.startswith(IGNORED_PREFIXES)]
+        if len(names) < 2:
+            return names[0] if names else ''
+        prefix = names[0]
+        for name in names[1:]:
+            while not name.startswith(prefix):
+                prefix = prefix[:-1]
+        return prefix.rsplit('_', 1)[0] if not prefix.endswith('_') else prefix[:-1]
+
+    @property
+    def span(self) -> float:
+        return self._scrapes[-1].time - self._scrapes[0].time if self._scrapes else 0
+
+    def _delta(self, key: SampleKey) -> float:
+        return self._scrapes[-1].samples.get(key, 0) - self._scrapes[0].samples.get(key, 0)
+
+    def rate(self, key: SampleKey) -> Optional[float]:
+        if self.span <= 0 or key not in self._scrapes[-1].samples:
+            return None
+        return self._delta(key) / self.span
+
+    def value(self, key: SampleKey) -> Optional[float]:
+        return self._scrapes[-1].samples.get(key) if self._scrapes else None
+
+    def families(self, metric_type: str) -> List[str]:
+        if not self._scrapes:
+            return []
+        return sorted(name for name, family_type in self._scrapes[-1].types.items() if family_type == metric_type and not name.startswith(IGNORED_PREFIXES))
+
+    def _label_sets(self, sample_name: str) -> List[Tuple[Tuple[str, str], ...]]:
+        return sorted({labels for name, labels in self._scrapes[-1].samples if name == sample_name})
+
+    def counters(self) -> List[Tuple[str, Tuple, Optional[float]]]:
+        # Depending on the client version, the family name of counters may or may not contain the _total suffix
+        sample_names = [name if name.endswith('_total') else f'{name}_total' for name in self.families('counter')]
+        return [(name, labels, self.rate((name, labels))) for name in sample_names for labels in self._label_sets(name)]
+
+    def gauges(self) -> List[Tuple[str, Tuple, Optional[float]]]:
+        return [(name, labels, self.value((name, labels)))
+                for name in self.families('gauge') if not name.endswith('_created') for labels in self._label_sets(name)]
+
+    def stages(self) -> List[StageStats]:
+        """Returns windowed stats of all summaries and histograms, sorted by the share of time spent in them."""
+        if self.span <= 0:
+            return []
+        stages = []
+        for metric_type in ('summary', 'histogram'):
+            for name in self.families(metric_type):
+                for labels in self._label_sets(f'{name}_count'):
+                    count = self._delta((f'{name}_count', labels))
+                    total = self._delta((f'{name}_sum', labels))
+                    quantiles = None
+                    if metric_type == 'histogram':
+                        buckets = [(float(bucket_labels[0][1]), self._delta((f'{name}_bucket', tuple(sorted(labels + bucket_labels)))))
+                                   for bucket_labels in self._bucket_labels(name, labels)]
+                        quantiles = [histogram_quantile(quantile, buckets) for quantile in QUANTILES]
+                    stages.append(StageStats(name, labels, count / self.span, total / count if count > 0 else None,
+                                             total / self.span, quantiles))
+        return sorted(stages, key=lambda stage: stage.busy, reverse=True)
+
+    def _bucket_labels(self, name: str, labels: Tuple) -> List[Tuple[Tuple[str, str]]]:
+        bucket_labels = []
+        for sample_name, sample_labels in self._scrapes[-1].samples:
+            if sample_name == f'{name}_bucket':
+                le = [label for label in sample_labels if label[0] == 'le']
+                if le and tuple(label for label in sample_labels if label[0] != 'le') == labels:
+                    bucket_labels.append(tuple(le))
+        return bucket_labels
+
+
+def format_labels(labels: Tuple) -> str:
+    return ','.join(f'{name}={value}' for name, value in labels)
+
+def format_sample(name: str, labels: Tuple) -> str:
+    return f'{name}{{{format_labels(labels)}}}' if labels else name
+
+def format_value(value: Optional[float], unit='', scale=1, precision=2) -> str:
+    return f'{value * scale:.{precision}f}{unit}' if value is not None else '-'
+
+def format_component(host: str, component: Component) -> List[str]:
+    if not component.is_up:
+        return [f'== {host}:{component.port} (not reachable)']
+
+    cpu = component.rate(('process_cpu_seconds_total', ()))
+    memory = component.value(('process_resident_memory_bytes', ()))
+    lines = [f'== {host}:{component.port} {component.name}  CPU {format_value(cpu, "%", 100, 0)}  RSS {format_value(memory, " MiB", 1 / 1024 / 1024, 0)}  '
+             f'window {component.span:.1f}s']
+
+    for name, labels, rate in component.counters():
+        lines.append(f'   {format_sample(name, labels)}: {format_value(rate, "/s", precision=1)}')
+    for name, labels, value in component.gauges():
+        lines.append(f'   {format_sample(name, labels)}: {format_value(value)}')
+
+    stages = component.stages()
+    if stages:
+        quantile_header = ''.join(f'{f"p{quantile * 100:g}": >9}' for quantile in QUANTILES)
+        lines.append(f'   {"Stage": <50}{"Calls": >9}{"Avg": >9}{quantile_header}{"Busy": >7}')
+        for stage in stages:
+            name = format_sample(stage.name, stage.labels)
+            quantiles = ''.join(f'{format_value(value, "ms", 1000): >9}' for value in (stage.quantiles or [None] * len(QUANTILES)))
+            lines.append(f'   {name: <50}{format_value(stage.rate, "/s", precision=1): >9}{format_value(stage.average, "ms", 1000): >9}'
+                         f'{quantiles}{format_value(stage.busy, "%", 100, 0): >7}')
+    return lines
+
+
+if __name__ == '__main__':
+
+    ap = argparse.ArgumentParser(description='Shows windowed rates, durations and a per-stage breakdown of the Prometheus metrics of SAE components')
+    ap.add_argument('ports', type=int, nargs='*', default=DEFAULT_PORTS, help='Prometheus ports of the components')
+    ap.add_argument('--host', type=str, default='localhost', help='Host the components run on')
+    ap.add_argument('-i', '--interval', type=float, default=INTERVAL, help='Seconds between scrapes')
+    ap.add_argument('-w', '--window', type=float, default=WINDOW, help='Seconds over which rates, averages and quantiles are computed')
+    args = ap.parse_args()
+
+    components = [Component(port, args.window) for port in args.ports]
+    # One session per component, as sessions are not thread-safe
+    sessions = {component.port: requests.Session() for component in components}
+
+    with ThreadPoolExecutor(max_workers=len(components)) as executor:
+        while True:
+            scrapes = executor.map(lambda component: scrape(sessions[component.port], args.host, component.port), components)
+            output = []
+            for component, component_scrape in zip(components, scrapes):
+                component.add(component_scrape)
+                output.extend(format_component(args.host, component))
+
+            system('clear')
+            print('\n'.join(output), flush=True)
+
+            time.sleep(args.interval)
@@ -0,0 +1,38 @@
+import random
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from pathlib import Path
+
+from common import process_message
+from dumpfile import open_dump, train_zstd_dict
+
+if __name__ == '__main__':
+
+    arg_parser = ArgumentParser(description='Train a zstd dictionary on the messages of existing SAE dumps (for use with record.py --zstd-dict)',
+                                formatter_class=ArgumentDefaultsHelpFormatter)
+    arg_parser.add_argument('dumpfiles', type=Path, nargs='+', metavar='DUMPFILE', help='Dump files or segment directories to take sample messages from')
+    arg_parser.add_argument('-o', '--output-file', type=Path, default=Path('zstd.dict'), metavar='FILE')
+    arg_parser.add_argument('-n', '--samples', type=int, default=10000, help='Maximum number of sample messages to use')
+    arg_parser.add_argument('--dict-size', type=int, default=112640, help='Dictionary size in bytes')
+    arg_parser.add_argument('-r', '--remove-frame', action='store_true', help='Remove frame data from sample messages (dictionaries are most effective for small messages)')
+    args = arg_parser.parse_args()
+
+    # Reservoir sampling, so that large dumps do not have to be kept in memory
+    samples = []
+    message_count = 0
+    for dump_file in args.dumpfiles:
+        with open_dump(dump_file) as dump:
+            for record in dump:
+                message_count += 1
+                sample_idx = len(samples) if len(samples) < args.samples else random.randrange(message_count)
+                if sample_idx >= args.samples:
+                    continue
+
+                sample = process_message(record.proto_bytes, is_remove_frame=True, stream_key=record.source_stream) if args.remove_frame else record.proto_bytes
+                if sample_idx == len(samples):
+                    samples.append(sample)
+                else:
+                    samples[sample_idx] = sample
+
+    print(f'Training dictionary on {len(samples)} messages ({sum(map(len, samples)) / 1024:.0f} KiB)')
+    args.output_file.write_bytes(train_zstd_dict(samples, args.dict_size))
+    print(f'Dictionary written to {args.output_file}')
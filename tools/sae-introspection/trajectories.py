@@ -0,0 +1,48 @@
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+from palettable.colorbrewer.qualitative import Set1_9
+
+# Only depends on NumPy, OpenCV and palettable, as it is also used by tools/cameras/plot-trajectories.py
+
+CLS_CMAP = Set1_9.colors
+# Time is only used to tell how long ago an object has been seen (in seconds, relative to any reference)
+TRACK_POINT_DTYPE = np.dtype([('object', '<i8'), ('class_id', '<i4'), ('time', '<f8'), ('center_x', '<f4'), ('center_y', '<f4')])
+
+
+def get_color(class_id: int) -> Tuple[int]:
+    c = CLS_CMAP[class_id % len(CLS_CMAP)]
+    return (c[2], c[1], c[0])
+
+def draw_trajectories(img: np.ndarray, points: np.ndarray, previous: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Connects the consecutive points (TRACK_POINT_DTYPE, center in normalized coordinates) of each object, starting at its point in
+    previous if there is one (i.e. the return value of the call for the previous chunk), and returns the last point of each object.
+    Each segment is colored by the class of the point it leads to, so tracks are split into runs of segments of the same class,
+    and all runs of a class are drawn with a single polylines call.
+    """
+    if previous is not None:
+        points = np.concatenate([previous, points])
+    if len(points) == 0:
+        return points
+
+    # The stable sort keeps the points of each object in their original order (previous ones first)
+    points = points[np.argsort(points['object'], kind='stable')]
+    pixels = (np.stack([points['center_x'], points['center_y']], axis=1) * (img.shape[1], img.shape[0])).astype(np.int32)
+    objects = points['object']
+    classes = points['class_id']
+
+    # Segment i connects point i - 1 and point i (segment 0 does not exist)
+    is_segment = np.concatenate([[False], objects[1:] == objects[:-1]])
+    is_run_start = is_segment & ~np.concatenate([[False], is_segment[:-1] & (classes[1:] == classes[:-1])])
+    run_starts = np.flatnonzero(is_run_start)
+    run_ends = run_starts + np.add.reduceat(is_segment, run_starts) if len(run_starts) > 0 else run_starts
+
+    for class_id in np.unique(classes[run_starts]):
+        is_class = classes[run_starts] == class_id
+        polylines = [pixels[start - 1:end] for start, end in zip(run_starts[is_class], run_ends[is_class])]
+        cv2.polylines(img, polylines, isClosed=False, color=get_color(int(class_id)), thickness=1, lineType=cv2.LINE_AA)
+
+    is_last = np.concatenate([objects[1:] != objects[:-1], [True]])
+    return points[is_last]
@@ -0,0 +1,194 @@
+import sys
+import time
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import nullcontext
+from pathlib import Path
+from typing import Deque, List, NamedTuple, Optional, Set, Tuple, Union
+
+from common import (InternalMessageType, add_dump_selection_args,
+                    determine_message_type, init_worker, process_sae_message)
+from dumpfile import (ZSTD_SUFFIX, DumpFileWriter, DumpFormat, DumpRecord,
+                      ProcessedMessage, detections_path, index_path,
+                      open_dump, write_message)
+
+STATS_INTERVAL_S = 5
+BATCH_SIZE = 64
+
+
+class SkippedMessage(NamedTuple):
+    """Result for a message that could not be transformed (e.g. of unknown type or corrupt), it is left out of the output."""
+    error: str
+
+TransformResult = Union[ProcessedMessage, SkippedMessage, None]
+
+
+def transform_message(stream_key: str, proto_data: bytes, message_types: Optional[Set[InternalMessageType]], is_remove_frame=False, scale_width=0,
+                      scale_quality=85, is_split_frame=False) -> Optional[ProcessedMessage]:
+    """Returns the transformed message or None if it is filtered out."""
+    message_type = determine_message_type(proto_data, stream_key)
+    if message_types is not None and message_type not in message_types:
+        return None
+    if message_type == InternalMessageType.SAE and (is_remove_frame or scale_width > 0 or is_split_frame):
+        return process_sae_message(proto_data, is_remove_frame, scale_width, scale_quality, is_split_frame)
+    return proto_data
+
+def transform_batch(messages: List[Tuple[str, bytes]], *transform_args) -> List[TransformResult]:
+    results = []
+    for stream_key, proto_data in messages:
+        # A single foreign or corrupt message must not abort the whole transformation
+        try:
+            results.append(transform_message(stream_key, proto_data, *transform_args))
+        except Exception as e:
+            results.append(SkippedMessage(str(e)))
+    return results
+
+
+class OrderedBatchWriter:
+    """
+    Writes batches of transformed messages in reading order, while later batches may still be processed in the worker pool.
+    The output file is only created with the first message that passes the filters.
+    """
+    def __init__(self, path: Path, start_time: Optional[float], stream_keys: List[str], format: DumpFormat, compression_level: Optional[int]):
+        self._path = path
+        self._start_time = start_time
+        self._stream_keys = stream_keys
+        self._format = format
+        self._compression_level = compression_level
+        self._dump_writer: Optional[DumpFileWriter] = None
+        self._pending: Deque[Tuple[List[DumpRecord], Union[Future, List[TransformResult]]]] = deque()
+        self.written_count = 0
+        self.skipped_count = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        if self._dump_writer is not None:
+            self._dump_writer.close()
+
+    @property
+    def is_empty(self) -> bool:
+        return self._dump_writer is None
+
+    def append(self, records: List[DumpRecord], results: Union[Future, List[TransformResult]]):
+        self._pending.append((records, results))
+
+    def write(self, max_pending: int = 0):
+        """Writes all batches that are done processing and waits for the oldest ones until at most max_pending are left."""
+        while len(self._pending) > max_pending or (len(self._pending) > 0 and self._is_done(self._pending[0][1])):
+            records, results = self._pending.popleft()
+            for record, message in zip(records, results.result() if isinstance(results, Future) else results):
+                if isinstance(message, SkippedMessage):
+                    self._skip(record, message)
+                elif message is not None:
+                    self._write(record, message)
+
+    def _write(self, record: DumpRecord, message: ProcessedMessage):
+        if self._dump_writer is None:
+            start_time = self._start_time if self._start_time is not None else record.record_time
+            self._dump_writer = DumpFileWriter(self._path, start_time, self._stream_keys, self._format, self._compression_level)
+        write_message(self._dump_writer, record.source_stream, message, record.record_time)
+        self.written_count += 1
+
+    def _skip(self, record: DumpRecord, skipped: SkippedMessage):
+        if self.skipped_count == 0:
+            print(f'Skipping message of {record.source_stream} at {record.record_time:.3f} ({skipped.error}), further ones are only counted', file=sys.stderr)
+        self.skipped_count += 1
+
+    @staticmethod
+    def _is_done(results: Union[Future, List[TransformResult]]) -> bool:
+        return not isinstance(results, Future) or results.done()
+
+
+if __name__ == '__main__':
+
+    arg_parser = ArgumentParser(description='Filter and slim down an existing SAE dump into a new one', formatter_class=ArgumentDefaultsHelpFormatter)
+    arg_parser.add_argument('dumpfile', type=Path, help='Dump file or segment directory to read')
+    arg_parser.add_argument('-o', '--output-file', type=Path, required=True, metavar='FILE')
+    arg_parser.add_argument('-f', '--force', action='store_true', help='Overwrite the output file if it exists')
+    add_dump_selection_args(arg_parser)
+    arg_parser.add_argument('-m', '--message-types', type=InternalMessageType, nargs='+', choices=list(InternalMessageType), metavar='TYPE',
+                            help=f'Only keep messages of the given types ({", ".join(message_type.value for message_type in InternalMessageType)})')
+    arg_parser.add_argument('-r', '--remove-frame', action='store_true', help='Remove frame data from messages (reduces size significantly)')
+    arg_parser.add_argument('-d', '--downscale-frames', default=0, type=int, help='Downscale frames to given width (preserving aspect ratio)', metavar='WIDTH')
+    arg_parser.add_argument('-q', '--downscale-jpeg-quality', default=85, type=int, help='JPEG quality for downscaling frames (0-100, sane values 80-95)', metavar='QUALITY')
+    arg_parser.add_argument('--dedup-frames', action='store_true', help='Store identical JPEG frames only once')
+    arg_parser.add_argument('-z', '--compress', type=int, nargs='?', const=3, default=None, help='Compress the output with zstd at the given level (1-22)', metavar='LEVEL')
+    arg_parser.add_argument('--legacy-format', action='store_true', help='Write the legacy JSON/base64 (v1) saedump format instead of the binary v2 format')
+    arg_parser.add_argument('-w', '--workers', default=4, type=int, help='Number of worker processes for message processing (0 processes messages inline)', metavar='N')
+    args = arg_parser.parse_args()
+
+    if args.legacy_format and (args.compress is not None or args.dedup_frames):
+        arg_parser.error('Compression and frame deduplication are only supported for the v2 format')
+
+    output_file = args.output_file
+    if args.compress is not None and not output_file.name.endswith(ZSTD_SUFFIX):
+        output_file = output_file.with_name(output_file.name + ZSTD_SUFFIX)
+    if output_file.exists():
+        if not args.force:
+            arg_parser.error(f'{output_file} already exists (use -f to overwrite)')
+        output_file.unlink()
+    # Sidecars of an earlier output would not match the new one
+    index_path(output_file).unlink(missing_ok=True)
+    detections_path(output_file).unlink(missing_ok=True)
+
+    message_types = set(args.message_types) if args.message_types is not None else None
+    transform_args = (message_types, args.remove_frame, args.downscale_frames, args.downscale_jpeg_quality, args.dedup_frames)
+    needs_processing = message_types is not None or args.remove_frame or args.downscale_frames > 0 or args.dedup_frames
+    use_pool = needs_processing and args.workers > 0
+    max_pending = max(1, args.workers * 2)
+
+    pool = ProcessPoolExecutor(args.workers, initializer=init_worker) if use_pool else nullcontext()
+
+    read_count = 0
+    read_bytes = 0
+    start_time = time.time()
+    last_stats_time = start_time
+
+    with open_dump(args.dumpfile) as dump, pool:
+        stream_keys = args.streams if args.streams is not None else list(dump.meta.recorded_streams)
+        # A sliced dump starts with its first message, so that it is played back without an initial pause
+        dump_start = dump.meta.start_time if args.from_offset is None else None
+        writer = OrderedBatchWriter(output_file, dump_start, stream_keys, DumpFormat.V1 if args.legacy_format else DumpFormat.V2, args.compress)
+
+        def submit(batch: List[DumpRecord]):
+            messages = [(record.source_stream, record.proto_bytes) for record in batch]
+            if not needs_processing:
+                writer.append(batch, [proto_data for _, proto_data in messages])
+            elif not use_pool:
+                writer.append(batch, transform_batch(messages, *transform_args))
+            else:
+                writer.write(max_pending=max_pending - 1)
+                writer.append(batch, pool.submit(transform_batch, messages, *transform_args))
+            writer.write(max_pending=max_pending)
+
+        with writer:
+            batch = []
+            for record in dump.iter_slice(args.from_offset, args.to_offset, args.streams):
+                read_count += 1
+                read_bytes += len(record.proto_bytes)
+                batch.append(record)
+                if len(batch) == BATCH_SIZE:
+                    submit(batch)
+                    batch = []
+
+                if time.time() - last_stats_time > STATS_INTERVAL_S:
+                    print(f'Read {read_count} messages ({read_bytes / 1024 / 1024:.0f} MiB), written {writer.written_count}', file=sys.stderr)
+                    last_stats_time = time.time()
+
+            if len(batch) > 0:
+                submit(batch)
+            writer.write()
+
+    if writer.skipped_count > 0:
+        print(f'Skipped {writer.skipped_count} messages that could not be transformed', file=sys.stderr)
+    if writer.is_empty:
+        print(f'None of the {read_count} messages was selected, no output written')
+    else:
+        print(f'Written {writer.written_count} of {read_count} messages into {output_file} in {time.time() - start_time:.1f}s '
+              f'({read_bytes / 1024 / 1024:.1f} MiB -> {output_file.stat().st_size / 1024 / 1024:.1f} MiB)')
@@ -1,21 +1,43 @@
+import asyncio
+import math
 import sys
+import threading
 import time
+from functools import partial
+from typing import Callable, List, Optional, Tuple
 
 import cv2
 import numpy as np
 import redis
-from visionapi.sae_pb2 import Detection, SaeMessage
-from visionlib.pipeline.consumer import RedisConsumer
+from visionapi.sae_pb2 import Detection, SaeMessage, VideoFrame
 from visionlib.pipeline.tools import get_raw_frame_data
 
-from common import (InternalMessageType, choose_stream, default_arg_parser,
-                    determine_message_type, register_stop_handler)
+from common import (AsyncRedisConsumer, BackpressurePolicy,
+                    InternalMessageType, choose_stream, default_arg_parser,
+                    determine_message_type, get_scaled_frame_data,
+                    register_async_stop_handler)
 
 ANNOTATION_COLOR = (0, 0, 255)
+LABEL_COLOR = (255, 255, 255)
 DEFAULT_WINDOW_SIZE = (1280, 720)
+MOSAIC_WINDOW_NAME = 'mosaic'
+MOSAIC_STATS_INTERVAL_S = 5
+# How often the display thread handles window events while no new frame arrives
+DISPLAY_IDLE_INTERVAL_S = 0.05
 
 previous_frame_timestamp = 0
 args = None
+# The image given with --image-file (loaded once)
+background_image = None
+# Size of the image area of the window (updated whenever a frame is shown), frames are decoded at that size
+display_size = DEFAULT_WINDOW_SIZE
+
+def getWindowImageSize(window_name) -> Optional[Tuple[int, int]]:
+    try:
+        _, _, width, height = cv2.getWindowImageRect(window_name)
+        return (width, height) if width > 0 and height > 0 else None
+    except:
+        return None
 
 def isWindowVisible(window_name):
     try:
@@ -24,14 +46,15 @@ def isWindowVisible(window_name):
     except:
         return False
     
-def get_image(sae_msg: SaeMessage):
-    if args.image_file is not None:
-        image = cv2.imread(args.image_file)
-        if image is None:
-            raise ValueError(f'Could not read image from file {args.image_file}')
-        return image
+def get_image(sae_msg: SaeMessage, target_width: int = 0, scale_factor: float = 0):
+    if background_image is not None:
+        # Annotations are drawn onto the image
+        return background_image.copy()
     else:
-        frame = get_raw_frame_data(sae_msg.frame)
+        if target_width > 0 or scale_factor > 0:
+            frame = get_scaled_frame_data(sae_msg.frame, target_width=target_width, scale_factor=scale_factor)
+        else:
+            frame = get_raw_frame_data(sae_msg.frame)
         if frame is not None:
             return frame
         else:
@@ -59,11 +82,13 @@ def annotate(image, detection: Detection):
     cv2.rectangle(image, (bbox_x1, bbox_y1), (bbox_x2, bbox_y2), color=ANNOTATION_COLOR, thickness=line_width, lineType=cv2.LINE_AA)
     cv2.putText(image, label, (bbox_x1, bbox_y1 - 10), fontFace=cv2.FONT_HERSHEY_SIMPLEX, color=ANNOTATION_COLOR, thickness=round(line_width/3), fontScale=line_width/4, lineType=cv2.LINE_AA)
 
-def showImage(stream_id, image):
+def showImage(stream_id, image, is_prescaled=False):
+    global display_size
+
     displayed_image = image
     
-    # When using fixed scale, resize the image before displaying
-    if args.fixed_scale:
+    # When using fixed scale, resize the image before displaying (unless it has been decoded at that size already)
+    if args.fixed_scale and not is_prescaled:
         scale_factor = args.fixed_scale
         new_width = int(image.shape[1] * scale_factor)
         new_height = int(image.shape[0] * scale_factor)
@@ -78,45 +103,251 @@ def showImage(stream_id, image):
             cv2.resizeWindow(stream_id, *DEFAULT_WINDOW_SIZE)
         
     cv2.imshow(stream_id, displayed_image)
-    if cv2.waitKey(1) == ord('q'):
-        stop_event.set()
+    if not args.fixed_scale:
+        display_size = getWindowImageSize(stream_id) or display_size
+
+
+class FrameDisplay(threading.Thread):
+    """
+    Shows frames in a window from a thread of its own, so that a slow display neither holds up reading and decoding nor adds to the measured delays.
+    Only the latest frame is kept, frames replaced before they have been shown are counted as skipped.
+    All window functions of OpenCV are called from this thread.
+    """
+    def __init__(self, show_image: Callable[[np.ndarray], None], on_quit: Callable[[], None]):
+        super().__init__(name='display', daemon=True)
+        self._show_image = show_image
+        self._on_quit = on_quit
+        self._image: Optional[np.ndarray] = None
+        self._changed = threading.Condition()
+        self._stopped = False
+        self.skipped_count = 0
+
+    def show(self, image: np.ndarray):
+        with self._changed:
+            if self._image is not None:
+                self.skipped_count += 1
+            self._image = image
+            self._changed.notify()
+
+    def stop(self):
+        with self._changed:
+            self._stopped = True
+            self._changed.notify()
+
+    def run(self):
+        while True:
+            with self._changed:
+                self._changed.wait_for(lambda: self._image is not None or self._stopped, timeout=DISPLAY_IDLE_INTERVAL_S)
+                if self._stopped:
+                    break
+                image, self._image = self._image, None
+
+            if image is not None:
+                self._show_image(image)
+            if cv2.waitKey(1) == ord('q'):
+                self._on_quit()
+                break
         cv2.destroyAllWindows()
 
-def handle_sae_message(sae_message_bytes, stream_key, show_image=True):
-    global previous_frame_timestamp, args
+def start_display(show_image: Callable[[np.ndarray], None], consumer: AsyncRedisConsumer) -> FrameDisplay:
+    """Starts the display thread, which stops the consumer (from within the event loop) when "q" is pressed."""
+    loop = asyncio.get_running_loop()
+    display = FrameDisplay(show_image, lambda: loop.call_soon_threadsafe(consumer.stop))
+    display.start()
+    return display
+
+def decode_sae_message(stream_key: str, sae_message_bytes: bytes) -> Tuple[InternalMessageType, Optional[SaeMessage], Optional[np.ndarray]]:
+    """Parses the message and decodes and annotates its frame (runs in a worker thread, while the previous frame is displayed)."""
+    if (msg_type := determine_message_type(sae_message_bytes, stream_key)) != InternalMessageType.SAE:
+        return msg_type, None, None
 
     sae_msg = SaeMessage()
     sae_msg.ParseFromString(sae_message_bytes)
 
+    image = get_image(sae_msg, get_decode_width(sae_msg.frame), get_decode_scale())
+
+    for detection in sae_msg.detections:
+        annotate(image, detection)
+
+    return msg_type, sae_msg, image
+
+def is_decoded_downscaled() -> bool:
+    # Downscaled frames can be decoded at display size directly, unless the full frame is needed for stdout
+    return not args.stdout and background_image is None and not args.no_gui
+
+def get_decode_scale() -> float:
+    return args.fixed_scale if args.fixed_scale and args.fixed_scale < 1 and is_decoded_downscaled() else 0
+
+def get_decode_width(frame: VideoFrame) -> int:
+    """Returns the width to decode the frame at to fit into the window (0 for the original size)."""
+    if args.fixed_scale or not is_decoded_downscaled() or frame.shape.width == 0 or frame.shape.height == 0:
+        return 0
+    fit_factor = min(display_size[0] / frame.shape.width, display_size[1] / frame.shape.height)
+    return round(frame.shape.width * fit_factor) if fit_factor < 1 else 0
+
+def handle_sae_message(sae_msg: SaeMessage, image: np.ndarray, read_time: float, skipped_count: int, display: Optional[FrameDisplay]):
+    global previous_frame_timestamp
+
     frametime = sae_msg.frame.timestamp_utc_ms - previous_frame_timestamp
     previous_frame_timestamp = sae_msg.frame.timestamp_utc_ms
 
-    log_line = f'E2E-Delay: {round(time.time() * 1000 - sae_msg.frame.timestamp_utc_ms): >8} ms, Display Frametime: {frametime: >5} ms'
+    # The E2E delay is measured when the message is read, i.e. it does not include the time it takes to decode and display the frame
+    # (the frame is displayed in a thread of its own, so displaying does not delay reading either)
+    log_line = (f'E2E-Delay: {round(read_time * 1000 - sae_msg.frame.timestamp_utc_ms): >8} ms, Display Delay: {round((time.time() - read_time) * 1000): >5} ms, '
+                f'Display Frametime: {frametime: >5} ms, Skipped: {skipped_count: >6}')
     if sae_msg.HasField('metrics'):
         log_line += f', Detection: {sae_msg.metrics.detection_inference_time_us: >7} us, Tracking: {sae_msg.metrics.tracking_inference_time_us: >7} us'
     print(log_line, file=sys.stderr)
 
-    image = get_image(sae_msg)
+    if args.stdout:
+        sys.stdout.buffer.write(image)
+
+    if display is not None:
+        display.show(image)
+
+def decode_tile(stream_key: str, sae_message_bytes: bytes, tile_size: Tuple[int, int]) -> Tuple[InternalMessageType, Optional[SaeMessage], Optional[np.ndarray]]:
+    """Parses the message and decodes and annotates its frame at the size of a mosaic tile."""
+    if (msg_type := determine_message_type(sae_message_bytes, stream_key)) != InternalMessageType.SAE:
+        return msg_type, None, None
+
+    sae_msg = SaeMessage()
+    sae_msg.ParseFromString(sae_message_bytes)
+
+    target_width = 0
+    if sae_msg.frame.shape.width > 0 and sae_msg.frame.shape.height > 0:
+        target_width = fit_into(sae_msg.frame.shape.width, sae_msg.frame.shape.height, tile_size)[0]
+    image = get_image(sae_msg, target_width)
+
+    # The frame shape may be missing or wrong (and the image file has a size of its own)
+    width, height = fit_into(image.shape[1], image.shape[0], tile_size)
+    if (width, height) != (image.shape[1], image.shape[0]):
+        image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
 
     for detection in sae_msg.detections:
         annotate(image, detection)
-    
-    if args.stdout:
-        sys.stdout.buffer.write(image)
 
-    if show_image:
-        showImage(stream_key, image)
+    return msg_type, sae_msg, image
+
+def fit_into(width: int, height: int, size: Tuple[int, int]) -> Tuple[int, int]:
+    """Returns the largest size with the same aspect ratio that fits into size."""
+    fit_factor = min(size[0] / width, size[1] / height)
+    return max(1, round(width * fit_factor)), max(1, round(height * fit_factor))
+
+
+class Mosaic:
+    """Grid of fixed-size tiles (one per stream), each showing the latest frame of its stream."""
+    def __init__(self, stream_keys: List[str], tile_size: Tuple[int, int], columns: int):
+        self._tile_size = tile_size
+        self._positions = {stream_key: divmod(idx, columns) for idx, stream_key in enumerate(stream_keys)}
+        rows = -(-len(stream_keys) // columns)
+        self.image = np.zeros((rows * tile_size[1], columns * tile_size[0], 3), dtype=np.uint8)
+        for stream_key in stream_keys:
+            self._label(self._tile(stream_key), stream_key)
+
+    def update(self, stream_key: str, image: np.ndarray):
+        tile = self._tile(stream_key)
+        tile[:] = 0
+        offset_x = (self._tile_size[0] - image.shape[1]) // 2
+        offset_y = (self._tile_size[1] - image.shape[0]) // 2
+        tile[offset_y:offset_y + image.shape[0], offset_x:offset_x + image.shape[1]] = image
+        self._label(tile, stream_key)
+
+    def _tile(self, stream_key: str) -> np.ndarray:
+        row, column = self._positions[stream_key]
+        width, height = self._tile_size
+        return self.image[row * height:(row + 1) * height, column * width:(column + 1) * width]
+
+    @staticmethod
+    def _label(tile: np.ndarray, text: str):
+        cv2.putText(tile, text, (8, 24), fontFace=cv2.FONT_HERSHEY_SIMPLEX, fontScale=0.6, color=(0, 0, 0), thickness=3, lineType=cv2.LINE_AA)
+        cv2.putText(tile, text, (8, 24), fontFace=cv2.FONT_HERSHEY_SIMPLEX, fontScale=0.6, color=LABEL_COLOR, thickness=1, lineType=cv2.LINE_AA)
+
+def show_mosaic(image: np.ndarray):
+    if not isWindowVisible(MOSAIC_WINDOW_NAME):
+        cv2.namedWindow(MOSAIC_WINDOW_NAME, cv2.WINDOW_NORMAL + cv2.WINDOW_KEEPRATIO)
+        cv2.resizeWindow(MOSAIC_WINDOW_NAME, *fit_into(image.shape[1], image.shape[0], DEFAULT_WINDOW_SIZE))
+    cv2.imshow(MOSAIC_WINDOW_NAME, image)
+
+async def watch_mosaic(consumer: AsyncRedisConsumer, mosaic: Mosaic, max_fps: float):
+    """
+    Shows the latest frames of all streams in one window. Tiles are refreshed at most max_fps times per second in total,
+    messages arriving in the meantime only replace older ones of the same stream (and streams whose newest message has waited the longest come first).
+    """
+    register_async_stop_handler(consumer.stop)
+
+    display = start_display(show_mosaic, consumer) if not args.no_gui else None
+
+    refresh_interval_s = 1 / max_fps
+    next_refresh_time = time.monotonic()
+    last_stats_time = time.monotonic()
+    refresh_count = 0
+    max_delay_ms = 0
+
+    async with consumer:
+        async for message in consumer:
+            msg_type, sae_msg, image = message.value
+            if msg_type != InternalMessageType.SAE:
+                print(f'Detected message type on stream {message.stream_key} is {msg_type.name}. Only type SAE is supported.')
+                exit(1)
+
+            mosaic.update(message.stream_key, image)
+            refresh_count += 1
+            max_delay_ms = max(max_delay_ms, round(message.read_time * 1000 - sae_msg.frame.timestamp_utc_ms))
+
+            if args.stdout:
+                sys.stdout.buffer.write(mosaic.image)
+
+            if display is not None:
+                # The mosaic is updated in place, so the display gets a snapshot (which replaces the previous one if that has not been shown yet)
+                display.show(mosaic.image.copy())
+
+            if time.monotonic() - last_stats_time > MOSAIC_STATS_INTERVAL_S:
+                print(f'Refreshed {refresh_count / (time.monotonic() - last_stats_time):.1f} tiles / s, {consumer.dropped_count} frames skipped in total, '
+                      f'max. E2E-Delay: {max_delay_ms} ms', file=sys.stderr)
+                last_stats_time = time.monotonic()
+                refresh_count = 0
+                max_delay_ms = 0
+
+            # Frames are only decoded as fast as the tiles are refreshed, so the budget also limits the CPU load
+            next_refresh_time = max(next_refresh_time + refresh_interval_s, time.monotonic())
+            await asyncio.sleep(next_refresh_time - time.monotonic())
+
+    if display is not None:
+        display.stop()
+        display.join()
+
+async def watch(consumer: AsyncRedisConsumer, stream_key: str):
+    register_async_stop_handler(consumer.stop)
+
+    display = start_display(partial(showImage, stream_key, is_prescaled=get_decode_scale() > 0), consumer) if not args.no_gui else None
+
+    async with consumer:
+        async for message in consumer:
+            msg_type, sae_msg, image = message.value
+            if msg_type != InternalMessageType.SAE:
+                print(f'Detected message type on stream {message.stream_key} is {msg_type.name}. Only type SAE is supported.')
+                exit(1)
+
+            skipped_count = consumer.dropped_count + (display.skipped_count if display is not None else 0)
+            handle_sae_message(sae_msg, image, message.read_time, skipped_count, display)
+
+    if display is not None:
+        display.stop()
+        display.join()
 
 
 if __name__ == '__main__':
 
     arg_parser = default_arg_parser()
-    arg_parser.add_argument('-s', '--stream', type=str)
+    arg_parser.add_argument('-s', '--stream', type=str, nargs='+', metavar='STREAM', help='Several streams are shown as a mosaic in one window')
     arg_parser.add_argument('-i', '--image-file', type=str, default=None, metavar='FILE')
     arg_parser.add_argument('-o', '--stdout', action='store_true', help='Output annotated raw frames to stdout (e.g. to pipe into ffmpeg)')
     arg_parser.add_argument('-f', '--fixed-scale', type=float, metavar='SCALE',
                            help='Display with fixed scaling factor and high-quality scaling (2=double size, 1=original size, 0.75=75%% size , 0.5=half size, etc.)')
     arg_parser.add_argument('-n', '--no-gui', action='store_true', help='Do not display a GUI window. Useful when only piping to stdout.')
+    arg_parser.add_argument('--tile-width', type=int, default=480, metavar='WIDTH', help='Width of each tile of the mosaic (tiles are 16:9)')
+    arg_parser.add_argument('--columns', type=int, default=0, metavar='N', help='Number of columns of the mosaic (default is a square grid)')
+    arg_parser.add_argument('--max-fps', type=float, default=30, metavar='FPS', help='Maximum number of tile refreshes per second of the mosaic (for all tiles together)')
 
     args = arg_parser.parse_args()
 
@@ -124,28 +355,37 @@ if __name__ == '__main__':
         print('Stdout is the terminal. Ignoring "stdout" option. Please redirect (e.g. into ffmpeg)', file=sys.stderr)
         args.stdout = False
 
-    STREAM_KEY = args.stream
+    if args.image_file is not None:
+        background_image = cv2.imread(args.image_file)
+        if background_image is None:
+            arg_parser.error(f'Could not read image from file {args.image_file}')
+
+    STREAM_KEYS = args.stream
     REDIS_HOST = args.redis_host
     REDIS_PORT = args.redis_port
 
-    if STREAM_KEY is None:
+    if STREAM_KEYS is None:
         redis_client = redis.Redis(REDIS_HOST, REDIS_PORT)
-        STREAM_KEY = choose_stream(redis_client)
-    
-    stop_event = register_stop_handler()
+        STREAM_KEYS = [choose_stream(redis_client)]
 
-    consume = RedisConsumer(REDIS_HOST, REDIS_PORT, [STREAM_KEY], block=200, start_at_head=args.start_at_head)
+    if len(STREAM_KEYS) > 1:
+        tile_size = (args.tile_width, round(args.tile_width * 9 / 16))
+        columns = args.columns if args.columns > 0 else math.ceil(math.sqrt(len(STREAM_KEYS)))
+        mosaic = Mosaic(STREAM_KEYS, tile_size, columns)
+        if args.stdout:
+            print(f'Writing mosaic frames of size {mosaic.image.shape[1]}x{mosaic.image.shape[0]} to stdout', file=sys.stderr)
 
-    with consume:
-        for stream_key, proto_data in consume():
-            if stop_event.is_set():
-                break
+        # Only the newest message of each stream is kept and decoded (at tile size) when its tile is refreshed
+        consumer = AsyncRedisConsumer(REDIS_HOST, REDIS_PORT, STREAM_KEYS, decode=partial(decode_tile, tile_size=tile_size), policy=BackpressurePolicy.LATEST_ONLY,
+                                      max_pending=len(STREAM_KEYS), max_decoding=2, decode_batch_size=1, start_at_head=args.start_at_head)
+        asyncio.run(watch_mosaic(consumer, mosaic, args.max_fps))
+        sys.exit(0)
 
-            if stream_key is None:
-                continue
-            
-            if (msg_type := determine_message_type(proto_data)) != InternalMessageType.SAE:
-                print(f'Detected message type on stream {stream_key} is {msg_type.name}. Only type SAE is supported.')
-                exit(1)
-            
-            handle_sae_message(proto_data, stream_key, show_image=not args.no_gui)
\ No newline at end of file
+    STREAM_KEY = STREAM_KEYS[0]
+
+    # Only the newest message is decoded and displayed, i.e. the display skips frames instead of falling behind the stream (unless all frames are written to stdout)
+    policy = BackpressurePolicy.BLOCK if args.stdout else BackpressurePolicy.LATEST_ONLY
+    consumer = AsyncRedisConsumer(REDIS_HOST, REDIS_PORT, [STREAM_KEY], decode=decode_sae_message, policy=policy,
+                                  max_pending=1, max_decoding=1, decode_batch_size=1, start_at_head=args.start_at_head)
+
+    asyncio.run(watch(consumer, STREAM_KEY))